@@ -0,0 +1,214 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional, Union
+from datetime import date
+
+import crud_async
+import schemas
+import cache
+import serialization
+import metrics
+from database import get_async_db, get_async_read_db
+
+# Async versions of the main endpoints, used when DB_ASYNC is enabled.
+# app.py registers this router ahead of its own routes, so these take over
+# the same paths; they are hidden from the OpenAPI schema because the sync
+# definitions already document identical parameters and responses.
+router = APIRouter(include_in_schema=False, route_class=metrics.InstrumentedRoute)
+
+
+# ========================================
+# PATIENT ENDPOINTS
+# ========================================
+
+@router.get("/api/patients", response_model=Union[schemas.PatientPage, List[schemas.Patient]])
+async def list_patients(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    order: str = "id",
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """Get all patients with pagination"""
+    if cursor is None:
+        patients = await crud_async.get_patients(db, skip=skip, limit=limit, columns=serialization.PATIENT_COLUMNS)
+        return serialization.FastJSONResponse(serialization.rows_to_dicts(patients))
+
+    try:
+        patients, next_cursor = await crud_async.get_patients_keyset(
+            db, cursor=cursor, limit=limit, order=order, columns=serialization.PATIENT_COLUMNS
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return serialization.FastJSONResponse(
+        {"items": serialization.rows_to_dicts(patients), "next_cursor": next_cursor}
+    )
+
+
+@router.get("/api/patients/search", response_model=List[schemas.Patient])
+async def search_patients(
+    q: str = Query(..., min_length=1),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """Search patients by name, MRN, phone or email prefix, with fuzzy name matching"""
+    return await crud_async.search_patients(db, q, skip=skip, limit=limit)
+
+
+@router.get("/api/patients/{patient_id}", response_model=schemas.PatientDetail)
+async def get_patient(
+    patient_id: int,
+    request: Request,
+    visits_limit: Optional[int] = Query(None, ge=0),
+    documents_limit: Optional[int] = Query(None, ge=0),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Get a single patient with their visits and documents"""
+    field = f"detail:{visits_limit}:{documents_limit}"
+    body = await cache.get_patient_response_async(patient_id, field)
+    if body is None:
+        patient = await crud_async.get_patient_detail(
+            db, patient_id, visits_limit=visits_limit, documents_limit=documents_limit
+        )
+        if not patient:
+            raise HTTPException(status_code=404, detail="Patient not found")
+        body = schemas.PatientDetail.model_validate(patient).model_dump_json().encode()
+        await cache.set_patient_response_async(patient_id, field, body)
+    return cache.json_response(request, body)
+
+
+@router.post("/api/patients", response_model=schemas.Patient, status_code=201)
+async def create_patient(patient: schemas.PatientCreate, db: AsyncSession = Depends(get_async_db)):
+    """Create a new patient"""
+    return await crud_async.create_patient(db, patient)
+
+
+@router.put("/api/patients/{patient_id}", response_model=schemas.Patient)
+async def update_patient(
+    patient_id: int,
+    patient_update: schemas.PatientUpdate,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Update a patient"""
+    updated_patient = await crud_async.update_patient(db, patient_id, patient_update)
+    if not updated_patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    return updated_patient
+
+
+@router.delete("/api/patients/{patient_id}")
+async def delete_patient(patient_id: int, db: AsyncSession = Depends(get_async_db)):
+    """Delete a patient"""
+    success = await crud_async.delete_patient(db, patient_id)
+    if not success:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    return {"message": "Patient deleted successfully"}
+
+
+# ========================================
+# VISIT ENDPOINTS
+# ========================================
+
+@router.get("/api/visits/search", response_model=schemas.VisitSearchResults)
+async def search_visits(
+    q: str = Query(..., min_length=1),
+    patient_id: Optional[int] = None,
+    start: Optional[date] = Query(None, alias="from"),
+    end: Optional[date] = Query(None, alias="to"),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """Full-text search over visit reason, diagnosis, treatment and notes"""
+    hits, truncated = await crud_async.search_visits(
+        db, q, patient_id=patient_id, start=start, end=end, skip=skip, limit=limit
+    )
+    return {
+        "items": [{"visit": visit, "snippet": snippet, "rank": rank} for visit, snippet, rank in hits],
+        "truncated": truncated,
+    }
+
+
+@router.get("/api/patients/{patient_id}/visits", response_model=List[schemas.Visit])
+async def get_patient_visits(patient_id: int, request: Request, db: AsyncSession = Depends(get_async_db)):
+    """Get all visits for a patient"""
+    body = await cache.get_patient_response_async(patient_id, "visits")
+    if body is None:
+        # Check if patient exists
+        if not await crud_async.patient_exists(db, patient_id):
+            raise HTTPException(status_code=404, detail="Patient not found")
+
+        visits = await crud_async.get_patient_visits(db, patient_id, columns=serialization.VISIT_COLUMNS)
+        body = serialization.rows_json(visits)
+        await cache.set_patient_response_async(patient_id, "visits", body)
+    return cache.json_response(request, body)
+
+
+@router.post("/api/patients/{patient_id}/visits", response_model=schemas.Visit, status_code=201)
+async def create_visit(
+    patient_id: int,
+    visit: schemas.VisitCreate,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Create a new visit for a patient"""
+    if not await crud_async.patient_exists(db, patient_id):
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+    visit.patient_id = patient_id
+    return await crud_async.create_visit(db, visit)
+
+
+# ========================================
+# DOCUMENT ENDPOINTS
+# ========================================
+
+@router.get("/api/patients/{patient_id}/documents", response_model=List[schemas.Document])
+async def get_patient_documents(patient_id: int, request: Request, db: AsyncSession = Depends(get_async_db)):
+    """Get all documents for a patient"""
+    body = await cache.get_patient_response_async(patient_id, "documents")
+    if body is None:
+        # Check if patient exists
+        if not await crud_async.patient_exists(db, patient_id):
+            raise HTTPException(status_code=404, detail="Patient not found")
+
+        documents = await crud_async.get_patient_documents(db, patient_id, columns=serialization.DOCUMENT_COLUMNS)
+        body = serialization.rows_json(documents)
+        await cache.set_patient_response_async(patient_id, "documents", body)
+    return cache.json_response(request, body)
+
+
+@router.post("/api/documents/upload", response_model=schemas.Document, status_code=201)
+async def upload_document(document: schemas.DocumentCreate, db: AsyncSession = Depends(get_async_db)):
+    """Create a document record"""
+    if not await crud_async.patient_exists(db, document.patient_id):
+        raise HTTPException(status_code=404, detail="Patient not found")
+    return await crud_async.create_document(db, document)
+
+
+# ========================================
+# ANALYTICS ENDPOINTS
+# ========================================
+
+@router.get("/api/analytics/stats")
+async def get_stats(db: AsyncSession = Depends(get_async_read_db)):
+    """Get overall statistics"""
+    return await crud_async.get_stats(db)
+
+
+@router.get("/api/analytics/trends")
+async def get_trends(
+    start: Optional[date] = Query(None, alias="from"),
+    end: Optional[date] = Query(None, alias="to"),
+    granularity: str = "month",
+    group_by: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """Get visit trends over time"""
+    try:
+        trends = await crud_async.get_trends(
+            db, granularity=granularity, start=start, end=end, group_by=group_by
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"granularity": granularity, "trends": trends}
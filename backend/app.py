@@ -1,15 +1,25 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from typing import List
-from datetime import datetime, timedelta
+from typing import List, Optional, Union
+from datetime import date, datetime
+import asyncio
+import mimetypes
+import anyio
 
 import database
 import crud
 import schemas
-from database import get_db, init_db
+import cache
+import serialization
+import metrics
+from database import get_db, get_read_db, init_db
 
 app = FastAPI(title="HealthPlus API", version="1.0.0")
+# Every route records when its endpoint returned, for the serialization metric
+app.router.route_class = metrics.InstrumentedRoute
 
 # CORS - allow frontend to talk to backend
 app.add_middleware(
@@ -19,12 +29,51 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Read-your-writes tokens for clients that just wrote (see replicas.py)
+if database.replica_set is not None:
+    import replicas
+    app.add_middleware(replicas.ReadTokenMiddleware, replica_set=database.replica_set)
+# Outermost, so request latency covers the other middleware too
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+# Async mode: the async endpoints are registered first so they take over
+# the matching routes defined below
+if database.DB_ASYNC:
+    import api_async
+    app.include_router(api_async.router)
 
 
 # Initialize database on startup
 @app.on_event("startup")
 def startup_event():
+    import changes
+    import jobs
+    import partitions
+    import stats
+    # Connect in the background while init_db runs
+    database.start_warmup_thread()
     init_db()
+    stats.start_reconcile_thread(database.SessionLocal)
+    jobs.start_worker_thread(database.SessionLocal)
+    changes.start_maintenance_thread(database.SessionLocal)
+    cache.start_invalidation_thread(database.SessionLocal)
+    partitions.start_maintenance_thread(database.engine)
+    if database.replica_set is not None:
+        import replicas
+        replicas.start_health_thread(database.replica_set)
+
+
+if database.DB_ASYNC:
+    @app.on_event("startup")
+    async def warm_async_pools():
+        # Not awaited, so the first requests don't wait for the warm-up either
+        app.state.pool_warmup = asyncio.create_task(database.warm_async_pools())
+
+    @app.on_event("shutdown")
+    async def finish_async_warmup():
+        # A warm-up still connecting when the server stops would leave its connections unclosed
+        await app.state.pool_warmup
 
 
 @app.get("/")
@@ -36,24 +85,86 @@ def welcome():
     }
 
 
+def _iter_request_body(request: Request):
+    """Pull the request body chunk by chunk from a worker thread"""
+    stream = request.stream().__aiter__()
+    while True:
+        try:
+            yield anyio.from_thread.run(stream.__anext__)
+        except StopAsyncIteration:
+            return
+
+
 # ========================================
 # PATIENT ENDPOINTS
 # ========================================
 
-@app.get("/api/patients", response_model=List[schemas.Patient])
-def list_patients(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    """Get all patients with pagination"""
-    patients = crud.get_patients(db, skip=skip, limit=limit)
-    return patients
+@app.get("/api/patients", response_model=Union[schemas.PatientPage, List[schemas.Patient]])
+def list_patients(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    order: str = "id",
+    db: Session = Depends(get_read_db)
+):
+    """
+    Get all patients with pagination.
+    Without a cursor this uses skip/limit and returns a plain list.
+    Pass cursor (empty for the first page) to use keyset pagination instead;
+    the response then includes next_cursor for fetching the following page.
+    Keyset pages can be ordered by "id" or "name" (last, first, id).
+    """
+    if cursor is None:
+        patients = crud.get_patients(db, skip=skip, limit=limit, columns=serialization.PATIENT_COLUMNS)
+        return serialization.FastJSONResponse(serialization.rows_to_dicts(patients))
+
+    try:
+        patients, next_cursor = crud.get_patients_keyset(
+            db, cursor=cursor, limit=limit, order=order, columns=serialization.PATIENT_COLUMNS
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return serialization.FastJSONResponse(
+        {"items": serialization.rows_to_dicts(patients), "next_cursor": next_cursor}
+    )
+
+
+@app.get("/api/patients/search", response_model=List[schemas.Patient])
+def search_patients(
+    q: str = Query(..., min_length=1),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_read_db)
+):
+    """Search patients by name, MRN, phone or email prefix, with fuzzy name matching"""
+    import search
+    return search.search_patients(db, q, skip=skip, limit=limit)
 
 
 @app.get("/api/patients/{patient_id}", response_model=schemas.PatientDetail)
-def get_patient(patient_id: int, db: Session = Depends(get_db)):
-    """Get a single patient with their visits and documents"""
-    patient = crud.get_patient(db, patient_id)
-    if not patient:
-        raise HTTPException(status_code=404, detail="Patient not found")
-    return patient
+def get_patient(
+    patient_id: int,
+    request: Request,
+    visits_limit: Optional[int] = Query(None, ge=0),
+    documents_limit: Optional[int] = Query(None, ge=0),
+    db: Session = Depends(get_db)
+):
+    """
+    Get a single patient with their visits and documents.
+    Use visits_limit / documents_limit to only embed the most recent ones.
+    Responses are cached and carry an ETag; send If-None-Match to get a 304.
+    """
+    field = f"detail:{visits_limit}:{documents_limit}"
+    body = cache.get_patient_response(patient_id, field)
+    if body is None:
+        patient = crud.get_patient_detail(
+            db, patient_id, visits_limit=visits_limit, documents_limit=documents_limit
+        )
+        if not patient:
+            raise HTTPException(status_code=404, detail="Patient not found")
+        body = schemas.PatientDetail.model_validate(patient).model_dump_json().encode()
+        cache.set_patient_response(patient_id, field, body)
+    return cache.json_response(request, body)
 
 
 @app.post("/api/patients", response_model=schemas.Patient, status_code=201)
@@ -88,16 +199,53 @@ def delete_patient(patient_id: int, db: Session = Depends(get_db)):
 # VISIT ENDPOINTS
 # ========================================
 
+@app.get("/api/visits/search", response_model=schemas.VisitSearchResults)
+def search_visits(
+    q: str = Query(..., min_length=1),
+    patient_id: Optional[int] = None,
+    start: Optional[date] = Query(None, alias="from"),
+    end: Optional[date] = Query(None, alias="to"),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_read_db)
+):
+    """
+    Full-text search over visit reason, diagnosis, treatment and notes.
+    Supports "quoted phrases", OR and -excluded terms, with optional patient
+    and visit date (from/to) filters. Results are ranked by relevance and
+    include a highlighted snippet. Only the newest SEARCH_MAX_CANDIDATES
+    matches are ranked; truncated says when there were more.
+    """
+    import search
+    hits, truncated = search.search_visits(
+        db, q, patient_id=patient_id, start=start, end=end, skip=skip, limit=limit
+    )
+    return {
+        "items": [{"visit": visit, "snippet": snippet, "rank": rank} for visit, snippet, rank in hits],
+        "truncated": truncated,
+    }
+
+
+@app.get("/api/visits/partitions")
+def visit_partitions(db: Session = Depends(get_db)):
+    """Live visit partitions and archived ones, with their date ranges and archive files"""
+    import partitions
+    return partitions.get_partitions(db)
+
+
 @app.get("/api/patients/{patient_id}/visits", response_model=List[schemas.Visit])
-def get_patient_visits(patient_id: int, db: Session = Depends(get_db)):
+def get_patient_visits(patient_id: int, request: Request, db: Session = Depends(get_db)):
     """Get all visits for a patient"""
-    # Check if patient exists
-    patient = crud.get_patient(db, patient_id)
-    if not patient:
-        raise HTTPException(status_code=404, detail="Patient not found")
+    body = cache.get_patient_response(patient_id, "visits")
+    if body is None:
+        # Check if patient exists
+        if not crud.patient_exists(db, patient_id):
+            raise HTTPException(status_code=404, detail="Patient not found")
 
-    visits = crud.get_patient_visits(db, patient_id)
-    return visits
+        visits = crud.get_patient_visits(db, patient_id, columns=serialization.VISIT_COLUMNS)
+        body = serialization.rows_json(visits)
+        cache.set_patient_response(patient_id, "visits", body)
+    return cache.json_response(request, body)
 
 
 @app.post("/api/patients/{patient_id}/visits", response_model=schemas.Visit, status_code=201)
@@ -108,8 +256,7 @@ def create_visit(
 ):
     """Create a new visit for a patient"""
     # Check if patient exists
-    patient = crud.get_patient(db, patient_id)
-    if not patient:
+    if not crud.patient_exists(db, patient_id):
         raise HTTPException(status_code=404, detail="Patient not found")
 
     # Ensure patient_id in visit matches URL parameter
@@ -122,15 +269,18 @@ def create_visit(
 # ========================================
 
 @app.get("/api/patients/{patient_id}/documents", response_model=List[schemas.Document])
-def get_patient_documents(patient_id: int, db: Session = Depends(get_db)):
+def get_patient_documents(patient_id: int, request: Request, db: Session = Depends(get_db)):
     """Get all documents for a patient"""
-    # Check if patient exists
-    patient = crud.get_patient(db, patient_id)
-    if not patient:
-        raise HTTPException(status_code=404, detail="Patient not found")
+    body = cache.get_patient_response(patient_id, "documents")
+    if body is None:
+        # Check if patient exists
+        if not crud.patient_exists(db, patient_id):
+            raise HTTPException(status_code=404, detail="Patient not found")
 
-    documents = crud.get_patient_documents(db, patient_id)
-    return documents
+        documents = crud.get_patient_documents(db, patient_id, columns=serialization.DOCUMENT_COLUMNS)
+        body = serialization.rows_json(documents)
+        cache.set_patient_response(patient_id, "documents", body)
+    return cache.json_response(request, body)
 
 
 @app.post("/api/documents/upload", response_model=schemas.Document, status_code=201)
@@ -141,66 +291,370 @@ def upload_document(document: schemas.DocumentCreate, db: Session = Depends(get_
     For now, this just creates the metadata record.
     """
     # Check if patient exists
-    patient = crud.get_patient(db, document.patient_id)
-    if not patient:
+    if not crud.patient_exists(db, document.patient_id):
         raise HTTPException(status_code=404, detail="Patient not found")
 
     return crud.create_document(db, document)
 
 
+@app.post("/api/patients/{patient_id}/documents", response_model=schemas.Document, status_code=201)
+def upload_document_file(patient_id: int, request: Request, db: Session = Depends(get_db)):
+    """
+    Upload a document file as multipart/form-data, with the file in a "file"
+    part and an optional "description" field. The file is streamed to storage
+    in fixed-size chunks; size and SHA-256 are computed on the way, and
+    identical content is only stored once.
+    """
+    import files
+    import storage
+    # Check if patient exists
+    if not crud.patient_exists(db, patient_id):
+        raise HTTPException(status_code=404, detail="Patient not found")
+    # Don't hold a database connection while the file streams in
+    db.close()
+
+    try:
+        upload = files.receive_upload(
+            request.headers.get("content-type", ""), _iter_request_body(request), storage.get_storage()
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    document = schemas.DocumentCreate(
+        patient_id=patient_id,
+        filename=upload.filename,
+        file_type=upload.file_type,
+        description=upload.fields.get("description"),
+        file_url=upload.stored.url,
+        file_size=upload.stored.size,
+    )
+    return crud.create_document(db, document, sha256=upload.stored.sha256)
+
+
+@app.get("/api/documents/{document_id}/content")
+def download_document(document_id: int, request: Request, db: Session = Depends(get_db)):
+    """Download a document file. Supports single-range Range requests."""
+    import files
+    import storage
+    document = crud.get_document(db, document_id)
+    if not document or not document.sha256:
+        raise HTTPException(status_code=404, detail="Document file not found")
+
+    size = document.file_size
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{document.sha256}"',
+        "Content-Disposition": files.content_disposition(document.filename),
+    }
+    media_type = mimetypes.guess_type(document.filename)[0] or "application/octet-stream"
+    try:
+        byte_range = files.parse_range(request.headers.get("range"), size)
+    except ValueError:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(storage.get_storage().read(document.sha256), media_type=media_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        storage.get_storage().read(document.sha256, start, end),
+        status_code=206, media_type=media_type, headers=headers
+    )
+
+
+@app.get("/api/documents/{document_id}/extraction", response_model=schemas.DocumentExtraction)
+def get_document_extraction(document_id: int, db: Session = Depends(get_db)):
+    """Text and metadata extracted from a document file by the processing worker"""
+    document = crud.get_document(db, document_id)
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return document
+
+
 # ========================================
-# ANALYTICS ENDPOINTS
+# BATCH WRITE ENDPOINTS
 # ========================================
 
-@app.get("/api/analytics/stats")
-def get_stats(db: Session = Depends(get_db)):
-    """Get overall statistics"""
-    from models import Patient, Visit, Document
+@app.post("/api/batch")
+def batch_write(request: schemas.BatchRequest, db: Session = Depends(get_db)):
+    """
+    Apply a list of operations (create_patient, update_patient, create_visit,
+    create_document) in one transaction. Give create_patient a ref and later
+    operations can use it as patient_ref. Returns the id of every created or
+    updated row; if any operation is invalid nothing is written and the 422
+    response marks which ones failed.
+    """
+    import batch
+    if len(request.operations) > batch.MAX_BATCH_OPERATIONS:
+        raise HTTPException(status_code=413, detail=f"At most {batch.MAX_BATCH_OPERATIONS} operations per batch")
+    try:
+        return batch.apply_batch(db, request.operations)
+    except batch.BatchError as e:
+        return JSONResponse(status_code=422, content={"committed": False, "results": e.results})
+    except IntegrityError as e:
+        raise HTTPException(status_code=409, detail=f"Batch failed: {e.orig}")
 
-    total_patients = db.query(Patient).count()
-    total_visits = db.query(Visit).count()
-    total_documents = db.query(Document).count()
 
-    # Get recent visits (last 30 days)
-    thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-    recent_visits = db.query(Visit).filter(Visit.visit_date >= thirty_days_ago).count()
+# ========================================
+# BULK IMPORT ENDPOINTS
+# ========================================
 
-    # Get new patients (last 30 days)
-    new_patients = db.query(Patient).filter(Patient.created_at >= thirty_days_ago).count()
+@app.post("/api/import/{kind}")
+def bulk_import(
+    kind: str,
+    request: Request,
+    format: str = "ndjson",
+    batch_size: Optional[int] = Query(None, ge=1, le=50000),
+    db: Session = Depends(get_db)
+):
+    """
+    Bulk import patients or visits from an NDJSON or CSV request body.
+    The body is streamed and written in batches; the response reports
+    per-row errors and throughput. A body that can't be read on (malformed
+    CSV, invalid UTF-8) gets a 400 naming the line, with the report of the
+    rows before it - committed is how many of those were written.
+    """
+    import importer
+    if kind not in importer.IMPORT_KINDS:
+        raise HTTPException(status_code=404, detail="Unknown import kind")
+    if format not in importer.IMPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Format must be ndjson or csv")
 
-    return {
-        "total_patients": total_patients,
-        "total_visits": total_visits,
-        "total_documents": total_documents,
-        "recent_visits_30d": recent_visits,
-        "new_patients_30d": new_patients,
-        "avg_visits_per_patient": round(total_visits / total_patients, 2) if total_patients > 0 else 0
-    }
+    stream = importer.open_chunks(_iter_request_body(request))
+    try:
+        return importer.import_stream(db, kind, stream, format, batch_size=batch_size or importer.DEFAULT_BATCH_SIZE)
+    except importer.ImportStreamError as e:
+        raise HTTPException(status_code=400, detail={
+            "error": str(e), "line": e.line, "committed": e.report["imported"], "report": e.report,
+        })
+
+
+# ========================================
+# EXPORT ENDPOINTS
+# ========================================
+
+@app.get("/api/export/{kind}")
+def export(kind: str, request: Request, format: str = "ndjson", updated_since: Optional[datetime] = None):
+    """
+    Stream every patient, visit or document as NDJSON, CSV, Parquet or Arrow.
+    Pass updated_since to only export rows changed at or after that time
+    (for visits, which are never edited, created at or after it).
+    Rows are read with a server-side cursor, so memory use doesn't grow
+    with the size of the table.
+    """
+    import exporter
+    try:
+        stream = exporter.export_stream(database.get_read_engine(request), kind, format, updated_since)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ImportError:
+        raise HTTPException(status_code=501, detail=f"{format} export needs pyarrow installed")
+    return StreamingResponse(
+        stream,
+        media_type=exporter.EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{kind}.{format}"'},
+    )
+
+
+# ========================================
+# CHANGE FEED ENDPOINTS
+# ========================================
+
+def _read_changes(db: Session, cursor: str, limit: int):
+    import changes
+    try:
+        return changes.get_changes(db, cursor, limit)
+    except changes.CursorExpired as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/changes", response_model=schemas.ChangePage)
+def get_changes(
+    cursor: Optional[str] = None,
+    consumer: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: Session = Depends(get_db)
+):
+    """
+    Page through every patient, visit and document change, oldest first.
+    Start without a cursor (or with a consumer name to resume from its saved
+    position) and pass next_cursor back to continue. Older changes are
+    compacted to the latest one per row, so treat create and update alike as
+    an upsert. 410 means the cursor has expired: resync from an export.
+    """
+    import changes
+    if cursor is None and consumer is not None:
+        saved = changes.get_consumer(db, consumer)
+        cursor = saved.cursor if saved is not None else None
+    page, next_cursor = _read_changes(db, cursor or "", limit)
+    return {"changes": page, "next_cursor": next_cursor}
+
+
+@app.put("/api/changes/consumers/{name}")
+def save_change_consumer(name: str, ack: schemas.ChangeAck, db: Session = Depends(get_db)):
+    """Save how far a named consumer has read, for resuming and lag monitoring"""
+    import changes
+    try:
+        consumer = changes.save_consumer(db, name, ack.cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return changes.consumer_lag(db, consumer)
+
+
+@app.get("/api/changes/stream")
+async def stream_changes(request: Request, cursor: Optional[str] = None):
+    """
+    Server-sent events stream of changes. Each event's id is the cursor after
+    it, so a reconnecting EventSource resumes where it left off through the
+    Last-Event-ID header.
+    """
+    import changes
+    cursor = request.headers.get("last-event-id") or cursor or ""
+
+    def poll(cursor: str):
+        db = database.SessionLocal()
+        try:
+            return _read_changes(db, cursor, 500)
+        finally:
+            db.close()
+
+    # Check the cursor before the response starts, so errors get a status code
+    page, cursor = await anyio.to_thread.run_sync(poll, cursor)
+
+    async def events(page, cursor):
+        idle = 0.0
+        while not await request.is_disconnected():
+            for change in page:
+                data = schemas.Change.model_validate(change).model_dump_json()
+                yield f"id: {changes.change_cursor(change)}\nevent: change\ndata: {data}\n\n"
+            if page:
+                idle = 0.0
+            else:
+                await anyio.sleep(changes.CHANGES_POLL_SECONDS)
+                idle += changes.CHANGES_POLL_SECONDS
+                if idle >= changes.CHANGES_KEEPALIVE_SECONDS:
+                    idle = 0.0
+                    yield ": keepalive\n\n"
+            try:
+                page, cursor = await anyio.to_thread.run_sync(poll, cursor)
+            except HTTPException as e:
+                yield f"event: error\ndata: {e.detail}\n\n"
+                return
+
+    return StreamingResponse(
+        events(page, cursor),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# ========================================
+# ANALYTICS ENDPOINTS
+# ========================================
+
+@app.get("/api/analytics/stats")
+def get_stats(db: Session = Depends(get_read_db)):
+    """
+    Get overall statistics.
+    Served from counters maintained on every write; staleness_seconds is the
+    time since they were last reconciled against the source tables.
+    """
+    import stats
+    return stats.get_stats(db)
 
 
 @app.get("/api/analytics/trends")
-def get_trends(db: Session = Depends(get_db)):
-    """Get visit trends over time"""
-    from models import Visit
-    from sqlalchemy import func, extract
+def get_trends(
+    start: Optional[date] = Query(None, alias="from"),
+    end: Optional[date] = Query(None, alias="to"),
+    granularity: str = "month",
+    group_by: Optional[str] = None,
+    db: Session = Depends(get_read_db)
+):
+    """
+    Get visit trends over time.
+    granularity is day, week or month; group_by optionally breaks each period
+    down by reason, gender or age_band. Served from pre-aggregated rollups.
+    """
+    import stats
+    try:
+        trends = stats.get_trends(db, granularity=granularity, start=start, end=end, group_by=group_by)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"granularity": granularity, "trends": trends}
+
+
+def _cohort(db: Session, metric: str, **params):
+    import cohorts  # NumPy - loaded on the first cohort request rather than at startup
+    try:
+        return cohorts.get_cohort(db, metric, **params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/analytics/cohorts")
+def list_cohort_metrics():
+    """The cohort metrics available under /api/analytics/cohorts/{metric}"""
+    import cohorts
+    return {"metrics": list(cohorts.COHORT_METRICS), "groups": list(cohorts.COHORT_GROUPS)}
+
+
+@app.get("/api/analytics/cohorts/visit-frequency")
+def cohort_visit_frequency(
+    start: Optional[date] = Query(None, alias="from"),
+    end: Optional[date] = Query(None, alias="to"),
+    db: Session = Depends(get_read_db)
+):
+    """
+    Visits per patient (mean, median, p90 and share with any visit) by age
+    band and gender, counting visits between from and to. Ages are as of to,
+    or today.
+    """
+    return _cohort(db, "visit-frequency", start=start, end=end)
 
-    # Get visits grouped by month
-    visits_by_month = db.query(
-        extract('year', Visit.visit_date).label('year'),
-        extract('month', Visit.visit_date).label('month'),
-        func.count(Visit.id).label('count')
-    ).group_by('year', 'month').order_by('year', 'month').all()
 
-    trends = [
-        {
-            "year": int(year),
-            "month": int(month),
-            "visit_count": count
-        }
-        for year, month, count in visits_by_month
-    ]
+@app.get("/api/analytics/cohorts/visit-intervals")
+def cohort_visit_intervals(
+    start: Optional[date] = Query(None, alias="from"),
+    end: Optional[date] = Query(None, alias="to"),
+    group_by: Optional[str] = None,
+    db: Session = Depends(get_read_db)
+):
+    """
+    Days between each patient's consecutive visits: mean, quartiles, p90 and
+    a histogram, optionally also per gender or age_band.
+    """
+    return _cohort(db, "visit-intervals", start=start, end=end, group_by=group_by)
 
-    return {"trends": trends}
+
+@app.get("/api/analytics/cohorts/retention")
+def cohort_retention(
+    start: Optional[date] = Query(None, alias="from"),
+    end: Optional[date] = Query(None, alias="to"),
+    months: int = Query(12, ge=1, le=60),
+    db: Session = Depends(get_read_db)
+):
+    """
+    Monthly retention: patients grouped by the month of their first visit,
+    and for each following month the share of them who visited again.
+    from/to select the cohorts by first-visit month.
+    """
+    return _cohort(db, "retention", start=start, end=end, months=months)
+
+
+@app.get("/api/analytics/cohorts/prevalence")
+def cohort_prevalence(
+    group_by: Optional[str] = None,
+    top: int = Query(20, ge=1, le=200),
+    db: Session = Depends(get_read_db)
+):
+    """Blood type and allergy prevalence, optionally also per gender or age_band"""
+    return _cohort(db, "prevalence", group_by=group_by, top=top)
 
 
 # ========================================
@@ -216,6 +670,85 @@ def health_check():
     }
 
 
+def _engines():
+    """(name, engine) for every engine with a connection pool"""
+    engines = [("sync", database.engine)]
+    if database.async_engine is not None:
+        engines.append(("async", database.async_engine.sync_engine))
+    if database.replica_set is not None:
+        for replica in database.replica_set.replicas:
+            engines.append((replica.name, replica.engine))
+            if replica.async_engine is not None:
+                engines.append((f"{replica.name}-async", replica.async_engine.sync_engine))
+    return engines
+
+
+@app.get("/api/health/pool")
+def pool_stats():
+    """Database connection pool metrics"""
+    return {name: database.get_pool_stats(db_engine) for name, db_engine in _engines()}
+
+
+@app.get("/api/health/replicas")
+def replica_stats():
+    """Read replica health, lag and latency from the last health check"""
+    if database.replica_set is None:
+        return {"replicas": []}
+    return database.replica_set.stats()
+
+
+@app.get("/api/health/cache")
+def cache_stats():
+    """Response cache hit-rate metrics"""
+    return cache.cache.stats()
+
+
+@app.get("/api/health/jobs")
+def job_stats(db: Session = Depends(get_db)):
+    """Document processing queue depth and worker throughput"""
+    import jobs
+    return {
+        "queue": jobs.get_queue_stats(db),
+        "worker": jobs.worker.metrics() if jobs.worker is not None else None,
+    }
+
+
+@app.get("/api/health/changes")
+def change_feed_stats(db: Session = Depends(get_db)):
+    """Change log size and how far behind each registered consumer is"""
+    import changes
+    return changes.get_feed_stats(db)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """Per-route request metrics and pool/cache state in Prometheus text format"""
+    pools = [({"engine": name}, database.get_pool_stats(db_engine)) for name, db_engine in _engines()]
+    extra = []
+    for key, kind, name in (
+        ("checked_out", "gauge", "db_pool_checked_out"),
+        ("overflow", "gauge", "db_pool_overflow"),
+        ("timeouts", "counter", "db_pool_timeouts_total"),
+    ):
+        samples = [(labels, pool[key]) for labels, pool in pools if key in pool]
+        if samples:
+            extra += metrics.render_values(name, f"Connection pool {key.replace('_', ' ')}", samples, kind)
+    cache_stats = cache.cache.stats()
+    for key in ("hits", "misses", "invalidations"):
+        extra += metrics.render_values(f"cache_{key}_total", f"Response cache {key}", [({}, cache_stats[key])], "counter")
+    if database.replica_set is not None:
+        labelled = [({"replica": replica.name}, replica) for replica in database.replica_set.replicas]
+        extra += metrics.render_values(
+            "db_replica_healthy", "Replica passed its last health check",
+            [(labels, int(replica.healthy)) for labels, replica in labelled],
+        )
+        extra += metrics.render_values(
+            "db_replica_lag_seconds", "How far the replica is behind the primary",
+            [(labels, replica.lag_seconds) for labels, replica in labelled if replica.lag_seconds is not None],
+        )
+    return metrics.render(extra)
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
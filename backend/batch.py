@@ -0,0 +1,225 @@
+import time
+from datetime import datetime
+from pydantic import ValidationError
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from models import Patient, Visit, Document
+from schemas import PatientCreate, PatientUpdate, VisitCreate, DocumentCreate
+import cache
+import crud
+import partitions
+import stats
+
+# Batch writes for sync jobs.
+# A batch is a list of operations (create/update patient, create visit,
+# create document) applied in one transaction with a single commit. Later
+# operations can point at patients created earlier in the same batch through
+# a client-chosen "ref" label. Rows of each kind are inserted with one
+# multi-row INSERT ... RETURNING, so new IDs come back without a refresh
+# SELECT per row, and the statistics are bumped once per batch. (SQLite
+# doesn't promise RETURNING order for a multi-row insert, so there
+# SQLAlchemy sends the rows one at a time to keep ids in input order.)
+#
+# The whole batch either commits or doesn't: every operation is validated
+# before anything is written, and a failure rolls all of it back.
+
+BATCH_OPERATIONS = ("create_patient", "update_patient", "create_visit", "create_document")
+MAX_BATCH_OPERATIONS = 10000
+
+
+class BatchError(Exception):
+    """A batch that was rejected before anything was written"""
+
+    def __init__(self, results):
+        super().__init__("Batch rejected")
+        self.results = results
+
+
+def _validation_message(error: ValidationError):
+    return "; ".join(
+        f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in error.errors()
+    )
+
+
+class Batch:
+    """Validates a list of operations and applies them in one transaction"""
+
+    def __init__(self, db: Session, operations):
+        self.db = db
+        self.operations = operations
+        self.results = [
+            {"index": index, "op": operation.op, "ref": operation.ref, "status": "ok", "id": None}
+            for index, operation in enumerate(operations)
+        ]
+        self.failed = False
+        self.started = time.perf_counter()
+
+        self.new_patients = {}  # ref -> (result index, column values)
+        self.updates = []  # (result index, patient_id, column values)
+        self.ref_updates = []  # (result index, ref) - updates folded into a create
+        self.children = []  # (result index, model, column values, patient ref or None)
+        self.existing = {}  # patient_id -> Patient loaded from the database
+
+    def _fail(self, index: int, message: str):
+        self.failed = True
+        self.results[index].update(status="error", error=message)
+
+    def _patient_target(self, index: int, operation):
+        """Resolve an operation's patient_id / patient_ref; returns (patient_id, ref)"""
+        if operation.patient_ref is not None:
+            if operation.patient_ref not in self.new_patients:
+                self._fail(index, f"Unknown patient_ref: {operation.patient_ref} (must be created earlier in the batch)")
+            return None, operation.patient_ref
+        if operation.patient_id is None:
+            self._fail(index, "patient_id or patient_ref is required")
+        return operation.patient_id, None
+
+    def validate(self):
+        """Check every operation and resolve references. Raises BatchError if any fail."""
+        now = datetime.utcnow()
+        for index, operation in enumerate(self.operations):
+            try:
+                if operation.op == "create_patient":
+                    values = PatientCreate.model_validate(operation.data).model_dump()
+                    values.update(created_at=now, updated_at=now)
+                    if operation.ref is None or operation.ref in self.new_patients:
+                        self._fail(index, "create_patient needs a ref that is unique within the batch")
+                        continue
+                    self.new_patients[operation.ref] = (index, values)
+
+                elif operation.op == "update_patient":
+                    values = PatientUpdate.model_validate(operation.data).model_dump(exclude_unset=True)
+                    patient_id, ref = self._patient_target(index, operation)
+                    if ref is not None:
+                        # Patient created in this batch - fold the change into its insert
+                        if ref in self.new_patients:
+                            self.new_patients[ref][1].update(values)
+                            self.ref_updates.append((index, ref))
+                    elif patient_id is not None:
+                        self.updates.append((index, patient_id, values))
+
+                else:
+                    schema, model = (VisitCreate, Visit) if operation.op == "create_visit" else (DocumentCreate, Document)
+                    patient_id, ref = self._patient_target(index, operation)
+                    # Validate with a placeholder id when the patient is a ref
+                    data = {**operation.data, "patient_id": patient_id if patient_id is not None else 0}
+                    values = schema.model_validate(data).model_dump()
+                    values["created_at" if model is Visit else "uploaded_at"] = now
+                    self.children.append((index, model, values, ref))
+            except ValidationError as e:
+                self._fail(index, _validation_message(e))
+
+        # Load every existing patient the batch touches in one query
+        patient_ids = {patient_id for _, patient_id, _ in self.updates}
+        patient_ids |= {values["patient_id"] for _, _, values, ref in self.children if ref is None}
+        if patient_ids:
+            self.existing = {
+                patient.id: patient for patient in
+                self.db.query(Patient).filter(Patient.id.in_(patient_ids)).all()
+            }
+        for index, patient_id, _ in self.updates:
+            if patient_id not in self.existing:
+                self._fail(index, "Patient not found")
+        for index, _, values, ref in self.children:
+            if ref is None and values["patient_id"] not in self.existing:
+                self._fail(index, "Patient not found")
+
+        if self.failed:
+            for result in self.results:
+                if result["status"] == "ok":
+                    result["status"] = "skipped"
+            raise BatchError(self.results)
+
+    def _insert(self, model, rows):
+        """Multi-row INSERT ... RETURNING id; ids come back in row order"""
+        if not rows:
+            return []
+        return self.db.scalars(
+            insert(model).returning(model.id, sort_by_parameter_order=True), rows
+        ).all()
+
+    def apply(self):
+        """Write the validated batch and commit once"""
+        db = self.db
+        touched = set()
+        try:
+            # Patients first, so the rest of the batch can point at them
+            new_patients = list(self.new_patients.values())
+            if new_patients:
+                mrns = crud.generate_mrns(db, len(new_patients))
+                for (_, values), mrn in zip(new_patients, mrns):
+                    values["medical_record_number"] = mrn
+                ids = self._insert(Patient, [values for _, values in new_patients])
+                days = {}
+                for (index, values), patient_id in zip(new_patients, ids):
+                    values["id"] = patient_id
+                    self.results[index].update(id=patient_id, medical_record_number=values["medical_record_number"])
+                    days[values["created_at"]] = days.get(values["created_at"], 0) + 1
+                stats.bump(db, {"patients": len(ids)}, new_patients=days)
+
+            for index, patient_id, values in self.updates:
+                patient = self.existing[patient_id]
+                old_gender, old_date_of_birth = patient.gender, patient.date_of_birth
+                for key, value in values.items():
+                    setattr(patient, key, value)
+                if (patient.gender, patient.date_of_birth) != (old_gender, old_date_of_birth):
+                    stats.record_patient_demographics_changed(db, patient, old_gender, old_date_of_birth)
+                patient.updated_at = datetime.utcnow()
+                self.results[index]["id"] = patient_id
+                touched.add(patient_id)
+            for index, ref in self.ref_updates:
+                self.results[index]["id"] = self.new_patients[ref][1]["id"]
+
+            rollups = []
+            for model in (Visit, Document):
+                children = [(index, values, ref) for index, kind, values, ref in self.children if kind is model]
+                for _, values, ref in children:
+                    if ref is not None:
+                        values["patient_id"] = self.new_patients[ref][1]["id"]
+                    touched.add(values["patient_id"])
+                if model is Visit:
+                    partitions.assign_visit_ids(db, [values for _, values, _ in children])
+                ids = self._insert(model, [values for _, values, _ in children])
+                for (index, _, _), row_id in zip(children, ids):
+                    self.results[index]["id"] = row_id
+                if model is Visit and children:
+                    days = {}
+                    for _, values, ref in children:
+                        days[values["visit_date"]] = days.get(values["visit_date"], 0) + 1
+                        if ref is not None:
+                            patient = self.new_patients[ref][1]
+                            demographics = (patient.get("gender"), patient["date_of_birth"])
+                        else:
+                            patient = self.existing[values["patient_id"]]
+                            demographics = (patient.gender, patient.date_of_birth)
+                        rollups.append((values["visit_date"], values["reason"], *demographics))
+                    stats.bump(db, {"visits": len(children)}, visits=days)
+                    stats.bump_rollups(db, stats.rollup_deltas(rollups))
+                elif children:
+                    stats.bump(db, {"documents": len(children)})
+
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        for patient_id in touched:
+            cache.invalidate_patient(patient_id)
+
+    def report(self):
+        """Per-operation results"""
+        seconds = time.perf_counter() - self.started
+        return {
+            "committed": not self.failed,
+            "operations": len(self.operations),
+            "results": self.results,
+            "seconds": round(seconds, 3),
+        }
+
+
+def apply_batch(db: Session, operations):
+    """Validate and apply a batch in one transaction. Raises BatchError if it's rejected."""
+    batch = Batch(db, operations)
+    batch.validate()
+    batch.apply()
+    return batch.report()
@@ -0,0 +1,8 @@
+# Benchmarks. Run from the backend directory against a scratch database, e.g.
+#   python -m benchmarks.generate --scale 100k
+#   python -m benchmarks.micro --output micro.json
+#   python -m benchmarks.load --mode both --scenario mixed
+#   python -m benchmarks.visit_search --visits 1000000
+#   python -m benchmarks.cohorts
+# Each one can save its results (--output) and compare with a saved run
+# (--baseline), exiting non-zero on regressions - see benchmarks/results.py.
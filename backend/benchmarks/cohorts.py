@@ -0,0 +1,197 @@
+import os
+
+os.environ.setdefault("JOB_WORKERS", "0")
+
+import argparse
+import statistics
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import date
+
+import cohorts
+import stats
+from database import SessionLocal, init_db
+from models import Patient, Visit
+from benchmarks.generate import SCALES, generate, scale_counts
+from benchmarks.results import report, summarize
+
+# Cohort analytics benchmark.
+# Times each cohort metric three ways: "naive" loads Patient and Visit ORM
+# objects and loops over them in Python, "vectorized" computes it from the
+# NumPy extract (loading the extract is timed separately as
+# "extract(load)"), and "cached" is a repeat request answered from the
+# result cache. The naive results double as a check: the run fails if the
+# vectorized numbers differ.
+#
+#   DATABASE_URL=sqlite:///./bench.db python -m benchmarks.cohorts --scale 100k --output cohorts.json
+
+
+def _nearest_rank(ordered, q: float):
+    return ordered[int(q * (len(ordered) - 1))] if ordered else None
+
+
+def _load(db):
+    return db.query(Patient).all(), db.query(Visit).all()
+
+
+def naive_visit_frequency(db):
+    patients, visits = _load(db)
+    counts = Counter(visit.patient_id for visit in visits)
+    groups = defaultdict(list)
+    for patient in patients:
+        groups[(stats.age_band(patient.date_of_birth, date.today()), patient.gender or "Unknown")].append(
+            counts.get(patient.id, 0))
+    return {
+        group: (len(values), sum(values), _nearest_rank(sorted(values), 0.5), _nearest_rank(sorted(values), 0.9))
+        for group, values in groups.items()
+    }
+
+
+def naive_visit_intervals(db):
+    _, visits = _load(db)
+    days = defaultdict(list)
+    for visit in visits:
+        days[visit.patient_id].append(visit.visit_date.date())
+    gaps = []
+    for patient_days in days.values():
+        patient_days.sort()
+        gaps.extend((later - earlier).days for earlier, later in zip(patient_days, patient_days[1:]))
+    gaps.sort()
+    return len(gaps), _nearest_rank(gaps, 0.5), _nearest_rank(gaps, 0.9)
+
+
+def naive_retention(db, months: int = 12):
+    _, visits = _load(db)
+    visited = defaultdict(set)
+    for visit in visits:
+        visited[visit.patient_id].add(visit.visit_date.year * 12 + visit.visit_date.month - 1)
+    cohort_patients = Counter()
+    returned = Counter()
+    for patient_months in visited.values():
+        first = min(patient_months)
+        cohort_patients[first] += 1
+        for month in patient_months:
+            if month - first <= months:
+                returned[(first, month - first)] += 1
+    today = date.today()
+    current = today.year * 12 + today.month - 1
+    return {
+        f"{cohort // 12:04d}-{cohort % 12 + 1:02d}": [
+            round(returned[(cohort, offset)] / patients, 4) for offset in range(min(months, current - cohort) + 1)
+        ]
+        for cohort, patients in cohort_patients.items()
+    }
+
+
+def naive_prevalence(db):
+    patients, _ = _load(db)
+    blood_types = Counter(patient.blood_type or "Unknown" for patient in patients)
+    allergies = Counter(name for patient in patients for name in cohorts.allergy_names(patient.allergies or ""))
+    return dict(blood_types), dict(allergies)
+
+
+# Reduce a vectorized result to the shape of the naive one
+def _frequency_key(result):
+    return {
+        (row["age_band"], row["gender"]): (row["patients"], row["visits"], row["median_visits"], row["p90_visits"])
+        for row in result
+    }
+
+
+def _intervals_key(result):
+    return result["intervals"], result["median_days"], result["p90_days"]
+
+
+def _retention_key(result):
+    return {row["cohort"]: row["retention"] for row in result}
+
+
+def _prevalence_key(result):
+    return ({row["blood_type"]: row["patients"] for row in result["blood_types"]},
+            {row["allergy"]: row["patients"] for row in result["allergies"]})
+
+
+# metric -> (naive function, vectorized params, function reducing the vectorized result for comparison)
+CASES = {
+    "visit-frequency": (naive_visit_frequency, {}, _frequency_key),
+    "visit-intervals": (naive_visit_intervals, {}, _intervals_key),
+    "retention": (naive_retention, {"months": 12}, _retention_key),
+    "prevalence": (naive_prevalence, {"top": 1000}, _prevalence_key),
+}
+
+
+def _same(naive, vectorized):
+    """Compare with the naive result, allowing for float formatting"""
+    if isinstance(naive, dict):
+        return naive.keys() == vectorized.keys() and all(_same(naive[key], vectorized[key]) for key in naive)
+    if isinstance(naive, (list, tuple)):
+        return len(naive) == len(vectorized) and all(_same(a, b) for a, b in zip(naive, vectorized))
+    if isinstance(naive, (int, float)) and isinstance(vectorized, (int, float)):
+        return abs(naive - vectorized) < 1e-3
+    return naive == vectorized
+
+
+def _time(call, iterations: int, max_seconds: float):
+    timings = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        result = call()
+        timings.append((time.perf_counter() - call_started) * 1000)
+        if time.perf_counter() - started > max_seconds:
+            break
+    return result, timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark vectorized cohort analytics against a naive ORM version")
+    parser.add_argument("--scale", choices=SCALES, help="generate this much data first")
+    parser.add_argument("--iterations", type=int, default=20, help="calls per vectorized case")
+    parser.add_argument("--naive-iterations", type=int, default=3, help="calls per naive case")
+    parser.add_argument("--max-seconds", type=float, default=60.0, help="stop a case early after this long")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="compare against a saved run and exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change that counts as a regression")
+    args = parser.parse_args()
+
+    init_db()
+    db = SessionLocal()
+    try:
+        if args.scale:
+            patients, visits, documents = scale_counts(SCALES[args.scale])
+            generate(db, patients, visits, args.seed, documents)
+
+        extract, timings = _time(lambda: cohorts.load_extract(db), args.iterations, args.max_seconds)
+        results = {"extract(load)": summarize(timings)}
+        mismatches = []
+        for metric, (naive, params, key) in CASES.items():
+            naive_result, naive_timings = _time(lambda: naive(db), args.naive_iterations, args.max_seconds)
+            db.expunge_all()
+            result, timings = _time(lambda: cohorts.COHORT_METRICS[metric](extract, **params), args.iterations,
+                                    args.max_seconds)
+            cohorts.get_cohort(db, metric, **params)  # fill the cache
+            _, cached_timings = _time(lambda: cohorts.get_cohort(db, metric, **params), args.iterations,
+                                      args.max_seconds)
+            results[f"{metric}/naive"] = summarize(naive_timings)
+            results[f"{metric}/vectorized"] = summarize(timings)
+            results[f"{metric}/cached"] = summarize(cached_timings)
+            results[f"{metric}/vectorized"]["speedup"] = round(
+                statistics.median(naive_timings) / statistics.median(timings), 1)
+            if not _same(naive_result, key(result)):
+                mismatches.append(metric)
+            print(f"{metric}: naive p50 {results[f'{metric}/naive']['p50_ms']} ms, "
+                  f"vectorized p50 {results[f'{metric}/vectorized']['p50_ms']} ms", file=sys.stderr)
+        rows = {"patients": extract.patients, "visits": extract.visits}
+        dialect = db.get_bind().dialect.name
+    finally:
+        db.close()
+
+    if mismatches:
+        print(f"Vectorized results differ from the naive ones: {', '.join(mismatches)}", file=sys.stderr)
+    code = report(
+        {"benchmark": "cohorts", "dialect": dialect, "rows": rows, "results": results, "mismatches": mismatches},
+        args.output, args.baseline, args.threshold,
+    )
+    sys.exit(1 if mismatches else code)
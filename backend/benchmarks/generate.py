@@ -0,0 +1,280 @@
+import argparse
+import random
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from sqlalchemy import bindparam, text
+
+import crud
+import partitions
+import search
+import stats
+from database import SessionLocal, init_db
+from importer import _insert_rows
+from models import Patient, Visit, Document
+
+# Synthetic data generator.
+# Fills the configured database (DATABASE_URL - use a scratch database, it
+# only ever adds rows) with realistic-looking patients, visits and documents.
+# It's deterministic for a given seed and size. Visits and documents are
+# skewed towards a minority of frequent patients, and all dates are spread
+# over the last ten years, so the indexes, search and analytics see data
+# shaped like production.
+#
+# Rows go in through the bulk import path (executemany on SQLite, COPY on
+# PostgreSQL) with the table triggers switched off, so each batch is a plain
+# insert. Afterwards the search index is backfilled and the statistics are
+# rebuilt. Generated rows are deliberately not in the change feed.
+#
+#   DATABASE_URL=sqlite:///./bench.db python -m benchmarks.generate --scale 1m
+#   DATABASE_URL=postgresql://localhost/bench python -m benchmarks.generate --scale 10m
+
+# Total rows per named scale
+SCALES = {"1k": 1_000, "10k": 10_000, "100k": 100_000, "1m": 1_000_000, "10m": 10_000_000}
+# Share of the rows that are patients, visits and documents
+MIX = (0.1, 0.8, 0.1)
+
+FIRST_NAMES = [
+    "James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael", "Linda", "David", "Elizabeth",
+    "William", "Barbara", "Richard", "Susan", "Joseph", "Jessica", "Thomas", "Sarah", "Carlos", "Maria",
+    "Wei", "Mei", "Ahmed", "Fatima", "Olga", "Ivan", "Aisha", "Kwame", "Priya", "Raj",
+    "Sofia", "Mateo", "Emma", "Noah", "Olivia", "Liam", "Yuki", "Hiroshi", "Chloe", "Lucas",
+]
+LAST_NAMES = [
+    "Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez", "Martinez",
+    "Hernandez", "Lopez", "Gonzalez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin",
+    "Lee", "Chen", "Wang", "Nguyen", "Kim", "Patel", "Shah", "Okafor", "Mensah", "Novak",
+    "Kowalski", "Ivanova", "Schmidt", "Muller", "Rossi", "Silva", "Santos", "Tanaka", "Sato", "Haddad",
+]
+STREETS = ["Main", "Oak", "Pine", "Maple", "Cedar", "Elm", "Lake", "Hill", "Park", "Washington", "River", "Sunset"]
+CITIES = ["Springfield", "Riverside", "Franklin", "Greenville", "Bristol", "Clinton", "Fairview", "Madison"]
+GENDERS = ["Female", "Male", "Other", None]
+GENDER_WEIGHTS = [49, 48, 1, 2]
+BLOOD_TYPES = ["O+", "A+", "B+", "AB+", "O-", "A-", "B-", "AB-", None]
+BLOOD_TYPE_WEIGHTS = [37, 34, 9, 3, 6, 6, 2, 1, 30]
+ALLERGIES = ["Penicillin", "Sulfa drugs", "Latex", "Peanuts", "Shellfish", "Aspirin", "Codeine", "Bee stings"]
+
+REASONS = [
+    "Annual physical", "Follow-up", "Chest pain", "Shortness of breath", "Back pain",
+    "Headache", "Medication review", "Diabetes check", "Blood pressure check", "Flu symptoms",
+    "Skin rash", "Abdominal pain", "Joint pain", "Anxiety", "Sleep problems",
+]
+DIAGNOSES = [
+    "type 2 diabetes mellitus", "essential hypertension", "hyperlipidemia", "acute bronchitis",
+    "migraine without aura", "lumbar strain", "generalized anxiety disorder", "asthma",
+    "gastroesophageal reflux disease", "osteoarthritis of the knee", "urinary tract infection",
+    "atrial fibrillation", "hypothyroidism", "major depressive disorder", "contact dermatitis",
+]
+TREATMENTS = [
+    "metformin 500 mg twice daily", "lisinopril 10 mg daily", "atorvastatin 20 mg nightly",
+    "amoxicillin 500 mg three times daily", "sumatriptan as needed", "physical therapy referral",
+    "sertraline 50 mg daily", "albuterol inhaler as needed", "omeprazole 20 mg daily",
+    "ibuprofen 400 mg as needed", "nitrofurantoin 100 mg twice daily", "apixaban 5 mg twice daily",
+    "levothyroxine 50 mcg daily", "hydrocortisone cream", "lifestyle counseling",
+]
+NOTE_PHRASES = [
+    "Patient reports improvement since last visit.", "Symptoms worse at night.",
+    "Advised to reduce salt intake.", "Blood sugar readings reviewed with patient.",
+    "No known drug allergies.", "Discussed side effects of the new medication.",
+    "Return in three months for follow-up.", "Labs ordered: CBC, CMP, HbA1c.",
+    "Patient declined flu vaccine.", "Referred to cardiology for further evaluation.",
+    "Weight stable.", "Encouraged regular exercise.", "Denies fever or chills.",
+]
+DOCUMENT_KINDS = [
+    ("lab_results", "Lab results"), ("referral", "Referral letter"), ("xray", "X-ray image"),
+    ("discharge_summary", "Discharge summary"), ("insurance_card", "Insurance card scan"),
+    ("prescription", "Prescription"), ("consent_form", "Signed consent form"), ("ecg", "ECG tracing"),
+]
+FILE_TYPES = ["pdf", "jpg", "png"]
+FILE_TYPE_WEIGHTS = [70, 20, 10]
+
+HISTORY_DAYS = 365 * 10
+
+
+def scale_counts(rows: int):
+    """Split a total row count into (patients, visits, documents)"""
+    patients = max(1, int(rows * MIX[0]))
+    documents = int(rows * MIX[2])
+    return patients, rows - patients - documents, documents
+
+
+@contextmanager
+def bulk_load(engine):
+    """Switch the table triggers (search index, change log) off for a bulk load"""
+    tables = [model.__tablename__ for model in (Patient, Visit, Document)]
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as conn:
+            for table in tables:
+                conn.execute(text(f"ALTER TABLE {table} DISABLE TRIGGER USER"))
+        try:
+            yield
+        finally:
+            with engine.begin() as conn:
+                for table in tables:
+                    conn.execute(text(f"ALTER TABLE {table} ENABLE TRIGGER USER"))
+    else:
+        # SQLite can't disable triggers: drop them and recreate them from their saved SQL
+        with engine.begin() as conn:
+            triggers = conn.execute(
+                text("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name IN :tables")
+                .bindparams(bindparam("tables", tables, expanding=True))
+            ).all()
+            for name, _ in triggers:
+                conn.execute(text(f'DROP TRIGGER "{name}"'))
+            # A partitioned visits view still needs its triggers to route rows - without the logging
+            for statement in partitions.sqlite_trigger_ddl(conn, logged=False):
+                conn.execute(text(statement))
+        try:
+            yield
+        finally:
+            with engine.begin() as conn:
+                for name, sql in triggers:
+                    conn.execute(text(f'DROP TRIGGER IF EXISTS "{name}"'))
+                    conn.execute(text(sql))
+
+
+class Generator:
+    """Deterministic row factory for one seed"""
+
+    def __init__(self, seed: int):
+        self.rng = random.Random(seed)
+        self.now = datetime.utcnow().replace(microsecond=0)
+
+    def _past(self, count: int):
+        """Random moments in the last ten years"""
+        rng = self.rng
+        span = HISTORY_DAYS * 24 * 3600
+        return [self.now - timedelta(seconds=int(span * rng.random())) for _ in range(count)]
+
+    def _patient_ids(self, first_id: int, patients: int, count: int):
+        # Skewed towards the lower ids: a minority of patients has most of the visits
+        rng = self.rng
+        return [first_id + int(patients * rng.random() ** 1.5) for _ in range(count)]
+
+    def patients(self, mrns):
+        rng = self.rng
+        count = len(mrns)
+        first_names = rng.choices(FIRST_NAMES, k=count)
+        last_names = rng.choices(LAST_NAMES, k=count)
+        genders = rng.choices(GENDERS, GENDER_WEIGHTS, k=count)
+        blood_types = rng.choices(BLOOD_TYPES, BLOOD_TYPE_WEIGHTS, k=count)
+        created = self._past(count)
+        today = self.now.date()
+        rows = []
+        for i in range(count):
+            first, last = first_names[i], last_names[i]
+            serial = mrns[i][-7:]
+            rows.append({
+                "medical_record_number": mrns[i],
+                "first_name": first,
+                "last_name": last,
+                "date_of_birth": today - timedelta(days=int(365.25 * 95 * rng.random() ** 1.3)),
+                "gender": genders[i],
+                "email": f"{first}.{last}{serial}@example.com".lower() if rng.random() < 0.8 else None,
+                "phone": f"555-{rng.randrange(1000):03d}-{rng.randrange(10000):04d}" if rng.random() < 0.9 else None,
+                "address": f"{rng.randrange(1, 9999)} {rng.choice(STREETS)} St, {rng.choice(CITIES)}",
+                "blood_type": blood_types[i],
+                "allergies": ", ".join(rng.sample(ALLERGIES, rng.randint(1, 2))) if rng.random() < 0.2 else None,
+                "created_at": created[i],
+                "updated_at": created[i],
+            })
+        return rows
+
+    def visits(self, count: int, first_id: int, patients: int):
+        rng = self.rng
+        patient_ids = self._patient_ids(first_id, patients, count)
+        reasons = rng.choices(REASONS, k=count)
+        diagnoses = rng.choices(DIAGNOSES, k=count)
+        treatments = rng.choices(TREATMENTS, k=count)
+        dates = self._past(count)
+        return [{
+            "patient_id": patient_ids[i],
+            "visit_date": dates[i],
+            "reason": reasons[i],
+            "diagnosis": diagnoses[i],
+            "treatment": treatments[i],
+            "notes": " ".join(rng.sample(NOTE_PHRASES, 3)),
+            "created_at": dates[i] + timedelta(minutes=rng.randrange(5, 240)),
+        } for i in range(count)]
+
+    def documents(self, count: int, first_id: int, patients: int):
+        rng = self.rng
+        patient_ids = self._patient_ids(first_id, patients, count)
+        kinds = rng.choices(DOCUMENT_KINDS, k=count)
+        file_types = rng.choices(FILE_TYPES, FILE_TYPE_WEIGHTS, k=count)
+        dates = self._past(count)
+        rows = []
+        for i in range(count):
+            (kind, description), file_type = kinds[i], file_types[i]
+            filename = f"{kind}_{dates[i]:%Y%m%d}_{i}.{file_type}"
+            rows.append({
+                "patient_id": patient_ids[i],
+                "filename": filename,
+                "file_type": file_type,
+                "file_url": f"/uploads/{patient_ids[i]}/{filename}",
+                "file_size": int(rng.lognormvariate(12, 1.2)),
+                "description": description,
+                "uploaded_at": dates[i],
+            })
+        return rows
+
+
+def generate(db, patients: int, visits: int, seed: int, documents: int = 0, batch_size: int = 10000,
+             progress=None):
+    """Insert synthetic patients, visits and documents, then rebuild the statistics"""
+    engine = db.get_bind()
+    generator = Generator(seed)
+    db.commit()
+    with bulk_load(engine):
+        first_id = (db.query(Patient.id).order_by(Patient.id.desc()).limit(1).scalar() or 0) + 1
+        for offset in range(0, patients, batch_size):
+            mrns = crud.generate_mrns(db, min(batch_size, patients - offset))
+            _insert_rows(db, Patient, generator.patients(mrns))
+            db.commit()
+            if progress:
+                progress("patients", offset + len(mrns))
+        for model, total, make in ((Visit, visits, generator.visits), (Document, documents, generator.documents)):
+            for offset in range(0, total, batch_size):
+                count = min(batch_size, total - offset)
+                _insert_rows(db, model, make(count, first_id, patients))
+                db.commit()
+                if progress:
+                    progress(model.__tablename__, offset + count)
+
+    # Index the new rows for search and bring the statistics up to date
+    search.init_search_index(engine)
+    stats.reconcile(db)
+    stats.rebuild_rollups(db)
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic patients, visits and documents")
+    parser.add_argument("--scale", choices=SCALES, default="100k", help="total rows, split 10/80/10")
+    parser.add_argument("--patients", type=int, help="override the scale's patient count")
+    parser.add_argument("--visits", type=int, help="override the scale's visit count")
+    parser.add_argument("--documents", type=int, help="override the scale's document count")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    patients, visits, documents = scale_counts(SCALES[args.scale])
+    patients = args.patients if args.patients is not None else patients
+    visits = args.visits if args.visits is not None else visits
+    documents = args.documents if args.documents is not None else documents
+
+    init_db()
+    db = SessionLocal()
+    started = time.perf_counter()
+
+    def progress(kind: str, done: int):
+        print(f"\r{kind}: {done} ({time.perf_counter() - started:.0f}s)", end="", flush=True)
+
+    try:
+        generate(db, patients, visits, args.seed, documents, args.batch_size, progress)
+    finally:
+        db.close()
+    rows = patients + visits + documents
+    seconds = time.perf_counter() - started
+    print(f"\nGenerated {rows} rows in {seconds:.1f}s ({rows / seconds:.0f} rows/s)")
@@ -0,0 +1,236 @@
+import argparse
+import asyncio
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import httpx
+
+from benchmarks.generate import FIRST_NAMES, LAST_NAMES, REASONS
+from benchmarks.results import report, summarize
+
+# HTTP load driver.
+# Runs a weighted mix of API requests from many concurrent clients for a
+# fixed time and reports requests/sec and p50/p95/p99 latency per endpoint,
+# plus the average number of SQL statements each route ran (read from the
+# server's /metrics). Either point it at a running server with --url, or let
+# it start uvicorn itself against DATABASE_URL - in sync mode, async mode
+# (DB_ASYNC) or both, one after the other, for a side-by-side comparison.
+#
+#   DATABASE_URL=sqlite:///./bench.db python -m benchmarks.load --mode both --output load.json
+#   python -m benchmarks.load --url http://localhost:8000 --scenario mixed --baseline load.json
+#
+# The client is a single asyncio process; give it its own core (or machine)
+# when the server can do more than a few thousand requests per second.
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SEARCH_TERMS = ["metformin", "hypertension", "\"blood sugar\"", "asthma OR bronchitis", "pain"]
+
+
+class Targets:
+    """Ids the request factories pick from"""
+
+    def __init__(self, patient_ids, rng: random.Random):
+        self.patient_ids = patient_ids
+        self.rng = rng
+
+    def patient_id(self):
+        return self.rng.choice(self.patient_ids)
+
+    def new_patient(self):
+        return {
+            "first_name": self.rng.choice(FIRST_NAMES), "last_name": self.rng.choice(LAST_NAMES),
+            "date_of_birth": f"19{self.rng.randint(40, 99)}-0{self.rng.randint(1, 9)}-1{self.rng.randint(0, 9)}",
+            "gender": self.rng.choice(["Female", "Male"]), "phone": "555-0100",
+        }
+
+
+def _create_visit(targets: Targets):
+    patient_id = targets.patient_id()
+    return "POST", f"/api/patients/{patient_id}/visits", {
+        "patient_id": patient_id, "visit_date": datetime.utcnow().isoformat(), "reason": targets.rng.choice(REASONS),
+    }
+
+
+# endpoint -> function(targets) returning (method, url, query params or json body)
+ENDPOINTS = {
+    "list_patients": lambda t: ("GET", "/api/patients?limit=50", None),
+    "list_patients_keyset": lambda t: ("GET", "/api/patients?cursor=&limit=50&order=name", None),
+    "get_patient": lambda t: ("GET", f"/api/patients/{t.patient_id()}", None),
+    "patient_visits": lambda t: ("GET", f"/api/patients/{t.patient_id()}/visits", None),
+    "patient_documents": lambda t: ("GET", f"/api/patients/{t.patient_id()}/documents", None),
+    "search_patients": lambda t: ("GET", f"/api/patients/search?q={t.rng.choice(LAST_NAMES)[:4]}", None),
+    "search_visits": lambda t: ("GET", "/api/visits/search", {"q": t.rng.choice(SEARCH_TERMS), "limit": 20}),
+    "stats": lambda t: ("GET", "/api/analytics/stats", None),
+    "trends": lambda t: ("GET", "/api/analytics/trends?granularity=month", None),
+    "create_patient": lambda t: ("POST", "/api/patients", t.new_patient()),
+    "update_patient": lambda t: ("PUT", f"/api/patients/{t.patient_id()}", {"phone": f"555-{t.rng.randrange(10000):04d}"}),
+    "create_visit": _create_visit,
+}
+
+# scenario -> {endpoint: weight}
+SCENARIOS = {
+    "read": {
+        "get_patient": 30, "patient_visits": 20, "patient_documents": 10, "list_patients": 10,
+        "list_patients_keyset": 5, "search_patients": 10, "search_visits": 5, "stats": 5, "trends": 5,
+    },
+    "mixed": {
+        "get_patient": 25, "patient_visits": 15, "patient_documents": 5, "list_patients": 5,
+        "search_patients": 10, "search_visits": 5, "stats": 5, "trends": 5,
+        "create_patient": 5, "update_patient": 10, "create_visit": 10,
+    },
+    "write": {"create_patient": 30, "update_patient": 35, "create_visit": 35},
+}
+
+
+def _request(targets: Targets, endpoint: str):
+    method, url, body = ENDPOINTS[endpoint](targets)
+    if body is None:
+        return method, url, {}
+    return method, url, {"params": body} if method == "GET" else {"json": body}
+
+
+async def _worker(client, targets, endpoints, weights, deadline, measure_from, timings, errors):
+    while time.perf_counter() < deadline:
+        endpoint = targets.rng.choices(endpoints, weights)[0]
+        method, url, kwargs = _request(targets, endpoint)
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            ok = response.status_code < 400
+        except httpx.HTTPError:
+            ok = False
+        finished = time.perf_counter()
+        if started < measure_from:
+            continue  # warm-up
+        if ok:
+            timings[endpoint].append((finished - started) * 1000)
+        else:
+            errors[endpoint] += 1
+
+
+def _db_queries(metrics_text: str):
+    """Sum and count of per-request query counts by route, from /metrics"""
+    totals = {}
+    pattern = re.compile(r'^http_request_db_queries_(sum|count)\{method="(\w+)",route="([^"]*)"\} (\S+)$', re.M)
+    for kind, method, route, value in pattern.findall(metrics_text):
+        totals.setdefault(f"{method} {route}", {})[kind] = float(value)
+    return totals
+
+
+async def run_load(url: str, scenario: str, concurrency: int, seconds: float, warmup: float, seed: int):
+    """Drive the server at url; returns per-endpoint results and per-route query counts"""
+    weights_by_endpoint = SCENARIOS[scenario]
+    endpoints, weights = list(weights_by_endpoint), list(weights_by_endpoint.values())
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+        patients = (await client.get("/api/patients", params={"limit": 1000})).json()
+        if not patients:
+            raise SystemExit("No patients - run python -m benchmarks.generate first")
+        patient_ids = [patient["id"] for patient in patients]
+        before = _db_queries((await client.get("/metrics")).text)
+
+        timings = {endpoint: [] for endpoint in endpoints}
+        errors = {endpoint: 0 for endpoint in endpoints}
+        measure_from = time.perf_counter() + warmup
+        deadline = measure_from + seconds
+        await asyncio.gather(*(
+            _worker(client, Targets(patient_ids, random.Random(seed + i)), endpoints, weights,
+                    deadline, measure_from, timings, errors)
+            for i in range(concurrency)
+        ))
+        after = _db_queries((await client.get("/metrics")).text)
+
+    results = {}
+    for endpoint in endpoints:
+        summary = summarize(timings[endpoint])
+        summary["rps"] = round(len(timings[endpoint]) / seconds, 1)
+        summary["errors"] = errors[endpoint]
+        results[endpoint] = summary
+    everything = [timing for endpoint in endpoints for timing in timings[endpoint]]
+    results["all"] = {**summarize(everything), "rps": round(len(everything) / seconds, 1),
+                      "errors": sum(errors.values())}
+
+    queries = {}
+    for route, totals in after.items():
+        count = totals.get("count", 0) - before.get(route, {}).get("count", 0)
+        if count > 0 and not route.endswith("/metrics"):
+            queries[route] = round((totals.get("sum", 0) - before.get(route, {}).get("sum", 0)) / count, 2)
+    return results, queries
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode: str, port: int):
+    """Start uvicorn on the configured DATABASE_URL in sync or async mode"""
+    env = dict(os.environ, DB_ASYNC="true" if mode == "async" else "false", JOB_WORKERS="0", CACHE_BACKEND="none")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Server exited with code {process.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/api/health", timeout=1).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("Server did not start within 60s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP load test: RPS and latency percentiles per endpoint")
+    parser.add_argument("--url", help="server to test (default: start one on DATABASE_URL)")
+    parser.add_argument("--mode", choices=["sync", "async", "both"], default="sync", help="server mode to start")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="read")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent clients")
+    parser.add_argument("--seconds", type=float, default=20.0, help="measured run time per mode")
+    parser.add_argument("--warmup", type=float, default=3.0, help="unmeasured seconds before that")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="compare against a saved run and exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change that counts as a regression")
+    args = parser.parse_args()
+
+    load_args = (args.scenario, args.concurrency, args.seconds, args.warmup, args.seed)
+    results, queries = {}, {}
+    if args.url:
+        results, queries["server"] = asyncio.run(run_load(args.url, *load_args))
+    else:
+        for mode in (["sync", "async"] if args.mode == "both" else [args.mode]):
+            port = free_port()
+            server = start_server(mode, port)
+            try:
+                mode_results, queries[mode] = asyncio.run(run_load(f"http://127.0.0.1:{port}", *load_args))
+            finally:
+                server.terminate()
+                server.wait()
+            # Results keyed "mode/endpoint", so a sync run and an async run compare separately
+            results.update({f"{mode}/{endpoint}": summary for endpoint, summary in mode_results.items()})
+            print(f"{mode}: {mode_results['all']['rps']} req/s, p99 {mode_results['all'].get('p99_ms')} ms",
+                  file=sys.stderr)
+
+    sys.exit(report(
+        {
+            "benchmark": "load",
+            "scenario": args.scenario,
+            "concurrency": args.concurrency,
+            "seconds": args.seconds,
+            "results": results,
+            "db_queries_per_request": queries,
+        },
+        args.output, args.baseline, args.threshold,
+    ))
@@ -0,0 +1,175 @@
+import os
+
+os.environ.setdefault("JOB_WORKERS", "0")
+
+import argparse
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+from sqlalchemy import func
+
+import batch
+import crud
+import metrics
+import schemas
+import search
+import stats
+from database import SessionLocal, init_db
+from models import Patient
+from benchmarks.generate import FIRST_NAMES, LAST_NAMES, REASONS, generate, scale_counts, SCALES
+from benchmarks.results import report, summarize
+
+# CRUD and analytics micro-benchmarks.
+# Calls each function in crud.py, search.py, stats.py and batch.py directly
+# (no HTTP) against the configured database and reports latency percentiles,
+# calls per second and the number of SQL statements each call runs. Write
+# cases really write, so point DATABASE_URL at a scratch database - fill it
+# with benchmarks.generate first, or pass --scale to do it here.
+#
+#   DATABASE_URL=sqlite:///./bench.db python -m benchmarks.micro --output micro.json
+#   DATABASE_URL=sqlite:///./bench.db python -m benchmarks.micro --baseline micro.json
+
+
+class Context:
+    """What the cases need to know about the data"""
+
+    def __init__(self, db, seed: int):
+        self.rng = random.Random(seed)
+        self.first_id, self.last_id = db.query(func.min(Patient.id), func.max(Patient.id)).one()
+        self.patients = db.query(func.count(Patient.id)).scalar()
+        if not self.patients:
+            raise SystemExit("No patients - run python -m benchmarks.generate first, or pass --scale")
+        self.mrns = [mrn for (mrn,) in db.query(Patient.medical_record_number).order_by(func.random()).limit(500)]
+        self.created = []  # patients made by create_patient, consumed by delete_patient
+
+    def patient_id(self):
+        return self.rng.randint(self.first_id, self.last_id)
+
+    def new_patient(self):
+        return schemas.PatientCreate(
+            first_name=self.rng.choice(FIRST_NAMES), last_name=self.rng.choice(LAST_NAMES),
+            date_of_birth=date(1950, 1, 1) + timedelta(days=self.rng.randrange(365 * 60)),
+            gender=self.rng.choice(["Female", "Male"]), phone="555-0100",
+        )
+
+    def new_visit(self):
+        return schemas.VisitCreate(
+            patient_id=self.patient_id(), visit_date=datetime.utcnow(), reason=self.rng.choice(REASONS),
+            diagnosis="essential hypertension", notes="Benchmark visit.",
+        )
+
+
+def _create_patient(db, ctx):
+    ctx.created.append(crud.create_patient(db, ctx.new_patient()).id)
+
+
+def _delete_patient(db, ctx):
+    crud.delete_patient(db, ctx.created.pop() if ctx.created else crud.create_patient(db, ctx.new_patient()).id)
+
+
+def _keyset_page(db, ctx):
+    # Continue from a random patient, the way a deep page would
+    cursor = crud.encode_cursor("id", db.get(Patient, ctx.patient_id()))
+    crud.get_patients_keyset(db, cursor=cursor, limit=100)
+
+
+def _batch(db, ctx):
+    operations = [schemas.BatchOperation(op="create_patient", ref="p", data=ctx.new_patient().model_dump(mode="json"))]
+    operations += [
+        schemas.BatchOperation(op="create_visit", patient_id=ctx.patient_id(),
+                               data=ctx.new_visit().model_dump(mode="json", exclude={"patient_id"}))
+        for _ in range(49)
+    ]
+    batch.apply_batch(db, operations)
+
+
+# name -> function(db, ctx). Reads roll back afterwards; writes commit as the API would.
+CASES = {
+    "get_patient": lambda db, ctx: crud.get_patient(db, ctx.patient_id()),
+    "get_patient_detail": lambda db, ctx: crud.get_patient_detail(db, ctx.patient_id(), visits_limit=20, documents_limit=20),
+    "get_patient_by_mrn": lambda db, ctx: crud.get_patient_by_mrn(db, ctx.rng.choice(ctx.mrns)),
+    "get_patients(first page)": lambda db, ctx: crud.get_patients(db, limit=100),
+    "get_patients(deep offset)": lambda db, ctx: crud.get_patients(db, skip=max(ctx.patients - 100, 0), limit=100),
+    "get_patients_keyset(deep page)": _keyset_page,
+    "get_patient_visits": lambda db, ctx: crud.get_patient_visits(db, ctx.patient_id()),
+    "get_patient_documents": lambda db, ctx: crud.get_patient_documents(db, ctx.patient_id()),
+    "search_patients(name)": lambda db, ctx: search.search_patients(db, ctx.rng.choice(LAST_NAMES)[:4]),
+    "search_patients(mrn)": lambda db, ctx: search.search_patients(db, ctx.rng.choice(ctx.mrns)),
+    "search_visits": lambda db, ctx: search.search_visits(db, ctx.rng.choice(["metformin", "hypertension", "\"blood sugar\""]), limit=20),
+    "search_visits(patient)": lambda db, ctx: search.search_visits(db, "pain", patient_id=ctx.patient_id(), limit=20),
+    "stats.get_stats": lambda db, ctx: stats.get_stats(db),
+    "stats.get_trends(month)": lambda db, ctx: stats.get_trends(db, granularity="month"),
+    "stats.get_trends(day, age_band)": lambda db, ctx: stats.get_trends(
+        db, granularity="day", start=date.today() - timedelta(days=90), group_by="age_band"),
+    "create_patient": _create_patient,
+    "update_patient": lambda db, ctx: crud.update_patient(db, ctx.patient_id(), schemas.PatientUpdate(phone="555-0199")),
+    "create_visit": lambda db, ctx: crud.create_visit(db, ctx.new_visit()),
+    "create_document": lambda db, ctx: crud.create_document(db, schemas.DocumentCreate(
+        patient_id=ctx.patient_id(), filename="bench.pdf", file_type="pdf", file_url="/uploads/bench.pdf")),
+    "delete_patient": _delete_patient,
+    "apply_batch(50 ops)": _batch,
+}
+
+
+def run_case(db, ctx, case, iterations: int, max_seconds: float):
+    """Time one case; returns its summary"""
+    timings = []
+    queries = 0
+    started = time.perf_counter()
+    for _ in range(iterations):
+        # Count this call's SQL statements through the request instrumentation
+        calls = metrics.RequestStats()
+        token = metrics.current.set(calls)
+        try:
+            call_started = time.perf_counter()
+            case(db, ctx)
+            timings.append((time.perf_counter() - call_started) * 1000)
+        finally:
+            metrics.current.reset(token)
+        queries += calls.queries
+        db.rollback()
+        db.expunge_all()  # don't let the identity map answer the next lookup
+        if time.perf_counter() - started > max_seconds:
+            break
+    summary = summarize(timings)
+    summary["ops_per_sec"] = round(len(timings) / (sum(timings) / 1000), 1)
+    summary["queries_per_call"] = round(queries / len(timings), 2)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark CRUD functions and analytics queries")
+    parser.add_argument("--scale", choices=SCALES, help="generate this much data first")
+    parser.add_argument("--iterations", type=int, default=200, help="calls per case")
+    parser.add_argument("--max-seconds", type=float, default=10.0, help="stop a case early after this long")
+    parser.add_argument("--case", action="append", help="only run cases starting with this (repeatable)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="compare against a saved run and exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change that counts as a regression")
+    args = parser.parse_args()
+
+    init_db()
+    db = SessionLocal()
+    try:
+        if args.scale:
+            patients, visits, documents = scale_counts(SCALES[args.scale])
+            generate(db, patients, visits, args.seed, documents)
+        ctx = Context(db, args.seed)
+        results = {}
+        for name, case in CASES.items():
+            if args.case and not any(name.startswith(prefix) for prefix in args.case):
+                continue
+            run_case(db, ctx, case, 3, args.max_seconds)  # warm up
+            results[name] = run_case(db, ctx, case, args.iterations, args.max_seconds)
+            print(f"{name}: p50 {results[name]['p50_ms']} ms", file=sys.stderr)
+        counts = {"patients": ctx.patients, "visits": stats.get_stats(db)["total_visits"]}
+        dialect = db.get_bind().dialect.name
+    finally:
+        db.close()
+
+    sys.exit(report(
+        {"benchmark": "micro", "dialect": dialect, "rows": counts, "results": results},
+        args.output, args.baseline, args.threshold,
+    ))
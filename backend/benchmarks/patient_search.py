@@ -0,0 +1,80 @@
+import argparse
+import random
+import sys
+import time
+from sqlalchemy import func
+
+import search
+from database import SessionLocal, init_db
+from models import Patient
+from benchmarks.generate import LAST_NAMES, generate
+from benchmarks.results import report, summarize
+
+# Patient search benchmark.
+# Fills the configured database (DATABASE_URL - use a scratch database) with
+# synthetic patients, then times name prefixes of each length (the 1-2
+# character ones used to fall back to a LIKE scan on SQLite), MRN lookups
+# and misspelled names that only the fuzzy stage finds, and prints latency
+# percentiles as JSON (see benchmarks.results for --output / --baseline).
+#
+#   DATABASE_URL=sqlite:///./bench.db python -m benchmarks.patient_search --patients 200000
+
+
+def _misspell(name: str, rng):
+    """The name with two adjacent letters swapped"""
+    i = rng.randrange(1, len(name) - 1)
+    return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+
+
+def run(db, rounds: int, seed: int):
+    """Time each query shape; returns per-shape latency stats in milliseconds"""
+    rng = random.Random(seed)
+    mrns = [mrn for mrn, in db.query(Patient.medical_record_number).order_by(func.random()).limit(100)]
+    shapes = {
+        "prefix1": lambda: rng.choice(LAST_NAMES)[:1],
+        "prefix2": lambda: rng.choice(LAST_NAMES)[:2],
+        "prefix4": lambda: rng.choice(LAST_NAMES)[:4],
+        "full_name": lambda: rng.choice(LAST_NAMES),
+        "mrn": lambda: rng.choice(mrns),
+        "fuzzy": lambda: _misspell(rng.choice([name for name in LAST_NAMES if len(name) > 4]), rng),
+    }
+    results = {}
+    for shape, query in shapes.items():
+        timings = []
+        for _ in range(rounds * 10):
+            q = query()
+            started = time.perf_counter()
+            search.search_patients(db, q, limit=20)
+            timings.append((time.perf_counter() - started) * 1000)
+            db.rollback()
+        results[shape] = summarize(timings)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark patient search on synthetic data")
+    parser.add_argument("--patients", type=int, default=100000, help="patients to generate (0 to reuse existing data)")
+    parser.add_argument("--rounds", type=int, default=5, help="tens of queries per shape")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="compare against a saved run and exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change that counts as a regression")
+    args = parser.parse_args()
+
+    init_db()
+    db = SessionLocal()
+    try:
+        if args.patients:
+            started = time.perf_counter()
+            generate(db, args.patients, 0, args.seed)
+            print(f"Generated {args.patients} patients in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        results = {
+            "benchmark": "patient_search",
+            "dialect": db.get_bind().dialect.name,
+            "patients": db.query(Patient).count(),
+            "results": run(db, args.rounds, args.seed),
+        }
+    finally:
+        db.close()
+
+    sys.exit(report(results, args.output, args.baseline, args.threshold))
@@ -0,0 +1,129 @@
+import argparse
+import json
+import platform
+import statistics
+import sys
+from datetime import datetime
+
+# Benchmark results and regression checks.
+# Every benchmark reports {"benchmark": name, ..., "results": {case: metrics}}
+# and can write it as JSON (--output) to keep as a baseline. Comparing a run
+# against a baseline flags each case whose latency went up, or whose
+# throughput went down, by more than the threshold.
+#
+#   python -m benchmarks.results baseline.json current.json --threshold 10
+
+# Metrics where bigger is worse, and where bigger is better
+LATENCY_METRICS = ("p50_ms", "p95_ms", "p99_ms", "mean_ms")
+THROUGHPUT_METRICS = ("ops_per_sec", "rps")
+# Latency changes smaller than this are noise, whatever the percentage
+MIN_DELTA_MS = 0.05
+
+
+def percentile(samples, pct: float):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1)]
+
+
+def summarize(timings_ms):
+    """Latency percentiles for a list of timings in milliseconds"""
+    if not timings_ms:
+        return {"calls": 0}
+    return {
+        "calls": len(timings_ms),
+        "p50_ms": round(percentile(timings_ms, 50), 3),
+        "p95_ms": round(percentile(timings_ms, 95), 3),
+        "p99_ms": round(percentile(timings_ms, 99), 3),
+        "max_ms": round(max(timings_ms), 3),
+        "mean_ms": round(statistics.mean(timings_ms), 3),
+    }
+
+
+def environment():
+    """Where the benchmark ran, so results from different machines aren't mixed up"""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "run_at": datetime.utcnow().isoformat(timespec="seconds"),
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float = 10.0):
+    """
+    Compare two reports of the same benchmark. Returns a list of changes, one
+    per case and metric, each flagged as a regression if it got worse by more
+    than threshold percent.
+    """
+    changes = []
+    for case, metrics in current.get("results", {}).items():
+        before = baseline.get("results", {}).get(case)
+        if not isinstance(before, dict):
+            continue
+        for metric, value in metrics.items():
+            old = before.get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or not old:
+                continue
+            if metric in LATENCY_METRICS:
+                worse = value > old * (1 + threshold / 100) and value - old >= MIN_DELTA_MS
+            elif metric in THROUGHPUT_METRICS:
+                worse = value < old * (1 - threshold / 100)
+            else:
+                continue
+            changes.append({
+                "case": case,
+                "metric": metric,
+                "baseline": old,
+                "current": value,
+                "change_pct": round((value - old) / old * 100, 1),
+                "regression": worse,
+            })
+    return changes
+
+
+def report(results: dict, output: str = None, baseline: str = None, threshold: float = 10.0):
+    """
+    Print a benchmark report, optionally save it and compare it with a
+    baseline. Returns the process exit code: 1 if anything regressed.
+    """
+    results.setdefault("environment", environment())
+    print(json.dumps(results, indent=2, default=str))
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+    if not baseline:
+        return 0
+    with open(baseline) as f:
+        changes = compare(json.load(f), results, threshold)
+    return print_comparison(changes, threshold)
+
+
+def print_comparison(changes, threshold: float):
+    """Print the changes beyond the threshold; returns 1 if anything regressed"""
+    regressions = [change for change in changes if change["regression"]]
+    for change in changes:
+        if abs(change["change_pct"]) <= threshold:
+            continue
+        better = (change["change_pct"] < 0) == (change["metric"] in LATENCY_METRICS)
+        flag = "REGRESSION" if change["regression"] else "improved" if better else ""
+        print(
+            f"{change['case']:<45} {change['metric']:<12} {change['baseline']:>12} -> {change['current']:<12} "
+            f"{change['change_pct']:>+7.1f}% {flag}",
+            file=sys.stderr,
+        )
+    print(f"{len(regressions)} regression(s) beyond {threshold:g}%", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare a benchmark run against a baseline")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change that counts as a regression")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    sys.exit(print_comparison(compare(baseline, current, args.threshold), args.threshold))
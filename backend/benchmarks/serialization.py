@@ -0,0 +1,94 @@
+import os
+
+# Measure the endpoints themselves, not the response cache
+os.environ.setdefault("CACHE_BACKEND", "none")
+os.environ.setdefault("JOB_WORKERS", "0")
+
+import argparse
+import json
+import time
+from typing import List
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+
+import app as api
+import crud
+import schemas
+from database import SessionLocal, get_db, init_db
+from models import Patient, Visit
+from benchmarks.generate import generate
+
+# List endpoint serialization benchmark.
+# Compares requests/sec on one core for the list endpoints before and after
+# the fast serialization path: "before" is a copy of the original endpoints
+# (ORM entities validated through the response_model), "after" is the real
+# app. Both run in-process through the ASGI test client, so the numbers
+# include routing and the database query, not network overhead.
+#
+#   DATABASE_URL=sqlite:///./bench.db python -m benchmarks.serialization
+
+before = FastAPI()
+
+
+@before.get("/api/patients", response_model=List[schemas.Patient])
+def list_patients(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+    return db.query(Patient).order_by(Patient.id).offset(skip).limit(limit).all()
+
+
+@before.get("/api/patients/{patient_id}/visits", response_model=List[schemas.Visit])
+def get_patient_visits(patient_id: int, db: Session = Depends(get_db)):
+    crud.patient_exists(db, patient_id)
+    return db.query(Visit).filter(Visit.patient_id == patient_id).all()
+
+
+def measure(client: TestClient, url: str, seconds: float):
+    """Requests per second for one URL, run for about the given time"""
+    client.get(url)  # warm up
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        response = client.get(url)
+        assert response.status_code == 200, response.text
+        count += 1
+    return count / (time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark list endpoint serialization")
+    parser.add_argument("--patients", type=int, default=2000, help="patients to generate (0 to reuse existing data)")
+    parser.add_argument("--visits", type=int, default=100000)
+    parser.add_argument("--seconds", type=float, default=5.0, help="run time per endpoint and variant")
+    args = parser.parse_args()
+
+    init_db()
+    if args.patients:
+        db = SessionLocal()
+        try:
+            generate(db, args.patients, args.visits, seed=42)
+        finally:
+            db.close()
+
+    db = SessionLocal()
+    try:
+        # Any patient will do; with the default sizes each has about 50 visits
+        patient_id = crud.get_patients(db, limit=1)[0].id
+        visit_count = len(crud.get_patient_visits(db, patient_id))
+    finally:
+        db.close()
+
+    urls = {
+        "list_patients (100 rows)": "/api/patients?limit=100",
+        f"get_patient_visits ({visit_count} rows)": f"/api/patients/{patient_id}/visits",
+    }
+    results = {}
+    with TestClient(before) as before_client, TestClient(api.app) as after_client:
+        for name, url in urls.items():
+            old = measure(before_client, url, args.seconds)
+            new = measure(after_client, url, args.seconds)
+            results[name] = {
+                "before_rps": round(old, 1),
+                "after_rps": round(new, 1),
+                "speedup": round(new / old, 2),
+            }
+    print(json.dumps({"benchmark": "serialization", "results": results}, indent=2))
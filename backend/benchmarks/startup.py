@@ -0,0 +1,91 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmarks.load import BACKEND_DIR, free_port
+from benchmarks.results import report, summarize
+
+# Cold start benchmark.
+# The service runs on containers that are started on demand, so start-up
+# time is latency a user sees. "import" is how long importing app takes in
+# a fresh interpreter; "first_request" is the time from launching uvicorn to
+# the first successful response from an endpoint that reads the database.
+# Each boot is measured twice over: "full" with DB_FAST_BOOT off - every
+# schema check, as on the first start after a deploy - and "fast" with it
+# on. The run fails if the fast boot's median time to first request is over
+# the budget.
+#
+#   DATABASE_URL=sqlite:///./bench.db python -m benchmarks.startup --runs 5 --output startup.json
+#   python -m benchmarks.startup --budget-ms 1500 --baseline startup.json
+
+# Median time to first request a fast boot must stay under
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "3000"))
+FIRST_REQUEST_PATH = "/api/patients?limit=1"
+BOOT_MODES = {"full": "false", "fast": "true"}  # mode -> DB_FAST_BOOT
+
+
+def time_import():
+    """Milliseconds to import app in a new interpreter"""
+    code = "import time; started = time.perf_counter(); import app; print(time.perf_counter() - started)"
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=BACKEND_DIR, env=dict(os.environ, JOB_WORKERS="0"),
+        capture_output=True, text=True, check=True,
+    )
+    return float(result.stdout.split()[-1]) * 1000
+
+
+def time_first_request(fast_boot: str, timeout: float = 120.0):
+    """Milliseconds from starting uvicorn to its first successful database read"""
+    port = free_port()
+    url = f"http://127.0.0.1:{port}{FIRST_REQUEST_PATH}"
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=dict(os.environ, DB_FAST_BOOT=fast_boot), stdout=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client(timeout=5) as client:
+            while time.perf_counter() - started < timeout:
+                if process.poll() is not None:
+                    raise SystemExit(f"Server exited with code {process.returncode}")
+                try:
+                    if client.get(url).status_code == 200:
+                        return (time.perf_counter() - started) * 1000
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.005)
+        raise SystemExit(f"No response within {timeout:g}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold start: import time and time to first request")
+    parser.add_argument("--runs", type=int, default=5, help="boots per mode")
+    parser.add_argument("--budget-ms", type=float, default=STARTUP_BUDGET_MS,
+                        help="fail if the fast boot's median time to first request is over this")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="compare against a saved run and exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change that counts as a regression")
+    args = parser.parse_args()
+
+    results = {"import": summarize([time_import() for _ in range(args.runs)])}
+    # Full boots first, so the database has a fingerprint for the fast ones
+    for mode, fast_boot in BOOT_MODES.items():
+        results[f"{mode}/first_request"] = summarize([time_first_request(fast_boot) for _ in range(args.runs)])
+        print(f"{mode}: first request after {results[f'{mode}/first_request']['p50_ms']} ms (p50)", file=sys.stderr)
+
+    over_budget = results["fast/first_request"]["p50_ms"] > args.budget_ms
+    if over_budget:
+        print(f"Cold start is over the {args.budget_ms:g} ms budget", file=sys.stderr)
+    code = report(
+        {"benchmark": "startup", "runs": args.runs, "budget_ms": args.budget_ms, "over_budget": over_budget,
+         "results": results},
+        args.output, args.baseline, args.threshold,
+    )
+    sys.exit(1 if over_budget else code)
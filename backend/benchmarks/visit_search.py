@@ -0,0 +1,76 @@
+import argparse
+import random
+import sys
+import time
+from datetime import date
+from sqlalchemy import func
+
+import search
+from database import SessionLocal, init_db
+from models import Patient, Visit
+from benchmarks.generate import generate
+from benchmarks.results import report, summarize
+
+# Visit full-text search benchmark.
+# Fills the configured database (DATABASE_URL - use a scratch database) with
+# synthetic visits, then times a mix of search queries and prints latency
+# percentiles as JSON (see benchmarks.results for --output / --baseline).
+#
+#   DATABASE_URL=sqlite:///./bench.db python -m benchmarks.visit_search --visits 1000000
+
+QUERIES = [
+    "metformin", "hypertension", "\"blood sugar\"", "asthma OR bronchitis", "pain -back",
+    "\"follow-up\" cardiology", "atrial fibrillation apixaban", "omeprazole", "anxiety sertraline",
+]
+
+
+def run(db, rounds: int, seed: int):
+    """Time each query shape; returns per-shape latency stats in milliseconds"""
+    rng = random.Random(seed)
+    first_id, last_id = db.query(func.min(Patient.id), func.max(Patient.id)).one()
+    shapes = {
+        "text": lambda q: {},
+        "text+date_range": lambda q: {"start": date(2020, 1, 1), "end": date(2020, 12, 31)},
+        "text+patient": lambda q: {"patient_id": rng.randint(first_id, last_id)},
+    }
+    results = {}
+    for shape, filters in shapes.items():
+        timings = []
+        for _ in range(rounds):
+            for q in QUERIES:
+                started = time.perf_counter()
+                search.search_visits(db, q, limit=20, **filters(q))
+                timings.append((time.perf_counter() - started) * 1000)
+                db.rollback()
+        results[shape] = summarize(timings)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark visit full-text search on synthetic data")
+    parser.add_argument("--visits", type=int, default=100000, help="visits to generate (0 to reuse existing data)")
+    parser.add_argument("--patients", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=5, help="times to run each query")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="compare against a saved run and exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change that counts as a regression")
+    args = parser.parse_args()
+
+    init_db()
+    db = SessionLocal()
+    try:
+        if args.visits:
+            started = time.perf_counter()
+            generate(db, args.patients, args.visits, args.seed)
+            print(f"Generated {args.visits} visits in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        results = {
+            "benchmark": "visit_search",
+            "dialect": db.get_bind().dialect.name,
+            "visits": db.query(Visit).count(),
+            "results": run(db, args.rounds, args.seed),
+        }
+    finally:
+        db.close()
+
+    sys.exit(report(results, args.output, args.baseline, args.threshold))
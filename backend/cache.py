@@ -0,0 +1,344 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from fastapi import Request, Response
+from starlette.concurrency import run_in_threadpool
+
+# Read-through cache for serialized patient responses.
+# Entries are grouped per patient (one key per patient, one field per
+# response shape), so a write only has to drop a single key to invalidate
+# every cached view of that patient. Values are the JSON bytes that get sent
+# to the client, so a hit skips both the database and Pydantic.
+#
+# CACHE_BACKEND selects the backend:
+#   memory - in-process LRU with TTL and a size bound (default)
+#   redis  - a Redis server at REDIS_URL, shared between workers
+#   fake   - an in-process stand-in for Redis, for local runs and tests
+#   none   - caching disabled
+#
+# A write drops the patient's key in the process that made it. With an
+# in-process backend every other uvicorn worker (and the standalone job
+# worker) has a cache of its own, so each process also follows the change
+# log - which records every write to patients, visits and documents - and
+# drops the keys of the patients changed elsewhere within
+# CACHE_INVALIDATION_POLL_SECONDS, instead of serving them until the TTL.
+#
+# The async endpoints use the *_async functions: with Redis they go through
+# redis.asyncio rather than blocking the event loop on a round trip.
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").lower()
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", "300"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# How often an in-process cache checks the change log for other processes' writes (0 disables it)
+CACHE_INVALIDATION_POLL_SECONDS = float(os.getenv("CACHE_INVALIDATION_POLL_SECONDS", "1"))
+CACHE_INVALIDATION_BATCH = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class CacheStats:
+    """Hit/miss counters shared by all backends"""
+
+    local = False  # private to this process, so other processes' writes must be picked up from the change log
+
+    def __init__(self):
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.invalidations = 0
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    async def get_async(self, key: str, field: str):
+        """get for the event loop - backends that do I/O override it"""
+        return self.get(key, field)
+
+    async def set_async(self, key: str, field: str, value: bytes):
+        self.set(key, field, value)
+
+    async def delete_async(self, key: str):
+        self.delete(key)
+
+    def stats(self):
+        """Counters and hit rate since the process started"""
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.__class__.__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "sets": self.sets,
+            "invalidations": self.invalidations,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+        }
+
+
+class NullCache(CacheStats):
+    """Caching disabled - every lookup misses"""
+
+    def get(self, key: str, field: str):
+        self._count("misses")
+        return None
+
+    def set(self, key: str, field: str, value: bytes):
+        pass
+
+    def delete(self, key: str):
+        pass
+
+
+class LRUCache(CacheStats):
+    """In-process LRU cache with a TTL per key and a bound on the number of keys"""
+
+    local = True
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: int = CACHE_TTL_SECONDS):
+        super().__init__()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, {field: value})
+
+    def get(self, key: str, field: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic() and field in entry[1]:
+                self._entries.move_to_end(key)
+                value = entry[1][field]
+            else:
+                value = None
+        self._count("hits" if value is not None else "misses")
+        return value
+
+    def set(self, key: str, field: str, value: bytes):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                entry = (time.monotonic() + self.ttl, {})
+                self._entries[key] = entry
+            entry[1][field] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        self._count("sets")
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+        self._count("invalidations")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        stats = super().stats()
+        stats["entries"] = len(self._entries)
+        return stats
+
+
+class RedisCache(CacheStats):
+    """Cache stored in Redis hashes (one hash per key) with a TTL per hash"""
+
+    def __init__(self, client, ttl: int = CACHE_TTL_SECONDS, async_client=None, local: bool = False):
+        super().__init__()
+        self.client = client
+        self.async_client = async_client  # redis.asyncio client for the async endpoints
+        self.ttl = ttl
+        self.local = local
+
+    def get(self, key: str, field: str):
+        value = self.client.hget(key, field)
+        self._count("hits" if value is not None else "misses")
+        return value
+
+    def set(self, key: str, field: str, value: bytes):
+        self.client.hset(key, field, value)
+        self.client.expire(key, self.ttl)
+        self._count("sets")
+
+    def delete(self, key: str):
+        self.client.delete(key)
+        self._count("invalidations")
+
+    def clear(self):
+        self.client.flushdb()
+
+    async def get_async(self, key: str, field: str):
+        if self.async_client is None:
+            return await run_in_threadpool(self.get, key, field)
+        value = await self.async_client.hget(key, field)
+        self._count("hits" if value is not None else "misses")
+        return value
+
+    async def set_async(self, key: str, field: str, value: bytes):
+        if self.async_client is None:
+            return await run_in_threadpool(self.set, key, field, value)
+        await self.async_client.hset(key, field, value)
+        await self.async_client.expire(key, self.ttl)
+        self._count("sets")
+
+    async def delete_async(self, key: str):
+        if self.async_client is None:
+            return await run_in_threadpool(self.delete, key)
+        await self.async_client.delete(key)
+        self._count("invalidations")
+
+
+class FakeRedis:
+    """Minimal in-process stand-in for the redis client calls RedisCache makes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hashes = {}  # key -> (expires_at or None, {field: value})
+
+    def _live(self, key: str):
+        entry = self._hashes.get(key)
+        if entry and entry[0] is not None and entry[0] <= time.monotonic():
+            del self._hashes[key]
+            return None
+        return entry
+
+    def hget(self, key: str, field: str):
+        with self._lock:
+            entry = self._live(key)
+            return entry[1].get(field) if entry else None
+
+    def hset(self, key: str, field: str, value: bytes):
+        with self._lock:
+            entry = self._live(key) or self._hashes.setdefault(key, (None, {}))
+            entry[1][field] = value
+
+    def expire(self, key: str, seconds: int):
+        with self._lock:
+            entry = self._live(key)
+            if entry:
+                self._hashes[key] = (time.monotonic() + seconds, entry[1])
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(1 for key in keys if self._hashes.pop(key, None) is not None)
+
+    def flushdb(self):
+        with self._lock:
+            self._hashes.clear()
+
+
+def create_cache(backend: str = CACHE_BACKEND):
+    """Build the cache backend selected by configuration"""
+    if backend == "none":
+        return NullCache()
+    if backend == "redis":
+        import redis  # optional dependency, only needed for this backend
+        import redis.asyncio
+        return RedisCache(redis.Redis.from_url(REDIS_URL), async_client=redis.asyncio.Redis.from_url(REDIS_URL))
+    if backend == "fake":
+        return RedisCache(FakeRedis(), local=True)
+    return LRUCache()
+
+
+cache = create_cache()
+
+
+# ============= PATIENT RESPONSES =============
+
+def patient_key(patient_id: int):
+    """Cache key holding every cached response for a patient"""
+    return f"patient:{patient_id}"
+
+
+def get_patient_response(patient_id: int, field: str):
+    """Cached JSON body for one of a patient's responses, or None"""
+    return cache.get(patient_key(patient_id), field)
+
+
+def set_patient_response(patient_id: int, field: str, body: bytes):
+    """Store the JSON body for one of a patient's responses"""
+    cache.set(patient_key(patient_id), field, body)
+
+
+async def get_patient_response_async(patient_id: int, field: str):
+    """get_patient_response for the async endpoints"""
+    return await cache.get_async(patient_key(patient_id), field)
+
+
+async def set_patient_response_async(patient_id: int, field: str, body: bytes):
+    """set_patient_response for the async endpoints"""
+    await cache.set_async(patient_key(patient_id), field, body)
+
+
+def invalidate_patient(patient_id: int):
+    """Drop every cached response for a patient. Call after the write commits."""
+    cache.delete(patient_key(patient_id))
+
+
+async def invalidate_patient_async(patient_id: int):
+    """invalidate_patient for the async endpoints"""
+    await cache.delete_async(patient_key(patient_id))
+
+
+# ============= CROSS-PROCESS INVALIDATION =============
+
+def invalidate_changed(db, cursor: str, batch: int = CACHE_INVALIDATION_BATCH):
+    """
+    Drop the cached responses of every patient changed after a change log
+    cursor. Returns the cursor to continue from.
+    """
+    import changes
+
+    while True:
+        entries, cursor = changes.get_changes(db, cursor, limit=batch)
+        for patient_id in {entry.patient_id for entry in entries if entry.patient_id is not None}:
+            invalidate_patient(patient_id)
+        if len(entries) < batch:
+            return cursor
+
+
+def start_invalidation_thread(session_factory, interval: float = CACHE_INVALIDATION_POLL_SECONDS):
+    """Follow the change log in a daemon thread when the cache is private to this process"""
+    if interval <= 0 or not cache.local:
+        return None
+    import changes
+
+    def loop():
+        cursor = None
+        while True:
+            db = session_factory()
+            try:
+                if cursor is None:
+                    cursor = changes.end_cursor(db)
+                else:
+                    cursor = invalidate_changed(db, cursor)
+            except changes.CursorExpired:
+                # Fell behind the pruned log - anything may have changed
+                cache.clear()
+                cursor = None
+            except Exception:
+                db.rollback()
+                logger.exception("Cache invalidation failed")
+            finally:
+                db.close()
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name="cache-invalidation", daemon=True)
+    thread.start()
+    return thread
+
+
+def etag_for(body: bytes):
+    """Strong ETag for a response body"""
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def json_response(request: Request, body: bytes):
+    """Send cached JSON with an ETag, or 304 if the client already has it"""
+    etag = etag_for(body)
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
@@ -0,0 +1,342 @@
+import base64
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import func, text, tuple_
+from sqlalchemy.orm import Session
+from models import Patient, Visit, Document, ChangeLog, ChangeConsumer, ChangeFeedPosition
+
+# Change-data feed.
+# Every insert, update and delete on patients, visits and documents appends
+# a row to change_log. Triggers write it, so it commits or rolls back with
+# the change itself and covers every write path - the CRUD functions, bulk
+# import, batch writes and background jobs alike.
+#
+# Consumers page through the log with an opaque cursor. On PostgreSQL,
+# sequence ids are handed out at insert time but transactions commit in any
+# order, so reading "id > cursor" could skip a row that commits late. Each
+# row therefore records its transaction id, the feed is ordered by
+# (txid, id), and only rows from transactions older than every transaction
+# still running (the snapshot's xmin) are served - nothing can appear before
+# them any more. SQLite has a single writer that commits in id order, so
+# txid is always 0 there.
+#
+# Old entries are compacted (only the latest change per row is kept) and
+# eventually pruned; a cursor pointing into the pruned range gets a
+# CursorExpired and the consumer has to resync from an export.
+
+# Entities with their table and the column holding the patient id
+CHANGE_ENTITIES = {
+    "patient": (Patient, "id"),
+    "visit": (Visit, "patient_id"),
+    "document": (Document, "patient_id"),
+}
+
+CHANGES_COMPACT_AFTER_HOURS = int(os.getenv("CHANGES_COMPACT_AFTER_HOURS", "24"))
+CHANGES_RETENTION_DAYS = int(os.getenv("CHANGES_RETENTION_DAYS", "7"))
+# How often compaction and pruning run (0 disables it)
+CHANGES_MAINTENANCE_SECONDS = int(os.getenv("CHANGES_MAINTENANCE_SECONDS", "3600"))
+# Seconds between polls of the log by the SSE stream, and between keepalive comments
+CHANGES_POLL_SECONDS = float(os.getenv("CHANGES_POLL_SECONDS", "1"))
+CHANGES_KEEPALIVE_SECONDS = 15
+
+logger = logging.getLogger(__name__)
+
+
+class CursorExpired(ValueError):
+    """The cursor points at changes that have been pruned"""
+
+
+# ============= TRIGGERS =============
+
+POSTGRES_CHANGE_FUNCTION = """
+CREATE OR REPLACE FUNCTION record_change() RETURNS trigger AS $$
+DECLARE
+    row_data jsonb;
+    changed jsonb;
+BEGIN
+    -- Partition maintenance moving rows between partitions isn't a change
+    IF current_setting('healthplus.moving_rows', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'DELETE' THEN
+        row_data := to_jsonb(OLD);
+    ELSE
+        row_data := to_jsonb(NEW);
+    END IF;
+    IF TG_OP = 'UPDATE' THEN
+        SELECT coalesce(jsonb_agg(n.key ORDER BY n.key), '[]'::jsonb) INTO changed
+        FROM jsonb_each(row_data) n
+        WHERE n.value IS DISTINCT FROM to_jsonb(OLD) -> n.key AND n.key <> 'updated_at';
+    END IF;
+    INSERT INTO change_log (txid, entity, entity_id, patient_id, op, fields, changed_at)
+    VALUES (
+        txid_current(), TG_ARGV[0], (row_data ->> 'id')::int, (row_data ->> TG_ARGV[1])::int,
+        CASE TG_OP WHEN 'INSERT' THEN 'create' WHEN 'UPDATE' THEN 'update' ELSE 'delete' END,
+        changed, now() AT TIME ZONE 'utc'
+    );
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+"""
+
+# Same layout as the timestamps SQLAlchemy writes (microsecond precision)
+SQLITE_NOW = "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+
+
+def _postgres_ddl():
+    statements = [POSTGRES_CHANGE_FUNCTION]
+    for entity, (model, patient_column) in CHANGE_ENTITIES.items():
+        table = model.__tablename__
+        statements += [
+            f"DROP TRIGGER IF EXISTS change_log_{table} ON {table}",
+            f"CREATE TRIGGER change_log_{table} AFTER INSERT OR UPDATE OR DELETE ON {table} "
+            f"FOR EACH ROW EXECUTE FUNCTION record_change('{entity}', '{patient_column}')",
+        ]
+    return statements
+
+
+def sqlite_change_insert(entity: str, op: str, entity_id: str = None):
+    """
+    The INSERT INTO change_log a SQLite trigger on entity's table runs for op
+    (insert, update or delete). entity_id defaults to the row's id column.
+    """
+    model, patient_column = CHANGE_ENTITIES[entity]
+    row = "old" if op == "delete" else "new"
+    entity_id = entity_id or f"{row}.id"
+    insert = "INSERT INTO change_log (txid, entity, entity_id, patient_id, op, fields, changed_at) "
+    if op == "update":
+        # SQLite triggers can't loop over columns, so list them: one row per changed column
+        changed = " UNION ALL ".join(
+            f"SELECT '{column.name}' AS name WHERE old.{column.name} IS NOT new.{column.name}"
+            for column in model.__table__.columns if column.name != "updated_at"
+        )
+        return (f"{insert}VALUES (0, '{entity}', {entity_id}, new.{patient_column}, 'update', "
+                f"(SELECT json_group_array(name) FROM ({changed})), {SQLITE_NOW})")
+    label = "create" if op == "insert" else "delete"
+    return f"{insert}VALUES (0, '{entity}', {entity_id}, {row}.{patient_column}, '{label}', NULL, {SQLITE_NOW})"
+
+
+def _sqlite_ddl(views=()):
+    statements = []
+    for entity, (model, _) in CHANGE_ENTITIES.items():
+        table = model.__tablename__
+        statements += [f"DROP TRIGGER IF EXISTS change_log_{table}_{op}" for op in ("insert", "update", "delete")]
+        if table in views:
+            # A partitioned table (partitions.py) logs its changes from its own view triggers
+            continue
+        statements += [
+            f"CREATE TRIGGER change_log_{table}_{op} AFTER {op.upper()} ON {table} "
+            f"BEGIN {sqlite_change_insert(entity, op)}; END"
+            for op in ("insert", "update", "delete")
+        ]
+    return statements
+
+
+def change_log_ddl(dialect: str, views=()):
+    """Statements that (re)create the change log triggers; views are tables replaced by a view"""
+    if dialect == "postgresql":
+        return _postgres_ddl()
+    if dialect == "sqlite":
+        return _sqlite_ddl(views)
+    return []
+
+
+def init_change_log(engine):
+    """(Re)create the change log triggers, so they track the current columns"""
+    if engine.dialect.name not in ("postgresql", "sqlite"):
+        return
+    with engine.begin() as conn:
+        views = ()
+        if engine.dialect.name == "sqlite":
+            views = {row[0] for row in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'view'"))}
+        for statement in change_log_ddl(engine.dialect.name, views):
+            conn.execute(text(statement))
+
+
+# ============= FEED =============
+
+def encode_cursor(txid: int, change_id: int):
+    """Opaque cursor pointing just after the given change"""
+    return base64.urlsafe_b64encode(json.dumps([txid, change_id]).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """Decode a cursor into (txid, change_id). Raises ValueError if malformed."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        txid, change_id = json.loads(base64.urlsafe_b64decode(padded))
+        return int(txid), int(change_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+def _pruned_position(db: Session):
+    """(txid, change_id) of the newest pruned change, (0, 0) if nothing has been pruned"""
+    position = db.get(ChangeFeedPosition, 1)
+    return (position.pruned_txid, position.pruned_change_id) if position else (0, 0)
+
+
+def get_changes(db: Session, cursor: str = "", limit: int = 100):
+    """
+    Get the changes after a cursor, oldest first. An empty cursor starts at
+    the oldest retained change. Returns (changes, next_cursor); next_cursor
+    is the cursor to pass next time, even when there were no new changes.
+    Raises CursorExpired if changes after the cursor have been pruned.
+    """
+    pruned = _pruned_position(db)
+    position = decode_cursor(cursor) if cursor else pruned
+    if position < pruned:
+        raise CursorExpired("Cursor has expired; resync from an export and start from a new cursor")
+
+    query = db.query(ChangeLog).filter(tuple_(ChangeLog.txid, ChangeLog.id) > tuple_(*position))
+    if db.get_bind().dialect.name == "postgresql":
+        # Only transactions that can no longer be overtaken by a later commit
+        query = query.filter(ChangeLog.txid < text("txid_snapshot_xmin(txid_current_snapshot())"))
+    changes = query.order_by(ChangeLog.txid, ChangeLog.id).limit(limit).all()
+    if changes:
+        return changes, encode_cursor(changes[-1].txid, changes[-1].id)
+    return changes, encode_cursor(*position)
+
+
+def change_cursor(change: ChangeLog):
+    """Cursor pointing just after one change"""
+    return encode_cursor(change.txid, change.id)
+
+
+def end_cursor(db: Session):
+    """Cursor just after the newest change get_changes can serve now, for following only new changes"""
+    query = db.query(ChangeLog.txid, ChangeLog.id)
+    if db.get_bind().dialect.name == "postgresql":
+        query = query.filter(ChangeLog.txid < text("txid_snapshot_xmin(txid_current_snapshot())"))
+    last = query.order_by(ChangeLog.txid.desc(), ChangeLog.id.desc()).first()
+    return encode_cursor(*(last or _pruned_position(db)))
+
+
+# ============= CONSUMERS =============
+
+def get_consumer(db: Session, name: str):
+    """A named consumer's saved position, or None"""
+    return db.get(ChangeConsumer, name)
+
+
+def save_consumer(db: Session, name: str, cursor: str):
+    """Record how far a consumer has read. Raises ValueError for a bad cursor."""
+    txid, change_id = decode_cursor(cursor)
+    consumer = db.get(ChangeConsumer, name) or ChangeConsumer(name=name)
+    consumer.cursor = cursor
+    consumer.txid = txid
+    consumer.change_id = change_id
+    consumer.updated_at = datetime.utcnow()
+    db.add(consumer)
+    db.commit()
+    return consumer
+
+
+def consumer_lag(db: Session, consumer: ChangeConsumer):
+    """How many changes a consumer has yet to read, and how old the oldest is"""
+    behind = db.query(ChangeLog).filter(
+        tuple_(ChangeLog.txid, ChangeLog.id) > tuple_(consumer.txid, consumer.change_id)
+    )
+    oldest = behind.order_by(ChangeLog.txid, ChangeLog.id).with_entities(ChangeLog.changed_at).first()
+    return {
+        "name": consumer.name,
+        "cursor": consumer.cursor,
+        "updated_at": consumer.updated_at,
+        "lag_changes": behind.count(),
+        "lag_seconds": round((datetime.utcnow() - oldest[0]).total_seconds(), 1) if oldest else 0,
+    }
+
+
+def get_feed_stats(db: Session):
+    """Log size and the lag of every registered consumer"""
+    size, oldest, newest = db.query(
+        func.count(ChangeLog.id), func.min(ChangeLog.changed_at), func.max(ChangeLog.changed_at)
+    ).one()
+    return {
+        "changes": size,
+        "oldest_change_at": oldest,
+        "newest_change_at": newest,
+        "consumers": [consumer_lag(db, consumer) for consumer in db.query(ChangeConsumer).order_by(ChangeConsumer.name)],
+    }
+
+
+# ============= MAINTENANCE =============
+
+def compact(db: Session, older_than_hours: int = CHANGES_COMPACT_AFTER_HOURS):
+    """Keep only the latest change per row among changes older than the cutoff"""
+    cutoff = datetime.utcnow() - timedelta(hours=older_than_hours)
+    # Writes to the same row are serialized by its lock, so the highest id is the latest change
+    latest = (
+        db.query(func.max(ChangeLog.id))
+        .filter(ChangeLog.changed_at < cutoff)
+        .group_by(ChangeLog.entity, ChangeLog.entity_id)
+    )
+    removed = (
+        db.query(ChangeLog)
+        .filter(ChangeLog.changed_at < cutoff, ChangeLog.id.not_in(latest))
+        .delete(synchronize_session=False)
+    )
+    db.commit()
+    return removed
+
+
+def prune(db: Session, retention_days: int = CHANGES_RETENTION_DAYS):
+    """Delete changes older than the retention period; their cursors expire"""
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    last = (
+        db.query(ChangeLog.txid, ChangeLog.id)
+        .filter(ChangeLog.changed_at < cutoff)
+        .order_by(ChangeLog.txid.desc(), ChangeLog.id.desc())
+        .first()
+    )
+    if last is None:
+        return 0
+    # Remove everything up to the newest expired change, so the log stays a
+    # contiguous range in feed order
+    removed = (
+        db.query(ChangeLog)
+        .filter(tuple_(ChangeLog.txid, ChangeLog.id) <= tuple_(*last))
+        .delete(synchronize_session=False)
+    )
+    db.merge(ChangeFeedPosition(id=1, pruned_txid=last[0], pruned_change_id=last[1], pruned_at=datetime.utcnow()))
+    db.commit()
+    return removed
+
+
+def start_maintenance_thread(session_factory, interval: int = CHANGES_MAINTENANCE_SECONDS):
+    """Run compaction and pruning every interval seconds in a daemon thread"""
+    if interval <= 0:
+        return None
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            db = session_factory()
+            try:
+                compact(db)
+                prune(db)
+            except Exception:
+                db.rollback()
+                logger.exception("Change log maintenance failed")
+            finally:
+                db.close()
+
+    thread = threading.Thread(target=loop, name="change-log-maintenance", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    from database import SessionLocal, init_db
+
+    init_db()
+    db = SessionLocal()
+    try:
+        print(f"Compacted {compact(db)} changes, pruned {prune(db)}")
+        print(get_feed_stats(db))
+    finally:
+        db.close()
@@ -0,0 +1,444 @@
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import date
+from typing import Optional
+import numpy as np
+from sqlalchemy import Date, Integer, cast, func, literal, select, type_coerce
+from sqlalchemy.orm import Session
+from models import ChangeLog, Patient, Visit
+import stats
+import partitions
+
+# Cohort analytics.
+# Questions about groups of patients - visit frequency by age band and
+# gender, time between visits, month-by-month retention, blood type and
+# allergy prevalence - are answered from an in-memory columnar extract: the
+# few patient and visit columns they need, read in chunks of
+# COHORT_CHUNK_ROWS into NumPy arrays (dates as days since 1970, strings as
+# integer codes); visits in archived partitions come straight from their
+# Parquet files. The metrics are then sorts, bincounts and masks over whole
+# arrays, with no Python loop over rows.
+#
+# The extract and the computed results are cached per process, keyed by a
+# data version: the newest change_log id plus the patient and visit
+# counters. Any write to patients or visits changes it, so the next request
+# reloads; until then repeated questions are answered from memory.
+
+COHORT_CHUNK_ROWS = int(os.getenv("COHORT_CHUNK_ROWS", "50000"))
+COHORT_CACHE_ENTRIES = int(os.getenv("COHORT_CACHE_ENTRIES", "256"))
+
+COHORT_GROUPS = ("gender", "age_band")
+AGE_BAND_NAMES = [band for _, band in stats.AGE_BANDS] + ["65+"]
+# Upper bounds (inclusive) of the time-between-visits histogram buckets, in days
+INTERVAL_BUCKETS = (7, 30, 90, 180, 365)
+# Allergy entries that mean "none"
+NO_ALLERGIES = {"", "none", "nka", "nkda", "no known allergies", "no known drug allergies", "n/a", "na"}
+
+
+def _epoch_days(column, dialect: str):
+    """SQL expression for a date or datetime column as whole days since 1970-01-01"""
+    if dialect == "postgresql":
+        return type_coerce(cast(column, Date) - cast(literal("1970-01-01"), Date), Integer)
+    return cast(func.julianday(func.date(column)) - 2440587.5, Integer)
+
+
+def _epoch_day(day: date):
+    return (day - date(1970, 1, 1)).days
+
+
+def _month_name(month: int):
+    """Months since 1970-01 as "YYYY-MM" """
+    return f"{1970 + month // 12:04d}-{month % 12 + 1:02d}"
+
+
+def allergy_names(value: str):
+    """Normalized allergy names in a patient's allergies field (comma list or JSON array)"""
+    text = value.strip()
+    items = None
+    if text.startswith("["):
+        try:
+            items = json.loads(text)
+        except ValueError:
+            text = text.strip("[]")
+    if not isinstance(items, list):
+        items = re.split(r"[,;]", text)
+    names = {str(item).strip().strip("\"'").strip().lower() for item in items}
+    return sorted(names - NO_ALLERGIES)
+
+
+def _encode(chunks):
+    """Integer codes and the distinct values for a list of object-array chunks"""
+    values = np.concatenate(chunks) if chunks else np.array([], dtype=object)
+    names, codes = np.unique(values, return_inverse=True)
+    return codes.astype(np.int32), names.tolist()
+
+
+class Extract:
+    """Columnar copy of the patient and visit columns the cohort metrics use"""
+
+    def __init__(self, version: str, patient_ids, birth_days, genders, blood_types, allergies,
+                 visit_patient_ids, visit_days):
+        self.version = version
+        self.patient_ids = patient_ids  # sorted
+        self.birth_days = birth_days
+        self.gender_codes, self.gender_names = genders
+        self.blood_codes, self.blood_names = blood_types
+        self.allergy_codes, allergy_values = allergies
+        # Parse each distinct allergies value once: (value code, allergy code) pairs
+        self.allergy_names = []
+        lookup = {}
+        value_codes, name_codes = [], []
+        for value_code, value in enumerate(allergy_values):
+            for name in allergy_names(value):
+                if name not in lookup:
+                    lookup[name] = len(self.allergy_names)
+                    self.allergy_names.append(name)
+                value_codes.append(value_code)
+                name_codes.append(lookup[name])
+        self.allergy_pairs = (np.array(value_codes, dtype=np.int64), np.array(name_codes, dtype=np.int64))
+        self.allergy_value_count = len(allergy_values)
+
+        # Visits point at patients by array index; drop any whose patient
+        # was deleted between the two reads
+        index = np.searchsorted(patient_ids, visit_patient_ids)
+        found = index < len(patient_ids)
+        found[found] = patient_ids[index[found]] == visit_patient_ids[found]
+        self.visit_patients = index[found].astype(np.int32)
+        self.visit_days = visit_days[found]
+
+    @property
+    def patients(self):
+        return len(self.patient_ids)
+
+    @property
+    def visits(self):
+        return len(self.visit_days)
+
+    def age_band_codes(self, on: date):
+        """Index into AGE_BAND_NAMES of each patient's age band on a given day"""
+        birth = self.birth_days.astype("datetime64[D]")
+        years = birth.astype("datetime64[Y]").astype(np.int64) + 1970
+        month_start = birth.astype("datetime64[M]")
+        months = month_start.astype(np.int64) % 12 + 1
+        days = (birth - month_start.astype("datetime64[D]")).astype(np.int64) + 1
+        ages = on.year - years - ((on.month * 100 + on.day) < (months * 100 + days))
+        return np.searchsorted([upper for upper, _ in stats.AGE_BANDS], ages, side="right")
+
+    def group_codes(self, group_by: str, on: date):
+        """Per-patient group codes and group names for gender or age_band"""
+        if group_by == "gender":
+            return self.gender_codes, [name or "Unknown" for name in self.gender_names]
+        return self.age_band_codes(on), AGE_BAND_NAMES
+
+    def visit_mask(self, start: Optional[date], end: Optional[date]):
+        """Boolean mask of visits between start and end (inclusive)"""
+        mask = np.ones(self.visits, dtype=bool)
+        if start is not None:
+            mask &= self.visit_days >= _epoch_day(start)
+        if end is not None:
+            mask &= self.visit_days <= _epoch_day(end)
+        return mask
+
+
+def data_version(db: Session):
+    """Changes whenever patients or visits change"""
+    change_id = db.execute(select(func.max(ChangeLog.id))).scalar() or 0
+    counters = stats.get_counters(db, ("patients", "visits"))
+    return f"{change_id}.{counters.get('patients', 0)}.{counters.get('visits', 0)}"
+
+
+def _read_columns(db: Session, query, dtypes, chunk_rows: int):
+    """Run query and collect each column into a list of NumPy chunks"""
+    chunks = [[] for _ in dtypes]
+    result = db.execute(query.execution_options(yield_per=chunk_rows))
+    for rows in result.partitions():
+        for chunk, values, dtype in zip(chunks, zip(*rows), dtypes):
+            chunk.append(np.array(values, dtype=dtype))
+    return chunks
+
+
+def _concat(chunks, dtype):
+    return np.concatenate(chunks) if chunks else np.array([], dtype=dtype)
+
+
+def load_extract(db: Session, version: str = "", chunk_rows: int = COHORT_CHUNK_ROWS):
+    """Read the patient and visit columns into an Extract"""
+    dialect = db.get_bind().dialect.name
+    ids, birth_days, genders, blood_types, allergies = _read_columns(
+        db,
+        select(
+            Patient.id,
+            _epoch_days(Patient.date_of_birth, dialect),
+            func.coalesce(Patient.gender, ""),
+            func.coalesce(Patient.blood_type, ""),
+            func.coalesce(Patient.allergies, ""),
+        ).order_by(Patient.id),
+        (np.int64, np.int32, object, object, object),
+        chunk_rows,
+    )
+    visit_patients, visit_days = _read_columns(
+        db,
+        select(Visit.patient_id, _epoch_days(Visit.visit_date, dialect)),
+        (np.int64, np.int32),
+        chunk_rows,
+    )
+    archived_patients, archived_days = partitions.archived_visit_days(partitions.archive_paths(db))
+    visit_patients += archived_patients
+    visit_days += archived_days
+    return Extract(
+        version,
+        _concat(ids, np.int64), _concat(birth_days, np.int32),
+        _encode(genders), _encode(blood_types), _encode(allergies),
+        _concat(visit_patients, np.int64), _concat(visit_days, np.int32),
+    )
+
+
+# ============= METRICS =============
+
+def group_quantiles(values, groups, group_count: int, quantiles):
+    """
+    Quantiles of values within each group, as a (group_count, len(quantiles))
+    array - the lower nearest rank, so every quantile is an actual value. NaN
+    for empty groups.
+    """
+    order = np.lexsort((values, groups))
+    ordered = values[order]
+    sizes = np.bincount(groups, minlength=group_count)
+    starts = np.cumsum(sizes) - sizes
+    result = np.full((group_count, len(quantiles)), np.nan)
+    filled = sizes > 0
+    for i, q in enumerate(quantiles):
+        positions = starts + np.floor(q * (sizes - 1)).astype(np.int64)
+        result[filled, i] = ordered[positions[filled]]
+    return result
+
+
+def _number(value, digits: int = 3):
+    """NumPy scalar as a JSON-friendly float (None for NaN)"""
+    value = float(value)
+    return None if np.isnan(value) else round(value, digits)
+
+
+def visit_frequency(extract: Extract, start: date = None, end: date = None, today: date = None):
+    """Visits per patient by age band and gender, over visits between start and end"""
+    on = end or today or date.today()
+    counts = np.bincount(extract.visit_patients[extract.visit_mask(start, end)], minlength=extract.patients)
+    gender_names = [name or "Unknown" for name in extract.gender_names]
+    groups = extract.age_band_codes(on) * len(gender_names) + extract.gender_codes
+    group_count = len(AGE_BAND_NAMES) * len(gender_names)
+
+    patients = np.bincount(groups, minlength=group_count)
+    visits = np.bincount(groups, weights=counts, minlength=group_count)
+    active = np.bincount(groups, weights=counts > 0, minlength=group_count)
+    quantiles = group_quantiles(counts, groups, group_count, (0.5, 0.9))
+    return [
+        {
+            "age_band": AGE_BAND_NAMES[group // len(gender_names)],
+            "gender": gender_names[group % len(gender_names)],
+            "patients": int(patients[group]),
+            "visits": int(visits[group]),
+            "visits_per_patient": _number(visits[group] / patients[group]),
+            "median_visits": _number(quantiles[group, 0]),
+            "p90_visits": _number(quantiles[group, 1]),
+            "active_share": _number(active[group] / patients[group], 4),
+        }
+        for group in np.flatnonzero(patients)
+    ]
+
+
+def _interval_summary(gaps, groups, group_count: int):
+    """Count, mean, quantiles and histogram of gaps per group"""
+    counts = np.bincount(groups, minlength=group_count)
+    totals = np.bincount(groups, weights=gaps, minlength=group_count)
+    quantiles = group_quantiles(gaps, groups, group_count, (0.25, 0.5, 0.75, 0.9))
+    buckets = np.searchsorted(INTERVAL_BUCKETS, gaps, side="left")
+    bucket_count = len(INTERVAL_BUCKETS) + 1
+    histogram = np.bincount(groups * bucket_count + buckets, minlength=group_count * bucket_count)
+    labels = [f"{low}-{high}" for low, high in zip((0,) + tuple(b + 1 for b in INTERVAL_BUCKETS), INTERVAL_BUCKETS)]
+    labels.append(f"{INTERVAL_BUCKETS[-1] + 1}+")
+    return [
+        {
+            "intervals": int(counts[group]),
+            "mean_days": _number(totals[group] / counts[group]) if counts[group] else None,
+            "p25_days": _number(quantiles[group, 0]),
+            "median_days": _number(quantiles[group, 1]),
+            "p75_days": _number(quantiles[group, 2]),
+            "p90_days": _number(quantiles[group, 3]),
+            "histogram": [
+                {"days": label, "intervals": int(histogram[group * bucket_count + bucket])}
+                for bucket, label in enumerate(labels)
+            ],
+        }
+        for group in range(group_count)
+    ]
+
+
+def visit_intervals(extract: Extract, start: date = None, end: date = None, group_by: str = None,
+                    today: date = None):
+    """Days between a patient's consecutive visits, overall and optionally per group"""
+    if group_by is not None and group_by not in COHORT_GROUPS:
+        raise ValueError(f"group_by must be one of {', '.join(COHORT_GROUPS)}")
+    mask = extract.visit_mask(start, end)
+    patients, days = extract.visit_patients[mask], extract.visit_days[mask]
+    order = np.lexsort((days, patients))
+    patients, days = patients[order], days[order]
+    same_patient = patients[1:] == patients[:-1]
+    gaps = np.diff(days)[same_patient]
+    result = _interval_summary(gaps, np.zeros(len(gaps), dtype=np.int64), 1)[0]
+    if group_by is not None:
+        codes, names = extract.group_codes(group_by, end or today or date.today())
+        summaries = _interval_summary(gaps, codes[patients[1:][same_patient]].astype(np.int64), len(names))
+        result["groups"] = [
+            {group_by: name, **summary} for name, summary in zip(names, summaries) if summary["intervals"]
+        ]
+    return result
+
+
+def retention(extract: Extract, months: int = 12, start: date = None, end: date = None, today: date = None):
+    """
+    Monthly retention of patient cohorts. A patient joins the cohort of the
+    month of their first visit (registration dates say when a record was
+    created, which for imported patients isn't when they became patients);
+    retention[k] is the share of the cohort with a visit k months later.
+    Only cohorts whose first month is between start and end are returned;
+    start can't be after the current month.
+    """
+    today = today or date.today()
+    current = (today.year - 1970) * 12 + today.month - 1
+    if start is not None and (start.year - 1970) * 12 + start.month - 1 > current:
+        raise ValueError("start can't be after the current month")
+    visit_months = extract.visit_days.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+    order = np.lexsort((visit_months, extract.visit_patients))
+    patients, visit_months = extract.visit_patients[order], visit_months[order]
+    if not len(patients):
+        return []
+
+    first_visit = np.r_[True, patients[1:] != patients[:-1]]
+    first_month = np.zeros(extract.patients, dtype=np.int64)
+    first_month[patients[first_visit]] = visit_months[first_visit]
+    # One entry per patient and month with a visit
+    distinct = first_visit | np.r_[True, visit_months[1:] != visit_months[:-1]]
+    cohorts = first_month[patients[distinct]]
+    offsets = visit_months[distinct] - cohorts
+
+    lowest = (start.year - 1970) * 12 + start.month - 1 if start else cohorts.min()
+    # Visits dated in the future don't start cohorts that haven't happened yet
+    highest = min((end.year - 1970) * 12 + end.month - 1 if end else cohorts.max(), current)
+    keep = (offsets <= months) & (cohorts >= lowest) & (cohorts <= highest)
+    if not keep.any():
+        return []
+    base = cohorts[keep].min()
+    width = months + 1
+    matrix = np.bincount(
+        (cohorts[keep] - base) * width + offsets[keep], minlength=(highest - base + 1) * width
+    ).reshape(-1, width)
+
+    result = []
+    for row in np.flatnonzero(matrix[:, 0]):
+        cohort = base + row
+        observed = min(months, current - cohort) + 1  # later months haven't happened yet
+        result.append({
+            "cohort": _month_name(cohort),
+            "patients": int(matrix[row, 0]),
+            "retention": [_number(value, 4) for value in matrix[row, :observed] / matrix[row, 0]],
+        })
+    return result
+
+
+def _share(count: int, total: int):
+    return round(count / total, 4) if total else 0
+
+
+def _prevalence(extract: Extract, mask, top: int):
+    patients = int(mask.sum())
+    blood = np.bincount(extract.blood_codes[mask], minlength=len(extract.blood_names))
+    by_value = np.bincount(extract.allergy_codes[mask], minlength=extract.allergy_value_count)
+    value_codes, name_codes = extract.allergy_pairs
+    allergies = np.bincount(name_codes, weights=by_value[value_codes], minlength=len(extract.allergy_names))
+    with_allergies = int(by_value[np.unique(value_codes)].sum()) if len(value_codes) else 0
+    return {
+        "patients": patients,
+        "blood_types": [
+            {"blood_type": extract.blood_names[code] or "Unknown", "patients": int(blood[code]),
+             "share": _share(int(blood[code]), patients)}
+            for code in np.argsort(-blood, kind="stable") if blood[code]
+        ],
+        "patients_with_allergies": with_allergies,
+        "allergy_share": _share(with_allergies, patients),
+        "allergies": [
+            {"allergy": extract.allergy_names[code], "patients": int(allergies[code]),
+             "share": _share(int(allergies[code]), patients)}
+            for code in np.argsort(-allergies, kind="stable")[:top] if allergies[code]
+        ],
+    }
+
+
+def prevalence(extract: Extract, group_by: str = None, top: int = 20, today: date = None):
+    """Blood type and allergy prevalence, overall and optionally per group"""
+    if group_by is not None and group_by not in COHORT_GROUPS:
+        raise ValueError(f"group_by must be one of {', '.join(COHORT_GROUPS)}")
+    result = _prevalence(extract, np.ones(extract.patients, dtype=bool), top)
+    if group_by is not None:
+        codes, names = extract.group_codes(group_by, today or date.today())
+        result["groups"] = [
+            {group_by: name, **_prevalence(extract, codes == code, top)}
+            for code, name in enumerate(names) if (codes == code).any()
+        ]
+    return result
+
+
+COHORT_METRICS = {
+    "visit-frequency": visit_frequency,
+    "visit-intervals": visit_intervals,
+    "retention": retention,
+    "prevalence": prevalence,
+}
+
+
+# ============= CACHE =============
+
+_lock = threading.Lock()
+_extract = None
+_results = OrderedDict()  # (metric, params) -> (data version, result)
+
+
+def get_extract(db: Session, version: str = None):
+    """The cached extract, reloaded if the data has changed since it was read"""
+    global _extract
+    version = version or data_version(db)
+    with _lock:
+        if _extract is None or _extract.version != version:
+            _extract = None  # let the old arrays go before reading new ones
+            _extract = load_extract(db, version)
+        return _extract
+
+
+def get_cohort(db: Session, metric: str, **params):
+    """Compute a cohort metric, or return it from the cache if the data hasn't changed"""
+    version = data_version(db)
+    # Ages and open date ranges are relative to today, so results don't carry over to tomorrow
+    today = date.today()
+    key = (metric, today, tuple(sorted(params.items())))
+    with _lock:
+        cached = _results.get(key)
+        if cached is not None and cached[0] == version:
+            _results.move_to_end(key)
+            return cached[1]
+
+    extract = get_extract(db, version)
+    result = {
+        "metric": metric,
+        "data_version": version,
+        "patients": extract.patients,
+        "visits": extract.visits,
+        "results": COHORT_METRICS[metric](extract, today=today, **params),
+    }
+    with _lock:
+        _results[key] = (version, result)
+        _results.move_to_end(key)
+        while len(_results) > COHORT_CACHE_ENTRIES:
+            _results.popitem(last=False)
+    return result
@@ -1,28 +1,48 @@
+from sqlalchemy import exists, tuple_
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 from models import Patient, Visit, Document, User
 from schemas import PatientCreate, PatientUpdate, VisitCreate, DocumentCreate, UserCreate
 from datetime import datetime
-import random
-import string
+from typing import Optional
+import base64
+import json
+import cache
+import mrn
+import partitions
+import stats
 
+# Sort orders supported by keyset (cursor) pagination.
+# Each entry lists the columns that make up the sort key; "id" is always
+# last so the key is unique and pages never overlap or skip rows.
+PATIENT_SORT_KEYS = {
+    "id": (Patient.id,),
+    "name": (Patient.last_name, Patient.first_name, Patient.id),
+}
 
-def generate_mrn():
+
+def generate_mrn(db: Session):
     """Generate a unique Medical Record Number"""
-    # Format: MRN-YYYYMMDD-XXXX
-    date_part = datetime.now().strftime("%Y%m%d")
-    random_part = ''.join(random.choices(string.digits, k=4))
-    return f"MRN-{date_part}-{random_part}"
+    # Format: MRN-YYYYMMDD-NNNNNNC (serial number + check digit)
+    return mrn.get_allocator(db.get_bind()).next_mrns(1)[0]
+
+
+def generate_mrns(db: Session, count: int):
+    """Generate count unique Medical Record Numbers at once"""
+    return mrn.get_allocator(db.get_bind()).next_mrns(count)
 
 
 # ============= PATIENT CRUD =============
 
-def create_patient(db: Session, patient: PatientCreate):
-    """Create a new patient"""
+def create_patient(db: Session, patient: PatientCreate, medical_record_number: Optional[str] = None):
+    """Create a new patient, allocating an MRN unless one is given"""
     db_patient = Patient(
         **patient.model_dump(),
-        medical_record_number=generate_mrn()
+        medical_record_number=medical_record_number or generate_mrn(db),
+        created_at=datetime.utcnow()
     )
     db.add(db_patient)
+    stats.record_patient_created(db, db_patient.created_at)
     db.commit()
     db.refresh(db_patient)
     return db_patient
@@ -33,73 +53,214 @@ def get_patient(db: Session, patient_id: int):
     return db.query(Patient).filter(Patient.id == patient_id).first()
 
 
+def merge_visits(visits, archived, limit: Optional[int] = None):
+    """Live and archived visits together, newest first, at most limit of them"""
+    return sorted(visits + archived, key=lambda visit: (visit.visit_date, visit.id), reverse=True)[:limit]
+
+
+def get_patient_detail(
+    db: Session,
+    patient_id: int,
+    visits_limit: Optional[int] = None,
+    documents_limit: Optional[int] = None,
+    include_archived: bool = True
+):
+    """
+    Get a patient with their visits and documents in exactly three queries
+    (plus one for the archive files once visits are partitioned).
+    The related rows are attached to the patient up front so serializing it
+    never triggers lazy loads. Visits and documents come newest first and can
+    be capped with visits_limit / documents_limit. Visits in archived
+    partitions are included unless the live ones already fill visits_limit.
+    """
+    db_patient = get_patient(db, patient_id)
+    if not db_patient:
+        return None
+
+    visits = (
+        db.query(Visit)
+        .filter(Visit.patient_id == patient_id)
+        .order_by(Visit.visit_date.desc(), Visit.id.desc())
+    )
+    if visits_limit is not None:
+        visits = visits.limit(visits_limit)
+
+    documents = (
+        db.query(Document)
+        .filter(Document.patient_id == patient_id)
+        .order_by(Document.uploaded_at.desc(), Document.id.desc())
+    )
+    if documents_limit is not None:
+        documents = documents.limit(documents_limit)
+
+    visits = visits.all()
+    if include_archived and (visits_limit is None or len(visits) < visits_limit):
+        visits = merge_visits(visits, partitions.archived_visits(db, patient_id), visits_limit)
+    set_committed_value(db_patient, "visits", visits)
+    set_committed_value(db_patient, "documents", documents.all())
+    return db_patient
+
+
+def patient_exists(db: Session, patient_id: int):
+    """Check whether a patient exists without loading the row"""
+    return db.query(exists().where(Patient.id == patient_id)).scalar()
+
+
 def get_patient_by_mrn(db: Session, mrn: str):
     """Get a patient by Medical Record Number"""
     return db.query(Patient).filter(Patient.medical_record_number == mrn).first()
 
 
-def get_patients(db: Session, skip: int = 0, limit: int = 100):
-    """Get all patients with pagination"""
-    return db.query(Patient).offset(skip).limit(limit).all()
+def get_patients(db: Session, skip: int = 0, limit: int = 100, columns=None):
+    """
+    Get all patients with pagination.
+    Pass columns to get plain rows of just those columns instead of ORM objects.
+    """
+    return db.query(*(columns or (Patient,))).order_by(Patient.id).offset(skip).limit(limit).all()
+
+
+def encode_cursor(order: str, patient: Patient):
+    """Build an opaque cursor pointing just after the given patient"""
+    values = [getattr(patient, column.key) for column in PATIENT_SORT_KEYS[order]]
+    raw = json.dumps([order, values]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
 
+def decode_cursor(cursor: str):
+    """Decode a cursor into (order, values). Raises ValueError if malformed."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        order, values = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if (not isinstance(order, str) or order not in PATIENT_SORT_KEYS or not isinstance(values, list)
+            or len(values) != len(PATIENT_SORT_KEYS[order])):
+        raise ValueError("Invalid cursor")
+    # Only values of the sort keys' own types may reach the SQL comparison
+    for column, value in zip(PATIENT_SORT_KEYS[order], values):
+        if type(value) is not column.type.python_type:
+            raise ValueError("Invalid cursor")
+    return order, values
 
-def update_patient(db: Session, patient_id: int, patient_update: PatientUpdate):
-    """Update a patient"""
+
+def get_patients_keyset(db: Session, cursor: str = "", limit: int = 100, order: str = "id", columns=None):
+    """
+    Get a page of patients using keyset (cursor) pagination.
+    Each page seeks directly to the last row of the previous one, so it costs
+    the same no matter how deep it is. An empty cursor starts at the beginning.
+    Returns (patients, next_cursor); next_cursor is None on the last page.
+    Pass columns to get plain rows instead of ORM objects; they must include
+    the sort key columns.
+    """
+    if order not in PATIENT_SORT_KEYS:
+        raise ValueError(f"Invalid order: {order}")
+    if cursor:
+        cursor_order, values = decode_cursor(cursor)
+        if cursor_order != order:
+            raise ValueError("Cursor does not match the requested order")
+    sort_keys = PATIENT_SORT_KEYS[order]
+
+    query = db.query(*(columns or (Patient,)))
+    if cursor:
+        query = query.filter(tuple_(*sort_keys) > tuple_(*values))
+    # Fetch one extra row to know whether another page exists
+    patients = query.order_by(*sort_keys).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(patients) > limit:
+        patients = patients[:limit]
+        if patients:
+            next_cursor = encode_cursor(order, patients[-1])
+    return patients, next_cursor
+
+
+def update_patient(db: Session, patient_id: int, patient_update: PatientUpdate, invalidate: bool = True):
+    """Update a patient. invalidate=False leaves dropping the cached responses to the caller."""
     db_patient = get_patient(db, patient_id)
     if not db_patient:
         return None
     
+    old_gender, old_date_of_birth = db_patient.gender, db_patient.date_of_birth
     update_data = patient_update.model_dump(exclude_unset=True)
     for key, value in update_data.items():
         setattr(db_patient, key, value)
     
+    if (db_patient.gender, db_patient.date_of_birth) != (old_gender, old_date_of_birth):
+        stats.record_patient_demographics_changed(db, db_patient, old_gender, old_date_of_birth)
     db_patient.updated_at = datetime.utcnow()
     db.commit()
+    if invalidate:
+        cache.invalidate_patient(patient_id)
     db.refresh(db_patient)
     return db_patient
 
 
-def delete_patient(db: Session, patient_id: int):
+def delete_patient(db: Session, patient_id: int, purge_archive: bool = True, invalidate: bool = True):
     """Delete a patient"""
     db_patient = get_patient(db, patient_id)
     if not db_patient:
         return False
     
+    stats.record_patient_deleted(db, db_patient)
+    # One statement for all of the patient's visits rather than a cascade
+    # that loads every visit and deletes it by id
+    db.query(Visit).filter(Visit.patient_id == patient_id).delete(synchronize_session=False)
     db.delete(db_patient)
     db.commit()
+    if purge_archive:
+        partitions.purge_patient(db.get_bind(), patient_id)
+    if invalidate:
+        cache.invalidate_patient(patient_id)
     return True
 
 
 # ============= VISIT CRUD =============
 
-def create_visit(db: Session, visit: VisitCreate):
+def create_visit(db: Session, visit: VisitCreate, invalidate: bool = True):
     """Create a new visit"""
     db_visit = Visit(**visit.model_dump())
     db.add(db_visit)
+    stats.record_visit_created(db, db_visit.visit_date, db_visit.reason, db.get(Patient, db_visit.patient_id))
     db.commit()
+    if invalidate:
+        cache.invalidate_patient(db_visit.patient_id)
     db.refresh(db_visit)
     return db_visit
 
 
-def get_patient_visits(db: Session, patient_id: int):
-    """Get all visits for a patient"""
-    return db.query(Visit).filter(Visit.patient_id == patient_id).all()
+def get_patient_visits(db: Session, patient_id: int, columns=None, include_archived: bool = True):
+    """Get all visits for a patient, as plain rows of the given columns if any"""
+    visits = db.query(*(columns or (Visit,))).filter(Visit.patient_id == patient_id).all()
+    if include_archived:
+        visits += partitions.archived_visits(db, patient_id, columns)
+    return visits
 
 
 # ============= DOCUMENT CRUD =============
 
-def create_document(db: Session, document: DocumentCreate):
-    """Create a new document record"""
-    db_document = Document(**document.model_dump())
+def create_document(db: Session, document: DocumentCreate, sha256: Optional[str] = None, invalidate: bool = True):
+    """Create a new document record. Uploaded files (with a sha256) are queued for processing."""
+    db_document = Document(**document.model_dump(), sha256=sha256)
     db.add(db_document)
+    if sha256 is not None:
+        import jobs  # multiprocessing - only loaded once a file is uploaded
+        jobs.enqueue(db, db_document)
+    stats.record_document_created(db)
     db.commit()
+    if invalidate:
+        cache.invalidate_patient(db_document.patient_id)
     db.refresh(db_document)
     return db_document
 
 
-def get_patient_documents(db: Session, patient_id: int):
-    """Get all documents for a patient"""
-    return db.query(Document).filter(Document.patient_id == patient_id).all()
+def get_document(db: Session, document_id: int):
+    """Get a single document record by ID"""
+    return db.query(Document).filter(Document.id == document_id).first()
+
+
+def get_patient_documents(db: Session, patient_id: int, columns=None):
+    """Get all documents for a patient, as plain rows of the given columns if any"""
+    return db.query(*(columns or (Document,))).filter(Document.patient_id == patient_id).all()
 
 
 # ============= USER CRUD =============
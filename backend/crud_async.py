@@ -0,0 +1,140 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+from starlette.concurrency import run_in_threadpool
+from schemas import PatientCreate, PatientUpdate, VisitCreate, DocumentCreate
+import cache
+import crud
+import database
+import partitions
+import search
+import stats
+
+# Async versions of the CRUD functions for DB_ASYNC mode.
+# Each one runs the sync implementation through AsyncSession.run_sync, which
+# executes it on a greenlet against the asyncio driver. The query logic (and
+# the counter, rollup and MRN bookkeeping) stays in one place, and no thread
+# is blocked while the database works.
+#
+# The greenlet runs on the event loop, so writes pass invalidate=False and
+# drop the patient's cached responses here once run_sync returns, through
+# the cache's async path rather than a blocking Redis round trip.
+
+
+# ============= PATIENT CRUD =============
+
+async def create_patient(db: AsyncSession, patient: PatientCreate):
+    """Create a new patient"""
+    # Take the MRN on a worker thread: when the allocator has to reserve a new
+    # block it waits on the database, and on SQLite that wait can be for a
+    # write lock only this event loop can release
+    medical_record_number = (await run_in_threadpool(crud.generate_mrns, db.sync_session, 1))[0]
+    return await db.run_sync(crud.create_patient, patient, medical_record_number)
+
+
+async def get_patient(db: AsyncSession, patient_id: int):
+    """Get a single patient by ID"""
+    return await db.run_sync(crud.get_patient, patient_id)
+
+
+async def get_patient_detail(db: AsyncSession, patient_id: int, visits_limit=None, documents_limit=None):
+    """Get a patient with their visits and documents"""
+    patient = await db.run_sync(
+        crud.get_patient_detail, patient_id, visits_limit=visits_limit, documents_limit=documents_limit,
+        include_archived=False,
+    )
+    if patient is not None and (visits_limit is None or len(patient.visits) < visits_limit):
+        paths = await db.run_sync(partitions.archive_paths)
+        if paths:
+            # Archived visits are read from Parquet files on a worker thread
+            archived = await run_in_threadpool(partitions.read_archive, paths, None, patient_id)
+            set_committed_value(patient, "visits", crud.merge_visits(patient.visits, archived, visits_limit))
+    return patient
+
+
+async def patient_exists(db: AsyncSession, patient_id: int):
+    """Check whether a patient exists without loading the row"""
+    return await db.run_sync(crud.patient_exists, patient_id)
+
+
+async def get_patients(db: AsyncSession, skip: int = 0, limit: int = 100, columns=None):
+    """Get all patients with pagination"""
+    return await db.run_sync(crud.get_patients, skip=skip, limit=limit, columns=columns)
+
+
+async def get_patients_keyset(db: AsyncSession, cursor: str = "", limit: int = 100, order: str = "id",
+                              columns=None):
+    """Get a page of patients using keyset (cursor) pagination"""
+    return await db.run_sync(crud.get_patients_keyset, cursor=cursor, limit=limit, order=order, columns=columns)
+
+
+async def search_patients(db: AsyncSession, q: str, skip: int = 0, limit: int = 20):
+    """Search patients by name, MRN, phone or email prefix"""
+    return await db.run_sync(search.search_patients, q, skip=skip, limit=limit)
+
+
+async def search_visits(db: AsyncSession, q: str, **filters):
+    """Full-text search over visit text"""
+    return await db.run_sync(search.search_visits, q, **filters)
+
+
+async def update_patient(db: AsyncSession, patient_id: int, patient_update: PatientUpdate):
+    """Update a patient"""
+    patient = await db.run_sync(crud.update_patient, patient_id, patient_update, invalidate=False)
+    if patient is not None:
+        await cache.invalidate_patient_async(patient_id)
+    return patient
+
+
+async def delete_patient(db: AsyncSession, patient_id: int):
+    """Delete a patient"""
+    deleted = await db.run_sync(crud.delete_patient, patient_id, purge_archive=False, invalidate=False)
+    if deleted:
+        # Rewriting archive files is blocking file I/O - keep it off the event loop
+        await run_in_threadpool(partitions.purge_patient, database.engine, patient_id)
+        await cache.invalidate_patient_async(patient_id)
+    return deleted
+
+
+# ============= VISIT CRUD =============
+
+async def create_visit(db: AsyncSession, visit: VisitCreate):
+    """Create a new visit"""
+    db_visit = await db.run_sync(crud.create_visit, visit, invalidate=False)
+    await cache.invalidate_patient_async(db_visit.patient_id)
+    return db_visit
+
+
+async def get_patient_visits(db: AsyncSession, patient_id: int, columns=None):
+    """Get all visits for a patient"""
+    visits = await db.run_sync(crud.get_patient_visits, patient_id, columns=columns, include_archived=False)
+    paths = await db.run_sync(partitions.archive_paths)
+    if paths:
+        # Archived visits are read from Parquet files on a worker thread
+        visits += await run_in_threadpool(partitions.read_archive, paths, columns, patient_id)
+    return visits
+
+
+# ============= DOCUMENT CRUD =============
+
+async def create_document(db: AsyncSession, document: DocumentCreate):
+    """Create a new document record"""
+    db_document = await db.run_sync(crud.create_document, document, invalidate=False)
+    await cache.invalidate_patient_async(db_document.patient_id)
+    return db_document
+
+
+async def get_patient_documents(db: AsyncSession, patient_id: int, columns=None):
+    """Get all documents for a patient"""
+    return await db.run_sync(crud.get_patient_documents, patient_id, columns=columns)
+
+
+# ============= ANALYTICS =============
+
+async def get_stats(db: AsyncSession):
+    """Read the materialized statistics"""
+    return await db.run_sync(stats.get_stats)
+
+
+async def get_trends(db: AsyncSession, **kwargs):
+    """Visit counts per period from the rollup table"""
+    return await db.run_sync(stats.get_trends, **kwargs)
@@ -1,7 +1,17 @@
+from fastapi import Request
 from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
 from models import Base
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import replicas
+import asyncio
+import logging
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -11,19 +21,153 @@ load_dotenv()
 # For production, use PostgreSQL from environment variable
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./healthplus.db")
 
-# Create SQLAlchemy engine
-if DATABASE_URL.startswith("sqlite"):
-    engine = create_engine(
-        DATABASE_URL,
-        connect_args={"check_same_thread": False}  # Needed for SQLite
+# Connection pool configuration (per process - multiply by the number of
+# uvicorn workers to get the most connections the database will see)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # seconds to wait for a connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # seconds; -1 disables
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# PgBouncer (transaction pooling) mode: no client-side pool and no prepared
+# statements, since PgBouncer owns the connections
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "false").lower() in ("1", "true", "yes")
+# Connections each pool opens in parallel at startup, so the first requests
+# after a cold start don't queue up behind new connections (0 disables)
+DB_POOL_WARM = int(os.getenv("DB_POOL_WARM", str(DB_POOL_SIZE)))
+# Skip the schema setup in init_db when the database was already set up by
+# this version of the code (see migrations.py)
+DB_FAST_BOOT = os.getenv("DB_FAST_BOOT", "true").lower() in ("1", "true", "yes")
+
+logger = logging.getLogger(__name__)
+
+
+class PoolMetricsMixin:
+    """Records how long checkouts wait for a connection and how often they time out"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            with self.metrics_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self.metrics_lock:
+                self.checkouts += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+
+class MeteredQueuePool(PoolMetricsMixin, QueuePool):
+    pass
+
+
+class MeteredAsyncQueuePool(PoolMetricsMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def get_engine_options(url: str, is_async: bool = False):
+    """Pool and driver options for create_engine / create_async_engine"""
+    if url.startswith("sqlite"):
+        options = {"connect_args": {"check_same_thread": False}}  # Needed for SQLite
+        if ":memory:" in url or url.rstrip("/").endswith(":"):
+            # In-memory databases live in a single connection
+            return options
+    else:
+        options = {}
+        if DB_PGBOUNCER:
+            options["poolclass"] = NullPool
+            if is_async:
+                options["connect_args"] = {"statement_cache_size": 0, "prepared_statement_cache_size": 0}
+            return options
+
+    options.update(
+        poolclass=MeteredAsyncQueuePool if is_async else MeteredQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
     )
-else:
-    # PostgreSQL connection
-    engine = create_engine(DATABASE_URL)
+    return options
+
+
+# Create SQLAlchemy engine
+engine = create_engine(DATABASE_URL, **get_engine_options(DATABASE_URL))
+metrics.instrument_engine(engine)
 
 # Create SessionLocal class for database sessions
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async mode - set DB_ASYNC=true to serve the main endpoints (api_async.py)
+# from an AsyncSession on asyncpg / aiosqlite, so a request waiting on the
+# database doesn't hold one of the threadpool threads.
+# Startup and background jobs keep using the sync engine above.
+DB_ASYNC = os.getenv("DB_ASYNC", "false").lower() in ("1", "true", "yes")
+
+
+def get_async_url(url: str):
+    """Map a sync DATABASE_URL to its asyncio driver equivalent"""
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url[len("sqlite://"):]
+    for prefix in ("postgresql://", "postgres://", "postgresql+psycopg2://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    return url
+
+
+async_engine = None
+AsyncSessionLocal = None
+if DB_ASYNC:
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    from mrn import share_allocator
+
+    async_url = get_async_url(DATABASE_URL)
+    async_engine = create_async_engine(async_url, **get_engine_options(async_url, is_async=True))
+    metrics.instrument_engine(async_engine.sync_engine, "async")
+    # Block reservations (one per MRN_BLOCK_SIZE patients) go through the sync engine
+    share_allocator(async_engine.sync_engine, engine)
+    # expire_on_commit=False so response serialization never triggers IO
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+def create_replica(index: int, url: str):
+    """Engines and session factories for one read replica, set to refuse writes"""
+    name = f"replica{index}"
+    replica_engine = create_engine(url, **get_engine_options(url))
+    replicas.make_read_only(replica_engine)
+    metrics.instrument_engine(replica_engine, name)
+    replica_async_engine = replica_async_sessions = None
+    if DB_ASYNC:
+        replica_async_url = get_async_url(url)
+        replica_async_engine = create_async_engine(replica_async_url, **get_engine_options(replica_async_url, is_async=True))
+        replicas.make_read_only(replica_async_engine.sync_engine)
+        metrics.instrument_engine(replica_async_engine.sync_engine, f"{name}-async")
+        replica_async_sessions = async_sessionmaker(replica_async_engine, autoflush=False, expire_on_commit=False)
+    return replicas.Replica(
+        name, replica_engine, sessionmaker(autocommit=False, autoflush=False, bind=replica_engine),
+        replica_async_engine, replica_async_sessions,
+    )
+
+
+# Read replicas (see replicas.py); None when DATABASE_REPLICA_URLS is unset
+replica_set = None
+if replicas.DATABASE_REPLICA_URLS:
+    replica_set = replicas.ReplicaSet(
+        engine, [create_replica(i, url) for i, url in enumerate(replicas.DATABASE_REPLICA_URLS)]
+    )
+    replicas.track_commits([engine] + ([async_engine.sync_engine] if async_engine is not None else []))
+
 
 def get_db():
     """
@@ -37,10 +181,154 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    """
+    Dependency function to get an async database session.
+    Only available when DB_ASYNC is enabled.
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def _read_replica(request: Request):
+    """Replica a read-only request should use, or None for the primary"""
+    if replica_set is None:
+        return None
+    replica = replica_set.choose(replicas.request_token(request.headers, request.cookies))
+    metrics.DB_READS.inc(replica.name if replica is not None else "primary")
+    return replica
+
+
+def get_read_db(request: Request):
+    """
+    Dependency function to get a read-only database session.
+    Use this in endpoints that never write; the session may be on a read
+    replica, a little behind the primary (but never behind this client's
+    own writes).
+    """
+    replica = _read_replica(request)
+    db = replica.session_factory() if replica is not None else SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_read_db(request: Request):
+    """
+    Dependency function to get a read-only async database session.
+    Only available when DB_ASYNC is enabled.
+    """
+    replica = _read_replica(request)
+    async with (replica.async_session_factory() if replica is not None else AsyncSessionLocal()) as db:
+        yield db
+
+
+def get_read_engine(request: Request):
+    """Engine for a read-only request that manages its own connections, e.g. an export"""
+    replica = _read_replica(request)
+    return replica.engine if replica is not None else engine
+
+
+def get_pool_stats(db_engine):
+    """Current state of an engine's connection pool"""
+    pool = db_engine.pool
+    pool_stats = {"pool": pool.__class__.__name__}
+    if isinstance(pool, QueuePool):
+        pool_stats.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            overflow=max(pool.overflow(), 0),
+            max_overflow=pool._max_overflow,
+            timeout_seconds=pool.timeout(),
+        )
+    if isinstance(pool, PoolMetricsMixin):
+        with pool.metrics_lock:
+            pool_stats.update(
+                checkouts=pool.checkouts,
+                timeouts=pool.timeouts,
+                wait_avg_ms=round(pool.wait_total / pool.checkouts * 1000, 3) if pool.checkouts else 0,
+                wait_max_ms=round(pool.wait_max * 1000, 3),
+            )
+    return pool_stats
+
+
+def _warm_targets(engines, count: int):
+    """One entry per connection to open: count per engine with a queue pool, at most its pool size"""
+    return [
+        db_engine for db_engine in engines if isinstance(db_engine.pool, QueuePool)
+        for _ in range(min(count, db_engine.pool.size()))
+    ]
+
+
+def warm_pools(count: int = DB_POOL_WARM):
+    """Open connections for the primary and replica pools all at once, then hand them back"""
+    engines = [engine]
+    if replica_set is not None:
+        engines += [replica.engine for replica in replica_set.replicas]
+    targets = _warm_targets(engines, count)
+    if not targets:
+        return
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = [executor.submit(db_engine.connect) for db_engine in targets]
+    # Only hand them back once all are open, or later connects would reuse the first ones
+    for future in futures:
+        try:
+            future.result().close()
+        except Exception:
+            logger.exception("Could not warm the connection pool")
+
+
+def start_warmup_thread(count: int = DB_POOL_WARM):
+    """Warm the connection pools in a daemon thread, alongside the rest of startup"""
+    if count <= 0:
+        return None
+    thread = threading.Thread(target=warm_pools, args=(count,), name="pool-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+async def warm_async_pools(count: int = DB_POOL_WARM):
+    """warm_pools for the async engines"""
+    engines = [async_engine]
+    if replica_set is not None:
+        engines += [replica.async_engine for replica in replica_set.replicas]
+    results = await asyncio.gather(
+        *(db_engine.connect().start() for db_engine in _warm_targets(engines, count)), return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Could not warm the async connection pool", exc_info=result)
+        else:
+            await result.close()
+
+
 def init_db():
     """
-    Initialize database - create all tables.
-    Call this when starting the app.
+    Initialize database - create all tables and apply pending migrations.
+    Call this when starting the app. With DB_FAST_BOOT, a database already
+    set up by this version of the code only has its partitions checked.
     """
+    from changes import init_change_log
+    from migrations import get_fingerprint, record_fingerprint, run_migrations, schema_fingerprint
+    from mrn import init_mrn_counter
+    from partitions import init_partitions
+    from search import init_search_index
+    from stats import init_stats
+
+    fingerprint = schema_fingerprint(engine.dialect)
+    if DB_FAST_BOOT and get_fingerprint(engine) == fingerprint:
+        init_partitions(engine, fast=True)
+        logger.info("Database schema up to date (fast boot)")
+        return
+
     Base.metadata.create_all(bind=engine)
-    print("Database initialized successfully!")
+    run_migrations(engine)
+    init_partitions(engine)
+    init_search_index(engine)
+    init_change_log(engine)
+    init_mrn_counter(engine)
+    init_stats(SessionLocal)
+    record_fingerprint(engine, fingerprint)
+    logger.info("Database initialized successfully!")
@@ -0,0 +1,188 @@
+import csv
+import io
+import os
+from datetime import datetime
+from sqlalchemy import Date, DateTime, Integer, or_, select
+from models import Patient, Visit, Document
+import partitions
+import serialization
+
+# Streaming export of patients, visits and documents as NDJSON, CSV,
+# Parquet or Arrow IPC.
+# Rows are read through a server-side cursor (stream_results) in chunks of
+# EXPORT_CHUNK_ROWS and each chunk is encoded and handed on before the next
+# is fetched, so memory stays flat however big the table is. The exported
+# fields are the ones the API's response schemas expose. Visits in archived
+# partitions (partitions.py) come after the live ones, read from their
+# Parquet files a row group at a time.
+#
+# updated_since makes exports incremental: patients changed at or after that
+# time, visits created since then and documents uploaded or processed since
+# then. Visits have no updated_at because the API never edits them, so for
+# visits it means "created since". Deletions are not part of an export.
+
+EXPORT_KINDS = {
+    "patients": (Patient, serialization.PATIENT_COLUMNS),
+    "visits": (Visit, serialization.VISIT_COLUMNS),
+    "documents": (Document, serialization.DOCUMENT_COLUMNS),
+}
+EXPORT_FORMATS = ("ndjson", "csv", "parquet", "arrow")
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))
+
+
+def _changed_since(kind: str, since: datetime):
+    """Filter for rows changed at or after since"""
+    if kind == "patients":
+        return Patient.updated_at >= since
+    if kind == "visits":
+        return Visit.created_at >= since
+    return or_(Document.uploaded_at >= since, Document.processed_at >= since)
+
+
+def iter_chunks(engine, kind: str, updated_since: datetime = None, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """Yield lists of rows from a server-side cursor, in primary key order, then any archived visits"""
+    model, columns = EXPORT_KINDS[kind]
+    query = select(*columns).order_by(model.id)
+    if updated_since is not None:
+        query = query.where(_changed_since(kind, updated_since))
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=chunk_rows).execute(query)
+        for rows in result.partitions():
+            yield rows
+        paths = partitions.archive_paths(conn) if kind == "visits" else []
+    # Archived visit partitions follow the live rows
+    yield from partitions.iter_archive(paths, columns, created_since=updated_since)
+
+
+# ============= FORMATS =============
+
+def _ndjson(chunks, columns):
+    keys = [column.key for column in columns]
+    for rows in chunks:
+        yield b"".join(serialization.dumps(dict(zip(keys, row))) + b"\n" for row in rows)
+
+
+def _csv(chunks, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.key for column in columns])
+    for rows in chunks:
+        writer.writerows(
+            ["" if value is None else value.isoformat() if hasattr(value, "isoformat") else value for value in row]
+            for row in rows
+        )
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+class _Sink:
+    """Write-only file object whose contents are drained after each chunk"""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def arrow_schema(columns):
+    import pyarrow as pa  # optional dependency, only needed for these formats
+
+    def arrow_type(column):
+        if isinstance(column.type, Integer):
+            return pa.int64()
+        if isinstance(column.type, DateTime):
+            return pa.timestamp("us")
+        if isinstance(column.type, Date):
+            return pa.date32()
+        return pa.string()
+
+    return pa.schema([pa.field(column.key, arrow_type(column), nullable=not column.primary_key) for column in columns])
+
+
+def _columnar(chunks, columns, fmt: str):
+    import pyarrow as pa
+
+    schema = arrow_schema(columns)
+    sink = _Sink()
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+    # Each chunk becomes one Parquet row group / Arrow record batch
+    for rows in chunks:
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array([row[i] for row in rows], type=field.type) for i, field in enumerate(schema)],
+            schema=schema,
+        )
+        writer.write_batch(batch)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def export_stream(engine, kind: str, fmt: str = "ndjson", updated_since: datetime = None):
+    """Yield the export as byte chunks. Raises ValueError for an unknown kind or format."""
+    if kind not in EXPORT_KINDS:
+        raise ValueError(f"Invalid export kind: {kind}")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Invalid format: {fmt}")
+    _, columns = EXPORT_KINDS[kind]
+    chunks = iter_chunks(engine, kind, updated_since)
+    if fmt == "ndjson":
+        return _ndjson(chunks, columns)
+    if fmt == "csv":
+        return _csv(chunks, columns)
+    arrow_schema(columns)  # fail now, not mid-response, if pyarrow is missing
+    return _columnar(chunks, columns, fmt)
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    from database import engine
+
+    parser = argparse.ArgumentParser(description="Export patients, visits or documents")
+    parser.add_argument("kind", choices=sorted(EXPORT_KINDS))
+    parser.add_argument("path", nargs="?", help="Output file (stdout if omitted)")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, help="Defaults to the file extension, else ndjson")
+    parser.add_argument("--updated-since", type=datetime.fromisoformat, help="ISO date/time for incremental exports")
+    args = parser.parse_args()
+
+    fmt = args.format or (os.path.splitext(args.path)[1][1:] if args.path else "") or "ndjson"
+    out = open(args.path, "wb") if args.path else sys.stdout.buffer
+    try:
+        for chunk in export_stream(engine, args.kind, fmt, args.updated_since):
+            out.write(chunk)
+    finally:
+        if args.path:
+            out.close()
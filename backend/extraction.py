@@ -0,0 +1,155 @@
+import os
+import re
+import struct
+import time
+import zlib
+import hashlib
+
+import storage
+
+# Text and metadata extraction for uploaded document files.
+# These functions run inside the worker processes of jobs.py, so they only
+# touch storage - never the database - and return plain dicts that pickle
+# cheaply back to the parent process.
+#
+# There's no real OCR engine behind images yet: image "OCR" is simulated by
+# spending CPU in proportion to the pixel count, so the worker pool sees a
+# realistic load, and only the image's header metadata is extracted.
+
+EXTRACT_MAX_BYTES = int(os.getenv("EXTRACT_MAX_BYTES", str(50 * 1024 * 1024)))
+EXTRACT_MAX_TEXT = int(os.getenv("EXTRACT_MAX_TEXT", str(1024 * 1024)))
+OCR_SIMULATED_MS_PER_MEGAPIXEL = int(os.getenv("OCR_SIMULATED_MS_PER_MEGAPIXEL", "50"))
+
+TEXT_TYPES = {"txt", "csv", "md", "json", "xml", "html"}
+IMAGE_TYPES = {"png", "jpg", "jpeg", "gif"}
+
+
+def read_file(sha256: str, limit: int = EXTRACT_MAX_BYTES):
+    """Up to limit bytes of a stored file"""
+    chunks = []
+    size = 0
+    for chunk in storage.get_storage().read(sha256, 0, limit - 1):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= limit:
+            break
+    return b"".join(chunks)[:limit]
+
+
+def extract_document(sha256: str, file_type: str):
+    """Extract text and metadata from a stored file. Raises on unreadable input."""
+    started = time.perf_counter()
+    data = read_file(sha256)
+    file_type = (file_type or "").lower()
+
+    if file_type == "pdf" or data.startswith(b"%PDF-"):
+        text, metadata = extract_pdf(data)
+    elif file_type in IMAGE_TYPES:
+        text, metadata = extract_image(data)
+    elif file_type in TEXT_TYPES:
+        text, metadata = data.decode("utf-8", errors="replace"), {"format": file_type}
+    else:
+        text, metadata = None, {"format": file_type or None}
+
+    if text is not None:
+        text = text[:EXTRACT_MAX_TEXT]
+        metadata["characters"] = len(text)
+    metadata["truncated"] = len(data) >= EXTRACT_MAX_BYTES
+    metadata["extract_seconds"] = round(time.perf_counter() - started, 4)
+    return {"text": text, "metadata": metadata}
+
+
+# ============= PDF =============
+
+_PDF_STREAM = re.compile(rb"<<(.*?)>>\s*stream\r?\n(.*?)\r?\nendstream", re.S)
+_PDF_PAGE = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+_PDF_INFO = re.compile(rb"/(Title|Author|Subject|Creator|Producer|CreationDate)\s*\(((?:\\.|[^\\)])*)\)")
+# (string) Tj, (string) ' and [(string) 12 (string)] TJ
+_PDF_TEXT = re.compile(rb"\[((?:\\.|[^\\\]])*)\]\s*TJ|\(((?:\\.|[^\\)])*)\)\s*(?:Tj|')")
+_PDF_ARRAY_STRING = re.compile(rb"\(((?:\\.|[^\\)])*)\)")
+_PDF_ESCAPES = {b"n": b"\n", b"r": b"\r", b"t": b"\t", b"b": b"\b", b"f": b"\f"}
+
+
+def _pdf_string(raw: bytes):
+    """Decode a PDF literal string"""
+    def unescape(match):
+        escaped = match.group(1)
+        if escaped[:1].isdigit():
+            return bytes([int(escaped, 8) & 0xFF])
+        return _PDF_ESCAPES.get(escaped, escaped)
+
+    value = re.sub(rb"\\([0-7]{1,3}|.)", unescape, raw, flags=re.S)
+    if value.startswith(b"\xfe\xff"):
+        return value[2:].decode("utf-16-be", errors="replace")
+    return value.decode("latin-1")
+
+
+def extract_pdf(data: bytes):
+    """Text from the content streams, plus page count and document info"""
+    if not data.startswith(b"%PDF-"):
+        raise ValueError("Not a PDF file")
+
+    metadata = {"format": "pdf", "version": data[5:8].decode("latin-1"), "pages": len(_PDF_PAGE.findall(data))}
+    for key, value in _PDF_INFO.findall(data):
+        metadata.setdefault(key.decode().lower(), _pdf_string(value))
+
+    lines = []
+    for dictionary, content in _PDF_STREAM.findall(data):
+        if b"/FlateDecode" in dictionary:
+            try:
+                content = zlib.decompress(content)
+            except zlib.error:
+                continue
+        elif b"/Filter" in dictionary:
+            continue  # images and other encodings carry no text
+        for array, string in _PDF_TEXT.findall(content):
+            if array:
+                lines.append("".join(_pdf_string(s) for s in _PDF_ARRAY_STRING.findall(array)))
+            else:
+                lines.append(_pdf_string(string))
+    return "\n".join(lines), metadata
+
+
+# ============= IMAGES =============
+
+def image_size(data: bytes):
+    """(format, width, height) from a PNG, JPEG or GIF header"""
+    if data.startswith(b"\x89PNG\r\n\x1a\n") and data[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", data[16:24])
+        return "png", width, height
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        width, height = struct.unpack("<HH", data[6:10])
+        return "gif", width, height
+    if data.startswith(b"\xff\xd8"):
+        # Walk the JPEG segments to the start-of-frame marker
+        offset = 2
+        while offset + 9 < len(data):
+            if data[offset] != 0xFF:
+                offset += 1
+                continue
+            marker = data[offset + 1]
+            if marker in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+                height, width = struct.unpack(">HH", data[offset + 5:offset + 9])
+                return "jpeg", width, height
+            if marker == 0xD8 or 0xD0 <= marker <= 0xD7:
+                offset += 2
+                continue
+            offset += 2 + struct.unpack(">H", data[offset + 2:offset + 4])[0]
+    raise ValueError("Unrecognized image format")
+
+
+def simulate_ocr(data: bytes, megapixels: float):
+    """Burn CPU roughly as long as OCR of an image this size would take"""
+    deadline = time.perf_counter() + megapixels * OCR_SIMULATED_MS_PER_MEGAPIXEL / 1000
+    digest = hashlib.sha256(data[:65536])
+    while time.perf_counter() < deadline:
+        digest = hashlib.sha256(digest.digest())
+
+
+def extract_image(data: bytes):
+    """Image dimensions; the text recognition step is simulated"""
+    fmt, width, height = image_size(data)
+    megapixels = width * height / 1_000_000
+    simulate_ocr(data, megapixels)
+    metadata = {"format": fmt, "width": width, "height": height, "megapixels": round(megapixels, 2), "ocr": "simulated"}
+    return "", metadata
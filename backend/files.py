@@ -0,0 +1,147 @@
+import os
+import re
+import unicodedata
+from urllib.parse import quote
+from multipart.multipart import MultipartParser, parse_options_header
+
+# Streaming multipart/form-data upload parsing and HTTP Range handling for
+# document files. The file part is passed straight to a storage writer as it
+# arrives, so the upload is never held in memory or spooled twice.
+
+MAX_FIELD_SIZE = 64 * 1024  # form fields other than the file
+
+
+class Upload:
+    """A parsed upload: the stored file plus the other form fields"""
+
+    def __init__(self):
+        self.fields = {}
+        self.filename = None
+        self.content_type = None
+        self.stored = None
+
+    @property
+    def file_type(self):
+        """File extension, e.g. pdf or jpg"""
+        extension = os.path.splitext(self.filename or "")[1]
+        return extension[1:].lower() or None
+
+
+def receive_upload(content_type: str, chunks, storage, file_field: str = "file"):
+    """
+    Parse a multipart/form-data body from an iterator of byte chunks,
+    streaming the file part into storage. Raises ValueError for bad input.
+    """
+    mime, options = parse_options_header(content_type)
+    boundary = options.get(b"boundary")
+    if mime != b"multipart/form-data" or not boundary:
+        raise ValueError("Expected multipart/form-data")
+
+    upload = Upload()
+    part = {"headers": {}, "field": b"", "value": b"", "name": None, "writer": None, "data": None}
+    writers = []
+
+    def on_part_begin():
+        part.update(headers={}, name=None, writer=None, data=None)
+
+    def on_header_field(data, start, end):
+        part["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        part["value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"][part["field"].lower()] = part["value"]
+        part["field"] = part["value"] = b""
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        part["name"] = disposition.get(b"name", b"").decode()
+        if part["name"] == file_field and b"filename" in disposition:
+            if upload.filename is not None:
+                raise ValueError("Only one file can be uploaded at a time")
+            upload.filename = os.path.basename(disposition[b"filename"].decode())
+            upload.content_type = part["headers"].get(b"content-type", b"").decode() or None
+            part["writer"] = storage.open_writer()
+            writers.append(part["writer"])
+        else:
+            part["data"] = bytearray()
+
+    def on_part_data(data, start, end):
+        if part["writer"] is not None:
+            part["writer"].write(data[start:end])
+        else:
+            part["data"].extend(data[start:end])
+            if len(part["data"]) > MAX_FIELD_SIZE:
+                raise ValueError(f"Form field {part['name']} is too large")
+
+    def on_part_end():
+        if part["writer"] is not None:
+            upload.stored = part["writer"].commit()
+        else:
+            upload.fields[part["name"]] = part["data"].decode()
+
+    parser = MultipartParser(boundary, callbacks={
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    try:
+        for chunk in chunks:
+            parser.write(chunk)
+        parser.finalize()
+    except Exception:
+        for writer in writers:
+            if upload.stored is None:
+                writer.abort()
+        raise
+
+    if upload.stored is None:
+        raise ValueError(f"Missing file field: {file_field}")
+    return upload
+
+
+def parse_range(header: str, size: int):
+    """
+    Parse a single-range "bytes=start-end" header into inclusive (start, end).
+    Returns None when there's no usable Range header (send the whole file);
+    raises ValueError when the range can't be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[len("bytes="):].strip().partition("-")
+    try:
+        if start:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+        else:
+            # "bytes=-N" means the last N bytes
+            start = max(size - int(end), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+def content_disposition(filename: str, disposition: str = "attachment"):
+    """
+    Content-Disposition header value for sending a file under its uploaded
+    name (RFC 6266): an ASCII-only filename for old clients, and the exact
+    name as UTF-8 in filename*. Headers are latin-1, so the raw name can't
+    go in as it is, and quotes or line breaks in it must not end the value.
+    """
+    stem, extension = (
+        re.sub(r'[^\x20-\x7e]|["\\]', "_", unicodedata.normalize("NFKD", part).encode("ascii", "ignore").decode())
+        for part in os.path.splitext(filename)
+    )
+    if not stem.strip("_. "):
+        # Nothing of the name survived, e.g. one written entirely in CJK
+        stem = "download"
+    fallback = stem + extension
+    return f"{disposition}; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
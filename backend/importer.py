@@ -0,0 +1,311 @@
+import csv
+import io
+import json
+import time
+from datetime import datetime
+from pydantic import ValidationError
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from models import Patient, Visit
+from schemas import PatientCreate, VisitCreate
+import cache
+import crud
+import stats
+
+# Bulk import of patients and visits from NDJSON or CSV.
+# Rows are read from a stream one at a time, validated with the normal
+# Pydantic schemas and written in batches - one executemany (or COPY on
+# PostgreSQL) and one commit per batch - so memory stays flat and each
+# row doesn't pay for its own transaction.
+#
+# A body that can't be read on (malformed CSV, invalid UTF-8) stops the
+# import with an ImportStreamError naming the line. Rows before it have been
+# processed - batches already committed stay committed - so the report says
+# how many were imported and the client can resume from that line.
+
+IMPORT_KINDS = {
+    "patients": (PatientCreate, Patient),
+    "visits": (VisitCreate, Visit),
+}
+IMPORT_FORMATS = ("ndjson", "csv")
+
+DEFAULT_BATCH_SIZE = 5000
+MAX_REPORTED_ERRORS = 1000
+
+
+class _BodyReader(io.RawIOBase):
+    """Adapts an iterator of byte chunks to a readable binary stream"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            try:
+                self._pending = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+class ImportStreamError(ValueError):
+    """The stream can't be read past line; report is the import up to there"""
+
+    def __init__(self, line: int, message: str, report: dict = None):
+        super().__init__(message)
+        self.line = line
+        self.report = report
+
+
+def open_chunks(chunks):
+    """Wrap an iterator of byte chunks (e.g. a request body) as a binary stream"""
+    return io.BufferedReader(_BodyReader(chunks))
+
+
+class _Lines:
+    """UTF-8 lines of a binary stream, decoded one at a time so a bad byte is reported with its line"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.line_number = 0
+
+    def __iter__(self):
+        for line in self.stream:
+            self.line_number += 1
+            try:
+                yield line.decode("utf-8")
+            except UnicodeDecodeError as e:
+                raise ImportStreamError(self.line_number, f"Invalid UTF-8: {e.reason} at byte {e.start}")
+
+
+def read_rows(stream, fmt: str):
+    """
+    Yield (line_number, row) pairs from a binary stream.
+    Rows that can't be parsed are yielded as (line_number, ValueError);
+    raises ImportStreamError if the stream can't be read on.
+    """
+    lines = _Lines(stream)
+    if fmt == "ndjson":
+        for line in lines:
+            line_number = lines.line_number
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+                if not isinstance(row, dict):
+                    raise ValueError("Expected a JSON object")
+                yield line_number, row
+            except ValueError as e:
+                yield line_number, ValueError(f"Invalid JSON: {e}")
+    elif fmt == "csv":
+        reader = csv.DictReader(lines)
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                raise ImportStreamError(lines.line_number, f"Invalid CSV: {e}")
+            # Empty CSV cells mean "not provided"
+            yield reader.line_num, {key: (value if value != "" else None) for key, value in row.items()}
+    else:
+        raise ValueError(f"Invalid format: {fmt}")
+
+
+def _insert_rows(db: Session, model, values):
+    """Write one batch of rows with a single statement"""
+    if db.get_bind().dialect.name == "postgresql":
+        _copy_rows(db, model.__tablename__, values)
+    else:
+        # Core insert on the connection -> a plain DBAPI executemany
+        db.connection().execute(insert(model.__table__), values)
+
+
+def _copy_rows(db: Session, table: str, values):
+    """Write one batch of rows with PostgreSQL COPY"""
+    columns = list(values[0])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in values:
+        writer.writerow(["\\N" if row[column] is None else row[column] for column in columns])
+    buffer.seek(0)
+
+    cursor = db.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+        buffer
+    )
+
+
+class BulkImporter:
+    """Validates and writes rows of one kind in batches, collecting a report"""
+
+    def __init__(self, db: Session, kind: str, batch_size: int = DEFAULT_BATCH_SIZE):
+        if kind not in IMPORT_KINDS:
+            raise ValueError(f"Invalid import kind: {kind}")
+        self.db = db
+        self.kind = kind
+        self.schema, self.model = IMPORT_KINDS[kind]
+        self.batch_size = batch_size
+        self.rows = 0
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self.started = time.perf_counter()
+        self._batch = []
+        self._patients = {}
+
+    def _error(self, line_number: int, message: str):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line_number, "error": message})
+
+    def add(self, line_number: int, row):
+        """Queue one parsed row, flushing when the batch is full"""
+        self.rows += 1
+        if isinstance(row, Exception):
+            self._error(line_number, str(row))
+        else:
+            self._batch.append((line_number, row))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Validate and write the queued batch in one transaction"""
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+
+        now = datetime.utcnow()
+        valid = []
+        for line_number, row in batch:
+            try:
+                item = self.schema.model_validate(row)
+            except ValidationError as e:
+                errors = "; ".join(
+                    f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in e.errors()
+                )
+                self._error(line_number, errors)
+                continue
+            values = item.model_dump()
+            values["created_at"] = now
+            if self.kind == "patients":
+                values["updated_at"] = now
+            valid.append((line_number, values))
+
+        if self.kind == "patients" and valid:
+            mrns = crud.generate_mrns(self.db, len(valid))
+            for (_, values), mrn in zip(valid, mrns):
+                values["medical_record_number"] = mrn
+
+        if self.kind == "visits" and valid:
+            # Report rows pointing at missing patients instead of failing the batch
+            patient_ids = {values["patient_id"] for _, values in valid}
+            self._patients = {
+                patient_id: (gender, date_of_birth) for patient_id, gender, date_of_birth in
+                self.db.query(Patient.id, Patient.gender, Patient.date_of_birth)
+                .filter(Patient.id.in_(patient_ids)).all()
+            }
+            checked = []
+            for line_number, values in valid:
+                if values["patient_id"] in self._patients:
+                    checked.append((line_number, values))
+                else:
+                    self._error(line_number, "Patient not found")
+            valid = checked
+
+        if not valid:
+            return
+        try:
+            rows = [values for _, values in valid]
+            _insert_rows(self.db, self.model, rows)
+            self._record_stats(rows)
+            self.db.commit()
+            self.imported += len(valid)
+            if self.kind == "visits":
+                for patient_id in {row["patient_id"] for row in rows}:
+                    cache.invalidate_patient(patient_id)
+        except Exception as e:
+            self.db.rollback()
+            for line_number, _ in valid:
+                self._error(line_number, f"Batch failed: {e.__class__.__name__}")
+
+    def _record_stats(self, rows):
+        """Update the materialized statistics for a written batch"""
+        days = {}
+        if self.kind == "patients":
+            for row in rows:
+                days[row["created_at"].date()] = days.get(row["created_at"].date(), 0) + 1
+            stats.bump(self.db, {"patients": len(rows)}, new_patients=days)
+        else:
+            for row in rows:
+                days[row["visit_date"].date()] = days.get(row["visit_date"].date(), 0) + 1
+            stats.bump(self.db, {"visits": len(rows)}, visits=days)
+            stats.bump_rollups(self.db, stats.rollup_deltas(
+                (row["visit_date"], row["reason"], *self._patients[row["patient_id"]]) for row in rows
+            ))
+
+    def report(self):
+        """Summary of the import so far"""
+        seconds = time.perf_counter() - self.started
+        return {
+            "kind": self.kind,
+            "rows": self.rows,
+            "imported": self.imported,
+            "failed": self.failed,
+            "errors": sorted(self.errors, key=lambda error: error["line"]),
+            "errors_truncated": self.failed > len(self.errors),
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(self.imported / seconds, 1) if seconds > 0 else 0,
+        }
+
+
+def import_stream(db: Session, kind: str, stream, fmt: str = "ndjson", batch_size: int = DEFAULT_BATCH_SIZE):
+    """
+    Import every row from a binary stream and return the report.
+    Raises ImportStreamError, carrying the report, if the stream turns out
+    to be unreadable part way; the rows before it are imported first.
+    """
+    if fmt not in IMPORT_FORMATS:
+        raise ValueError(f"Invalid format: {fmt}")
+    importer = BulkImporter(db, kind, batch_size=batch_size)
+    try:
+        for line_number, row in read_rows(stream, fmt):
+            importer.add(line_number, row)
+    except ImportStreamError as e:
+        importer.flush()
+        e.report = importer.report()
+        raise
+    importer.flush()
+    return importer.report()
+
+
+if __name__ == "__main__":
+    import argparse
+    from database import SessionLocal, init_db
+
+    parser = argparse.ArgumentParser(description="Bulk import patients or visits")
+    parser.add_argument("kind", choices=sorted(IMPORT_KINDS))
+    parser.add_argument("path", help="NDJSON or CSV file")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, help="Defaults to the file extension")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    fmt = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+    init_db()
+    db = SessionLocal()
+    try:
+        with open(args.path, "rb") as f:
+            report = import_stream(db, args.kind, f, fmt, batch_size=args.batch_size)
+    except ImportStreamError as e:
+        report = {"error": str(e), "line": e.line, **e.report}
+    finally:
+        db.close()
+    print(json.dumps(report, indent=2))
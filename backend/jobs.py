@@ -0,0 +1,284 @@
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.orm import Session
+from models import Document, DocumentJob
+import cache
+import extraction
+
+# Background document processing.
+# Uploading a file enqueues a row in document_jobs in the same transaction
+# as the document itself, so there's no external broker and no job is lost
+# if the process dies right after the upload. Workers claim batches of jobs
+# with SELECT ... FOR UPDATE SKIP LOCKED, so any number of them (in app
+# processes or standalone via "python jobs.py") can share the queue without
+# handing out the same job twice.
+#
+# Run one standalone worker per host. A worker inside the app
+# (JOB_WORKER_IN_APP) is only for single-process setups such as local
+# development: every uvicorn worker would start its own pool of JOB_WORKERS
+# processes, multiplying the extraction processes competing for the CPUs.
+#
+# Extraction is CPU-bound, so it runs in a process pool; the thread feeding
+# the pool only waits on futures and the database, which keeps it off the
+# event loop and away from request threads.
+
+# Extraction processes per worker (0 also disables the worker inside the app)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", str(min(os.cpu_count() or 1, 4))))
+# Also run a worker inside each app process (single-process setups only)
+JOB_WORKER_IN_APP = os.getenv("JOB_WORKER_IN_APP", "false").lower() in ("1", "true", "yes")
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_SECONDS = int(os.getenv("JOB_RETRY_SECONDS", "30"))  # doubled on each retry
+JOB_LOCK_TIMEOUT = int(os.getenv("JOB_LOCK_TIMEOUT", "600"))  # reclaim jobs from dead workers
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+
+logger = logging.getLogger(__name__)
+
+
+# ============= QUEUE =============
+
+def enqueue(db: Session, document: Document):
+    """Queue a document for processing. Commits with the caller's transaction."""
+    if document.id is None:
+        db.flush()
+    document.processing_status = "queued"
+    db.add(DocumentJob(document_id=document.id))
+
+
+def claim(db: Session, limit: int, worker: str):
+    """
+    Mark up to limit runnable jobs as running and return them as
+    (job_id, document_id, patient_id, attempts, sha256, file_type) rows.
+    """
+    now = datetime.utcnow()
+    runnable = (
+        select(DocumentJob.id)
+        .where(or_(
+            and_(DocumentJob.status == "queued", DocumentJob.run_after <= now),
+            # Running for too long - the worker holding it has died
+            and_(DocumentJob.status == "running", DocumentJob.locked_at < now - timedelta(seconds=JOB_LOCK_TIMEOUT)),
+        ))
+        .order_by(DocumentJob.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    claimed = db.execute(
+        update(DocumentJob)
+        .where(DocumentJob.id.in_(runnable))
+        .values(status="running", locked_at=now, locked_by=worker, attempts=DocumentJob.attempts + 1)
+        .returning(DocumentJob.id, DocumentJob.document_id, DocumentJob.attempts)
+        .execution_options(synchronize_session=False)
+    ).all()
+    if not claimed:
+        db.commit()
+        return []
+
+    documents = {
+        row.id: row for row in db.execute(
+            select(Document.id, Document.patient_id, Document.sha256, Document.file_type)
+            .where(Document.id.in_([job.document_id for job in claimed]))
+        )
+    }
+    db.execute(
+        update(Document)
+        .where(Document.id.in_(list(documents)))
+        .values(processing_status="processing")
+        .execution_options(synchronize_session=False)
+    )
+    # The document was deleted after the job was queued
+    orphaned = [job.id for job in claimed if job.document_id not in documents]
+    if orphaned:
+        db.execute(
+            update(DocumentJob)
+            .where(DocumentJob.id.in_(orphaned))
+            .values(status="failed", finished_at=now, last_error="Document deleted")
+        )
+    db.commit()
+
+    jobs = []
+    for job_id, document_id, attempts in claimed:
+        document = documents.get(document_id)
+        if document is not None:
+            jobs.append((job_id, document_id, document.patient_id, attempts, document.sha256, document.file_type))
+    return jobs
+
+
+def complete(db: Session, job, result: dict):
+    """Store the extraction result and finish the job"""
+    job_id, document_id, patient_id = job[:3]
+    now = datetime.utcnow()
+    db.execute(
+        update(Document).where(Document.id == document_id).values(
+            processing_status="done",
+            extracted_text=result["text"],
+            extracted_metadata=result["metadata"],
+            processed_at=now,
+        )
+    )
+    db.execute(
+        update(DocumentJob).where(DocumentJob.id == job_id)
+        .values(status="done", finished_at=now, last_error=None)
+    )
+    db.commit()
+    cache.invalidate_patient(patient_id)
+
+
+def fail(db: Session, job, error: str):
+    """Record a failed attempt; retry with backoff until attempts run out. Returns True if retried."""
+    job_id, document_id, patient_id, attempts = job[:4]
+    now = datetime.utcnow()
+    retry = attempts < JOB_MAX_ATTEMPTS
+    if retry:
+        values = {"status": "queued", "run_after": now + timedelta(seconds=JOB_RETRY_SECONDS * 2 ** (attempts - 1))}
+    else:
+        values = {"status": "failed", "finished_at": now}
+        db.execute(update(Document).where(Document.id == document_id).values(processing_status="failed"))
+    db.execute(update(DocumentJob).where(DocumentJob.id == job_id).values(last_error=error[:2000], **values))
+    db.commit()
+    if not retry:
+        cache.invalidate_patient(patient_id)
+    return retry
+
+
+def get_queue_stats(db: Session):
+    """Job counts per status and the age of the oldest runnable job"""
+    counts = dict(db.execute(select(DocumentJob.status, func.count()).group_by(DocumentJob.status)).all())
+    oldest = db.execute(
+        select(func.min(DocumentJob.created_at)).where(DocumentJob.status == "queued")
+    ).scalar()
+    return {
+        "queued": counts.get("queued", 0),
+        "running": counts.get("running", 0),
+        "done": counts.get("done", 0),
+        "failed": counts.get("failed", 0),
+        "oldest_queued_seconds": round((datetime.utcnow() - oldest).total_seconds(), 1) if oldest else 0,
+    }
+
+
+# ============= WORKER =============
+
+class JobWorker:
+    """Feeds claimed jobs to a process pool and records the results"""
+
+    def __init__(self, session_factory, processes: int = JOB_WORKERS):
+        self.session_factory = session_factory
+        self.processes = max(processes, 1)
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self._stop = threading.Event()
+
+    def _count(self, name: str, seconds: float):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+            self.busy_seconds += seconds
+
+    def metrics(self):
+        """Throughput since the worker started"""
+        elapsed = time.monotonic() - self.started_at
+        finished = self.completed + self.failed
+        return {
+            "worker": self.name,
+            "processes": self.processes,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+            "jobs_per_second": round(finished / elapsed, 3) if elapsed else 0,
+            "avg_job_seconds": round(self.busy_seconds / (finished + self.retried), 4) if finished + self.retried else 0,
+            "uptime_seconds": round(elapsed, 1),
+        }
+
+    def _finish(self, db: Session, job, future, submitted: float):
+        seconds = time.monotonic() - submitted
+        try:
+            result = future.result()
+        except Exception as e:
+            retried = fail(db, job, f"{type(e).__name__}: {e}")
+            self._count("retried" if retried else "failed", seconds)
+        else:
+            complete(db, job, result)
+            self._count("completed", seconds)
+
+    def run(self):
+        """Process jobs until stop() is called"""
+        # spawn, not fork: the parent has threads and open database connections
+        context = multiprocessing.get_context("spawn")
+        in_flight = {}  # future -> (job, submitted_at)
+        db = self.session_factory()
+        try:
+            with ProcessPoolExecutor(max_workers=self.processes, mp_context=context) as pool:
+                while not self._stop.is_set() or in_flight:
+                    # Keep every process busy with one job queued behind it
+                    free = 2 * self.processes - len(in_flight)
+                    if free > 0 and not self._stop.is_set():
+                        try:
+                            for job in claim(db, free, self.name):
+                                future = pool.submit(extraction.extract_document, job[4], job[5])
+                                in_flight[future] = (job, time.monotonic())
+                        except Exception:
+                            db.rollback()
+                            logger.exception("Job claim failed")
+
+                    if not in_flight:
+                        self._stop.wait(JOB_POLL_SECONDS)
+                        continue
+                    done, _ = wait(in_flight, timeout=JOB_POLL_SECONDS, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        job, submitted = in_flight.pop(future)
+                        try:
+                            self._finish(db, job, future, submitted)
+                        except Exception:
+                            # Left running; reclaimed after JOB_LOCK_TIMEOUT
+                            db.rollback()
+                            logger.exception("Job %s result could not be saved", job[0])
+        finally:
+            db.close()
+
+    def stop(self):
+        """Stop claiming jobs; run() returns once in-flight jobs finish"""
+        self._stop.set()
+
+
+worker = None
+
+
+def start_worker_thread(session_factory, processes: int = JOB_WORKERS):
+    """Run a JobWorker in a daemon thread of this process"""
+    global worker
+    if processes <= 0 or not JOB_WORKER_IN_APP:
+        return None
+    worker = JobWorker(session_factory, processes)
+    thread = threading.Thread(target=worker.run, name="document-jobs", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    import sys
+    from database import SessionLocal, init_db
+
+    if sys.argv[1:] == ["stats"]:
+        db = SessionLocal()
+        try:
+            print(get_queue_stats(db))
+        finally:
+            db.close()
+    else:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+        init_db()
+        standalone = JobWorker(SessionLocal, max(JOB_WORKERS, 1))
+        print(f"Processing documents with {standalone.processes} processes (Ctrl+C to stop)")
+        try:
+            standalone.run()
+        except KeyboardInterrupt:
+            print(standalone.metrics())
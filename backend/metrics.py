@@ -0,0 +1,425 @@
+import functools
+import inspect
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+
+# Request instrumentation.
+# MetricsMiddleware times every request and, through SQLAlchemy cursor
+# events, how many queries it ran and how long the database took.
+# InstrumentedRoute marks when the endpoint function returned, so the time
+# from there until the response starts - response model validation and JSON
+# encoding - is counted as serialization (plus any encoding done inside the
+# endpoint through serialization.dumps). Everything is aggregated per route
+# template and served in Prometheus text format from /metrics.
+#
+# Queries slower than SLOW_QUERY_MS are logged with their EXPLAIN plan.
+#
+# With PROFILE_TOKEN set, a request sent with "X-Profile: <token>" is run
+# under a sampling profiler and answered with the sampled stacks in collapsed
+# format (one "frame;frame;frame count" line per stack) instead of its normal
+# body - feed it to flamegraph.pl or speedscope. The request itself still
+# runs; its status is in the X-Profile-Status header.
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "true").lower() in ("1", "true", "yes")
+# Explain the same statement at most once per this many seconds
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL", "300"))
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+
+# Histogram buckets: request and query durations in seconds, queries per request
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+logger = logging.getLogger("healthplus.sql")
+
+
+# ============= REGISTRY =============
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    """A Prometheus metric with a fixed set of labels"""
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class CounterMetric(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return self.header() + [f"{self.name}{_labels(self.labels, key)} {value:g}" for key, value in values]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.series = {}  # labels -> [bucket counts..., count, sum]
+
+    def observe(self, value: float, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        with self.lock:
+            series = sorted((key, list(values)) for key, values in self.series.items())
+        lines = self.header()
+        names = self.labels + ("le",)
+        for key, values in series:
+            for bound, count in zip(self.buckets, values):
+                lines.append(f"{self.name}_bucket{_labels(names, key + (f'{bound:g}',))} {count}")
+            lines.append(f"{self.name}_bucket{_labels(names, key + ('+Inf',))} {values[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {values[-2]}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {values[-1]:g}")
+        return lines
+
+
+def render_values(name: str, help: str, samples, kind: str = "gauge"):
+    """Prometheus lines for values kept elsewhere; samples is a list of (labels dict, value)"""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{_labels(tuple(labels), tuple(labels.values()))} {value:g}")
+    return lines
+
+
+REQUESTS = CounterMetric("http_requests_total", "Requests handled", ("method", "route", "status"))
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Request latency", ("method", "route"))
+REQUEST_DB_SECONDS = Histogram("http_request_db_seconds", "Database time per request", ("method", "route"))
+REQUEST_DB_QUERIES = Histogram(
+    "http_request_db_queries", "Database queries per request", ("method", "route"), QUERY_COUNT_BUCKETS
+)
+REQUEST_SERIALIZE_SECONDS = Histogram(
+    "http_request_serialization_seconds", "Response serialization time per request", ("method", "route")
+)
+DB_QUERIES = CounterMetric("db_queries_total", "Database queries, including background work", ("engine",))
+DB_SECONDS = CounterMetric("db_query_seconds_total", "Database query time, including background work", ("engine",))
+DB_SLOW_QUERIES = CounterMetric("db_slow_queries_total", "Queries slower than SLOW_QUERY_MS", ("engine",))
+DB_READS = CounterMetric("db_read_sessions_total", "Read-only sessions by the database that served them", ("target",))
+
+METRICS = [
+    REQUESTS, REQUEST_SECONDS, REQUEST_DB_SECONDS, REQUEST_DB_QUERIES, REQUEST_SERIALIZE_SECONDS,
+    DB_QUERIES, DB_SECONDS, DB_SLOW_QUERIES, DB_READS,
+]
+
+
+def render(extra_lines=()):
+    """All metrics in Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    lines += extra_lines
+    return "\n".join(lines) + "\n"
+
+
+# ============= PER-REQUEST STATS =============
+
+class RequestStats:
+    """Timings collected while handling one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.endpoint_done = None
+        self.threads = {threading.get_ident()}  # threads the request ran on, for the profiler
+
+
+# Copied into threadpool workers with the rest of the context, so sync
+# endpoints and their queries update the same object
+current = ContextVar("request_stats", default=None)
+
+
+class timed_serialization:
+    """Context manager adding the time spent in it to the request's serialization time"""
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        stats = current.get()
+        if stats is not None:
+            stats.serialize_seconds += time.perf_counter() - self.started
+
+
+# ============= QUERY EVENTS =============
+
+_explained = {}  # statement -> last time it was explained
+_explain_lock = threading.Lock()
+
+
+def _explain(conn, statement: str, parameters):
+    """EXPLAIN a statement on the connection that just ran it; returns plan lines"""
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        explain = "EXPLAIN QUERY PLAN " + statement
+    elif dialect == "postgresql":
+        explain = "EXPLAIN " + statement
+    else:
+        return []
+    # Straight on the DBAPI connection, so this doesn't fire the events again.
+    # On PostgreSQL a failing statement aborts the transaction, hence the savepoint.
+    raw = conn.connection.cursor()
+    savepoint = dialect == "postgresql" and conn.in_transaction()
+    try:
+        if savepoint:
+            raw.execute("SAVEPOINT explain_slow_query")
+        try:
+            raw.execute(explain, parameters)
+            rows = raw.fetchall()
+        except Exception:
+            if savepoint:
+                raw.execute("ROLLBACK TO SAVEPOINT explain_slow_query")
+            raise
+        if savepoint:
+            raw.execute("RELEASE SAVEPOINT explain_slow_query")
+    finally:
+        raw.close()
+    return [row[-1] for row in rows]
+
+
+def _should_explain(statement: str):
+    if not SLOW_QUERY_EXPLAIN:
+        return False
+    if statement.lstrip().split(None, 1)[0].upper() not in ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE"):
+        return False
+    now = time.monotonic()
+    with _explain_lock:
+        if now - _explained.get(statement, -SLOW_QUERY_EXPLAIN_INTERVAL) < SLOW_QUERY_EXPLAIN_INTERVAL:
+            return False
+        _explained[statement] = now
+    return True
+
+
+def instrument_engine(engine, name: str = "sync"):
+    """Count and time every query on an engine and log slow ones"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        DB_QUERIES.inc(name)
+        DB_SECONDS.inc(name, amount=elapsed)
+        stats = current.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += elapsed
+        if elapsed * 1000 < SLOW_QUERY_MS:
+            return
+        DB_SLOW_QUERIES.inc(name)
+        plan = []
+        if not executemany and _should_explain(statement):
+            try:
+                plan = _explain(conn, statement, parameters)
+            except Exception as e:
+                plan = [f"(EXPLAIN failed: {e})"]
+        logger.warning(
+            "Slow query (%.1f ms):\n%s%s", elapsed * 1000, statement,
+            "".join(f"\n  {line}" for line in plan),
+        )
+
+    # A failed query never reaches after_cursor_execute
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            started.pop()
+
+
+# ============= PROFILER =============
+
+class Sampler:
+    """Samples the stacks of a request's threads on a background thread"""
+
+    def __init__(self, stats: RequestStats, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.stats = stats
+        self.interval = interval
+        self.counts = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="request-profiler", daemon=True)
+
+    @staticmethod
+    def _stack(frame):
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(frames))
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for ident in list(self.stats.threads):
+                if ident != own and ident in frames:
+                    self.counts[self._stack(frames[ident])] += 1
+            self.samples += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def collapsed(self):
+        """Stacks in collapsed format, most sampled first"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+
+# ============= MIDDLEWARE =============
+
+def route_label(scope):
+    """Route template the request matched, so labels don't grow with ids"""
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording per-route latency, DB and serialization time"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = current.set(stats)
+        status = 500
+        sampler = None
+        buffered = []
+        if PROFILE_TOKEN:
+            for key, value in scope["headers"]:
+                if key == b"x-profile" and value.decode() == PROFILE_TOKEN:
+                    sampler = Sampler(stats)
+                    sampler.start()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if stats.endpoint_done is not None:
+                    stats.serialize_seconds += time.perf_counter() - stats.endpoint_done
+            if sampler is not None:
+                buffered.append(message)
+            else:
+                await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current.reset(token)
+            elapsed = time.perf_counter() - stats.started
+            labels = (scope["method"], route_label(scope))
+            REQUESTS.inc(*labels, str(status))
+            REQUEST_SECONDS.observe(elapsed, *labels)
+            REQUEST_DB_SECONDS.observe(stats.db_seconds, *labels)
+            REQUEST_DB_QUERIES.observe(stats.queries, *labels)
+            REQUEST_SERIALIZE_SECONDS.observe(stats.serialize_seconds, *labels)
+            if sampler is not None:
+                sampler.stop()
+
+        if sampler is not None:
+            body = sampler.collapsed().encode()
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"text/plain; charset=utf-8"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"x-profile-status", str(status).encode()),
+                    (b"x-profile-samples", str(sampler.samples).encode()),
+                    (b"x-profile-seconds", f"{elapsed:.3f}".encode()),
+                    (b"x-profile-db-queries", str(stats.queries).encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+
+
+class InstrumentedRoute(APIRoute):
+    """Route that records when its endpoint returned and which thread ran it"""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        if getattr(endpoint, "instrumented", False):
+            # Already wrapped - a router's route being included into the app
+            wrapped = endpoint
+        elif inspect.iscoroutinefunction(endpoint):
+            @functools.wraps(endpoint)
+            async def wrapped(*args, **kw):
+                try:
+                    return await endpoint(*args, **kw)
+                finally:
+                    _endpoint_done()
+        else:
+            @functools.wraps(endpoint)
+            def wrapped(*args, **kw):
+                # Sync endpoints run on a threadpool thread; profile it while they do
+                stats = current.get()
+                ident = threading.get_ident()
+                if stats is not None:
+                    stats.threads.add(ident)
+                try:
+                    return endpoint(*args, **kw)
+                finally:
+                    _endpoint_done()
+                    if stats is not None:
+                        stats.threads.discard(ident)
+        wrapped.instrumented = True
+        super().__init__(path, wrapped, **kwargs)
+
+
+def _endpoint_done():
+    stats = current.get()
+    if stats is not None:
+        stats.endpoint_done = time.perf_counter()
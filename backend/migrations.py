@@ -0,0 +1,211 @@
+import hashlib
+import logging
+from datetime import datetime
+from sqlalchemy import insert, inspect, select, text, update
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.schema import CreateIndex, CreateTable
+from models import Base, SchemaFingerprint, SchemaMigration
+import changes
+import partitions
+import search
+
+# Schema migrations.
+# Base.metadata.create_all only creates missing tables - it never changes a
+# table that already exists. Changes to existing tables (such as new indexes)
+# go here as numbered migrations. Each one is applied once and recorded in
+# schema_migrations.
+#
+# Migrations marked online run outside a transaction so that on PostgreSQL
+# indexes can be built with CREATE INDEX CONCURRENTLY, which doesn't block
+# writes to the table while it runs. Every step must be idempotent (IF NOT
+# EXISTS), because on a fresh database create_all has already built
+# everything the models declare.
+#
+# Fast boot: after a full init_db the database records a fingerprint of the
+# schema this code sets up - the models' tables and indexes, the migrations,
+# the search index and change log DDL, the partitioning settings. When
+# DB_FAST_BOOT is on and the fingerprint still matches, init_db skips all of
+# that (create_all alone reflects every table), which matters on a
+# container that is started on demand. Any change to the schema code changes
+# the fingerprint, so the first boot after a deploy still does the full run.
+
+logger = logging.getLogger(__name__)
+
+
+def create_index(conn, name: str, table: str, columns: str):
+    """Create an index if it doesn't exist, concurrently on PostgreSQL"""
+    if conn.dialect.name == "postgresql":
+        # A failed CONCURRENTLY build leaves an invalid index behind that
+        # IF NOT EXISTS would skip - drop it so the build is retried
+        invalid = conn.execute(text(
+            "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"
+        ), {"name": name}).first()
+        if invalid:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})"))
+    else:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+
+
+def add_secondary_indexes(conn):
+    """Indexes for per-patient lookups, date-range analytics and cascade deletes"""
+    create_index(conn, "ix_visits_patient_id_visit_date", "visits", "patient_id, visit_date DESC")
+    create_index(conn, "ix_visits_visit_date", "visits", "visit_date")
+    create_index(conn, "ix_documents_patient_id_uploaded_at", "documents", "patient_id, uploaded_at DESC")
+    create_index(conn, "ix_patients_created_at", "patients", "created_at")
+    create_index(conn, "ix_patients_name_id", "patients", "last_name, first_name, id")
+
+
+def add_column(conn, table: str, column: str, ddl: str):
+    """Add a column if the table doesn't have it yet"""
+    existing = {c["name"] for c in inspect(conn).get_columns(table)}
+    if column not in existing:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def add_document_sha256(conn):
+    """Content hash of stored document files, used for deduplication"""
+    add_column(conn, "documents", "sha256", "VARCHAR")
+
+
+def index_document_sha256(conn):
+    """Index for looking documents up by content hash"""
+    create_index(conn, "ix_documents_sha256", "documents", "sha256")
+
+
+def add_document_processing(conn):
+    """Results of background document processing"""
+    add_column(conn, "documents", "processing_status", "VARCHAR")
+    add_column(conn, "documents", "extracted_text", "TEXT")
+    add_column(conn, "documents", "extracted_metadata", "JSON")
+    add_column(conn, "documents", "processed_at", "TIMESTAMP")
+
+
+def add_export_indexes(conn):
+    """Indexes for incremental (updated_since) exports"""
+    create_index(conn, "ix_patients_updated_at", "patients", "updated_at")
+    create_index(conn, "ix_visits_created_at", "visits", "created_at")
+
+
+def move_change_feed_position(conn):
+    """Move the pruned change feed position out of stat_counters, whose Integer value overflows on txids"""
+    counters = dict(conn.execute(text(
+        "SELECT name, value FROM stat_counters WHERE name IN ('changes_pruned_txid', 'changes_pruned_id')"
+    )).all())
+    if counters and conn.execute(text("SELECT 1 FROM change_feed_position WHERE id = 1")).first() is None:
+        conn.execute(text(
+            "INSERT INTO change_feed_position (id, pruned_txid, pruned_change_id) VALUES (1, :txid, :change_id)"
+        ), {"txid": counters.get("changes_pruned_txid", 0), "change_id": counters.get("changes_pruned_id", 0)})
+    conn.execute(text("DELETE FROM stat_counters WHERE name IN ('changes_pruned_txid', 'changes_pruned_id')"))
+
+
+# (version, function, online) - append new migrations to the end
+MIGRATIONS = [
+    ("0001_secondary_indexes", add_secondary_indexes, True),
+    ("0002_document_sha256", add_document_sha256, False),
+    ("0003_document_sha256_index", index_document_sha256, True),
+    ("0004_document_processing", add_document_processing, False),
+    ("0005_export_indexes", add_export_indexes, True),
+    ("0006_change_feed_position", move_change_feed_position, False),
+]
+
+
+def get_applied(engine):
+    """Versions already applied to the database"""
+    with engine.connect() as conn:
+        return {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+
+# Arbitrary key for the PostgreSQL advisory lock that serializes migration runs
+MIGRATION_LOCK_ID = 730114
+
+
+def run_migrations(engine):
+    """Apply every pending migration in order"""
+    SchemaMigration.__table__.create(bind=engine, checkfirst=True)
+    if len(get_applied(engine)) == len(MIGRATIONS):
+        return
+
+    lock_conn = None
+    if engine.dialect.name == "postgresql":
+        # Several workers may boot at once; only one of them migrates
+        lock_conn = engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        lock_conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+    try:
+        applied = get_applied(engine)
+        for version, migrate, online in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info("Applying migration %s", version)
+            record = SchemaMigration.__table__.insert().values(version=version, applied_at=datetime.utcnow())
+            if online:
+                with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                    migrate(conn)
+                with engine.begin() as conn:
+                    conn.execute(record)
+            else:
+                with engine.begin() as conn:
+                    migrate(conn)
+                    conn.execute(record)
+    finally:
+        if lock_conn is not None:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+            lock_conn.close()
+
+
+# ============= FAST BOOT =============
+
+def schema_fingerprint(dialect):
+    """Hash of everything a full init_db sets up on dialect"""
+    parts = [dialect.name]
+    for table in Base.metadata.sorted_tables:
+        parts.append(str(CreateTable(table).compile(dialect=dialect)))
+        parts += sorted(str(CreateIndex(index).compile(dialect=dialect)) for index in table.indexes)
+    parts += [version for version, _, _ in MIGRATIONS]
+    parts += search.search_index_ddl(dialect.name) + changes.change_log_ddl(dialect.name)
+    if dialect.name in ("postgresql", "sqlite"):
+        parts.append(f"partitioning={partitions.VISIT_PARTITIONING} period={partitions.get_period(dialect.name)}")
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def get_fingerprint(engine):
+    """Fingerprint recorded by the last full init_db, or None"""
+    try:
+        with engine.connect() as conn:
+            return conn.execute(select(SchemaFingerprint.fingerprint).where(SchemaFingerprint.id == 1)).scalar()
+    except DBAPIError:
+        # A database that predates fast boot, or a new one
+        return None
+
+
+def record_fingerprint(engine, fingerprint: str):
+    """Record that the schema with this fingerprint is fully set up"""
+    values = {"fingerprint": fingerprint, "recorded_at": datetime.utcnow()}
+    try:
+        with engine.begin() as conn:
+            if not conn.execute(update(SchemaFingerprint).where(SchemaFingerprint.id == 1).values(**values)).rowcount:
+                conn.execute(insert(SchemaFingerprint).values(id=1, **values))
+    except IntegrityError:
+        # Another worker recorded it first
+        pass
+
+
+if __name__ == "__main__":
+    import sys
+    from database import engine
+
+    if sys.argv[1:] == ["status"]:
+        SchemaMigration.__table__.create(bind=engine, checkfirst=True)
+        applied = get_applied(engine)
+        for version, _, _ in MIGRATIONS:
+            print(f"{'applied' if version in applied else 'pending'}  {version}")
+        fingerprint = get_fingerprint(engine)
+        if fingerprint is None:
+            print("fingerprint not recorded")
+        else:
+            print(f"fingerprint {'current' if fingerprint == schema_fingerprint(engine.dialect) else 'stale'}")
+    else:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+        run_migrations(engine)
+        print("Migrations up to date")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, BigInteger, String, Date, DateTime, ForeignKey, Text, Index, JSON
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -54,6 +54,15 @@ class Patient(Base):
     visits = relationship("Visit", back_populates="patient", cascade="all, delete-orphan")
     documents = relationship("Document", back_populates="patient", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # Serves keyset pagination ordered by name
+        Index("ix_patients_name_id", "last_name", "first_name", "id"),
+        # New-patient windows in analytics
+        Index("ix_patients_created_at", "created_at"),
+        # Incremental exports (updated_since)
+        Index("ix_patients_updated_at", "updated_at"),
+    )
+
 
 class Visit(Base):
     """Visit/Appointment model"""
@@ -73,6 +82,15 @@ class Visit(Base):
     # Relationship
     patient = relationship("Patient", back_populates="visits")
 
+    __table_args__ = (
+        # A patient's visits, newest first; also serves cascade deletes
+        Index("ix_visits_patient_id_visit_date", patient_id, visit_date.desc()),
+        # Date-range analytics (30-day windows, reconcile)
+        Index("ix_visits_visit_date", visit_date),
+        # Incremental exports - visits are never edited, so updated_since means created since
+        Index("ix_visits_created_at", created_at),
+    )
+
 
 class Document(Base):
     """Document/File model"""
@@ -85,9 +103,192 @@ class Document(Base):
     file_type = Column(String)  # pdf, jpg, png, etc.
     file_url = Column(String, nullable=False)  # Local path or Azure Blob URL
     file_size = Column(Integer)  # in bytes
+    sha256 = Column(String, index=True)  # content hash, set for files uploaded through the API
     description = Column(Text)
     
     uploaded_at = Column(DateTime, default=datetime.utcnow)
+
+    # Filled in by the background processing worker (jobs.py)
+    processing_status = Column(String)  # queued, processing, done, failed
+    extracted_text = Column(Text)
+    extracted_metadata = Column(JSON)
+    processed_at = Column(DateTime)
     
     # Relationship
-    patient = relationship("Patient", back_populates="documents")
\ No newline at end of file
+    patient = relationship("Patient", back_populates="documents")
+
+    __table_args__ = (
+        # A patient's documents, newest first; also serves cascade deletes
+        Index("ix_documents_patient_id_uploaded_at", patient_id, uploaded_at.desc()),
+    )
+
+
+class MRNCounter(Base):
+    """Single-row counter that MRN serial numbers are reserved from in blocks"""
+    __tablename__ = "mrn_counter"
+
+    id = Column(Integer, primary_key=True)
+    next_value = Column(Integer, nullable=False, default=1)
+
+
+class StatCounter(Base):
+    """Running totals behind /api/analytics/stats, kept up to date by the CRUD layer"""
+    __tablename__ = "stat_counters"
+
+    name = Column(String, primary_key=True)  # patients, visits, documents, reconciled_at
+    value = Column(Integer, nullable=False, default=0)
+
+
+class DailyStat(Base):
+    """Per-day new patient and visit counts, used for the rolling 30-day windows"""
+    __tablename__ = "daily_stats"
+
+    day = Column(Date, primary_key=True)
+    new_patients = Column(Integer, nullable=False, default=0)
+    visits = Column(Integer, nullable=False, default=0)
+
+
+class VisitRollup(Base):
+    """Visit counts per period, reason and patient demographic, kept up to date by the CRUD layer"""
+    __tablename__ = "visit_rollups"
+
+    granularity = Column(String, primary_key=True)  # day, week, month
+    period_start = Column(Date, primary_key=True)
+    reason = Column(String, primary_key=True)
+    gender = Column(String, primary_key=True)  # "Unknown" when not recorded
+    age_band = Column(String, primary_key=True)  # age at the time of the visit
+    visit_count = Column(Integer, nullable=False, default=0)
+
+
+class RollupReason(Base):
+    """A visit reason visit_rollups counts on its own - the rest are rolled up as "other" (see stats.py)"""
+    __tablename__ = "rollup_reasons"
+
+    reason = Column(String, primary_key=True)  # normalized: trimmed, lower case
+
+
+# Writes to the statistics go to these append-only tables instead of updating
+# the shared rows above, and are folded into them in the background (stats.py)
+
+class StatCounterDelta(Base):
+    """A change to stat_counters not folded in yet"""
+    __tablename__ = "stat_counter_deltas"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    value = Column(Integer, nullable=False)
+
+
+class DailyStatDelta(Base):
+    """A change to daily_stats not folded in yet"""
+    __tablename__ = "daily_stat_deltas"
+
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    new_patients = Column(Integer, nullable=False, default=0)
+    visits = Column(Integer, nullable=False, default=0)
+
+
+class VisitRollupDelta(Base):
+    """A change to visit_rollups not folded in yet"""
+    __tablename__ = "visit_rollup_deltas"
+
+    id = Column(Integer, primary_key=True)
+    granularity = Column(String, nullable=False)
+    period_start = Column(Date, nullable=False)
+    reason = Column(String, nullable=False)
+    gender = Column(String, nullable=False)
+    age_band = Column(String, nullable=False)
+    visit_count = Column(Integer, nullable=False)
+
+
+class VisitPartition(Base):
+    """One period of visits: a live partition table, or a Parquet file once it has been archived"""
+    __tablename__ = "visit_partitions"
+
+    name = Column(String, primary_key=True)  # visits_p2024_01 (month) or visits_p2024 (year)
+    range_start = Column(Date, nullable=False)
+    range_end = Column(Date, nullable=False)  # exclusive
+    status = Column(String, nullable=False, default="live")  # live, archived
+    row_count = Column(Integer)  # rows in the archive file
+    archive_path = Column(String)
+    archived_at = Column(DateTime)
+
+
+class SchemaMigration(Base):
+    """Migrations from migrations.py that have been applied to this database"""
+    __tablename__ = "schema_migrations"
+
+    version = Column(String, primary_key=True)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+
+class SchemaFingerprint(Base):
+    """Fingerprint of the schema the last full init_db set up (fast boot, see migrations.py)"""
+    __tablename__ = "schema_fingerprint"
+
+    id = Column(Integer, primary_key=True)  # always 1
+    fingerprint = Column(String, nullable=False)
+    recorded_at = Column(DateTime, default=datetime.utcnow)
+
+
+class DocumentJob(Base):
+    """Queued document processing job, claimed by workers with SKIP LOCKED"""
+    __tablename__ = "document_jobs"
+
+    id = Column(Integer, primary_key=True)
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), nullable=False)
+    status = Column(String, nullable=False, default="queued")  # queued, running, done, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    run_after = Column(DateTime, nullable=False, default=datetime.utcnow)  # pushed back between retries
+    locked_at = Column(DateTime)
+    locked_by = Column(String)
+    last_error = Column(Text)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = Column(DateTime)
+
+    __table_args__ = (
+        # Claim order for the worker's queue scan
+        Index("ix_document_jobs_status_run_after", status, run_after),
+    )
+
+
+class ChangeLog(Base):
+    """Append-only log of patient, visit and document changes, written by database triggers"""
+    __tablename__ = "change_log"
+
+    id = Column(Integer, primary_key=True)
+    txid = Column(BigInteger, nullable=False, default=0)  # writing transaction on PostgreSQL, 0 on SQLite
+    entity = Column(String, nullable=False)  # patient, visit, document
+    entity_id = Column(Integer, nullable=False)
+    patient_id = Column(Integer)
+    op = Column(String, nullable=False)  # create, update, delete
+    fields = Column(JSON)  # columns an update changed
+    changed_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Feed order - see changes.py
+        Index("ix_change_log_txid_id", txid, id),
+        Index("ix_change_log_changed_at", changed_at),
+    )
+
+
+class ChangeConsumer(Base):
+    """How far a named consumer has read the change feed"""
+    __tablename__ = "change_consumers"
+
+    name = Column(String, primary_key=True)
+    cursor = Column(String, nullable=False)
+    txid = Column(BigInteger, nullable=False, default=0)
+    change_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ChangeFeedPosition(Base):
+    """Where the change feed now starts: the newest change pruned from change_log"""
+    __tablename__ = "change_feed_position"
+
+    id = Column(Integer, primary_key=True)  # always 1
+    pruned_txid = Column(BigInteger, nullable=False, default=0)  # PostgreSQL txids outgrow int4
+    pruned_change_id = Column(Integer, nullable=False, default=0)
+    pruned_at = Column(DateTime)
@@ -0,0 +1,128 @@
+import os
+import threading
+from datetime import datetime
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+from models import MRNCounter
+
+# Medical Record Number allocation.
+# Serial numbers come from a single counter row in the database. Each process
+# reserves a block of them with one atomic UPDATE ... RETURNING and then hands
+# them out from memory, so MRNs never collide (no retry loop needed) and most
+# allocations need no database round trip at all.
+#
+# Format: MRN-YYYYMMDD-NNNNNNC, where NNNNNN is the zero-padded serial
+# (it grows past six digits if needed) and C is a Luhn check digit.
+
+MRN_BLOCK_SIZE = int(os.getenv("MRN_BLOCK_SIZE", "100"))
+MRN_SERIAL_WIDTH = 6
+
+
+def check_digit(digits: str):
+    """Luhn check digit for a string of digits"""
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        if i % 2 == 0:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return str((10 - total % 10) % 10)
+
+
+def format_mrn(serial: int, date=None):
+    """Build a human-readable MRN from a serial number"""
+    date_part = (date or datetime.now()).strftime("%Y%m%d")
+    digits = str(serial).zfill(MRN_SERIAL_WIDTH)
+    return f"MRN-{date_part}-{digits}{check_digit(digits)}"
+
+
+def is_valid_mrn(mrn: str):
+    """Check the format and check digit of an MRN issued by this module"""
+    parts = mrn.split("-")
+    if len(parts) != 3 or parts[0] != "MRN" or not parts[2].isdigit() or len(parts[2]) < 2:
+        return False
+    return check_digit(parts[2][:-1]) == parts[2][-1]
+
+
+def init_mrn_counter(engine):
+    """Create the counter row if it doesn't exist yet"""
+    try:
+        with engine.begin() as conn:
+            if conn.execute(select(MRNCounter.id).where(MRNCounter.id == 1)).first() is None:
+                conn.execute(insert(MRNCounter).values(id=1, next_value=1))
+    except IntegrityError:
+        # Another worker created it first
+        pass
+
+
+class MRNAllocator:
+    """Hands out MRNs from serial number blocks reserved in the database"""
+
+    def __init__(self, engine, block_size: int = MRN_BLOCK_SIZE):
+        self.engine = engine
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+        self._pid = None
+
+    def _reserve_block(self, size: int):
+        # Runs on its own connection and commits immediately, so a block is
+        # never handed out twice even if the caller's transaction rolls back
+        with self.engine.begin() as conn:
+            end = conn.execute(
+                update(MRNCounter)
+                .where(MRNCounter.id == 1)
+                .values(next_value=MRNCounter.next_value + size)
+                .returning(MRNCounter.next_value)
+            ).scalar_one()
+        self._next = end - size
+        self._end = end
+        self._pid = os.getpid()
+
+    def next_serials(self, count: int):
+        """Allocate count serial numbers, reserving at most one new block"""
+        with self._lock:
+            # A forked worker must not reuse the block its parent reserved
+            if self._pid != os.getpid():
+                self._next = self._end = 0
+            serials = list(range(self._next, min(self._end, self._next + count)))
+            self._next += len(serials)
+            missing = count - len(serials)
+            if missing:
+                self._reserve_block(max(self.block_size, missing))
+                serials.extend(range(self._next, self._next + missing))
+                self._next += missing
+            return serials
+
+    def next_mrns(self, count: int):
+        """Allocate count MRNs"""
+        date = datetime.now()
+        return [format_mrn(serial, date) for serial in self.next_serials(count)]
+
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+# engine -> the sync engine whose allocator it uses instead
+_shared = {}
+
+
+def share_allocator(engine, sync_engine):
+    """
+    Allocate MRNs for engine through sync_engine's allocator. Needed for an
+    async engine's sync facade: reserving a block through it would suspend
+    the caller while it holds the allocator lock, and the next allocation on
+    the same event loop would then block forever waiting for that lock.
+    """
+    _shared[engine] = sync_engine
+
+
+def get_allocator(engine):
+    """Get the allocator for an engine, creating it on first use"""
+    engine = _shared.get(engine, engine)
+    with _allocators_lock:
+        if engine not in _allocators:
+            _allocators[engine] = MRNAllocator(engine)
+        return _allocators[engine]
@@ -0,0 +1,680 @@
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import date, datetime
+from sqlalchemy import Column, MetaData, Table, event, func, insert, select, text, update
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateTable
+from models import Patient, Visit, VisitPartition
+import changes
+import search
+
+# Time-partitioned visits.
+# With VISIT_PARTITIONING=true the visits table is split by visit_date into
+# one partition per month (PostgreSQL) or year (SQLite), plus a default
+# partition for dates no partition covers. Queries on a date range only
+# touch the partitions in that range, so recent-visit queries stay fast
+# however much history there is.
+#
+# PostgreSQL: visits becomes a native declarative table, PARTITION BY RANGE
+# (visit_date), with the primary key extended to (id, visit_date). Indexes
+# and the change log trigger are declared on the parent and cloned onto
+# every partition.
+#
+# SQLite: each period is its own table (visits_p2024, ...) and visits is a
+# view over them (UNION ALL). INSTEAD OF triggers on the view route writes
+# to the right table and maintain the search index and change log. Rows
+# written through the view don't report their id back, so the ORM and batch
+# writes take ids from the visits_id_counter row up front; anything else is
+# numbered by the insert trigger. Each old partition costs one index probe
+# of a date-range query rather than a scan.
+#
+# The first start with partitioning on converts the existing table (copying
+# every row, under an exclusive lock - plan for downtime on a big table).
+# After that a maintenance thread keeps VISIT_PARTITIONS_AHEAD periods of
+# partitions ahead of today. Rows dated in a period before its partition
+# existed are moved out of the default partition when it is created.
+#
+# Archival: partitions that ended more than VISIT_ARCHIVE_AFTER_MONTHS ago
+# are written to zstd-compressed Parquet files in VISIT_ARCHIVE_DIR (sorted
+# by patient, so per-patient reads only decode matching row groups) and
+# dropped from the database. visit_partitions records every partition and
+# archive file. Archived visits are still returned by a patient's visit
+# list, exports, cohort analytics and the statistics; they are no longer in
+# the full-text search index. Deleting a patient rewrites the archive files
+# that hold their visits.
+
+VISIT_PARTITIONING = os.getenv("VISIT_PARTITIONING", "false").lower() in ("1", "true", "yes")
+VISIT_PARTITION_PERIOD = os.getenv("VISIT_PARTITION_PERIOD", "").lower()  # month or year; default month on PostgreSQL, year on SQLite
+VISIT_PARTITIONS_AHEAD = int(os.getenv("VISIT_PARTITIONS_AHEAD", "3"))
+# Archive partitions that ended this many months ago (0 disables archival)
+VISIT_ARCHIVE_AFTER_MONTHS = int(os.getenv("VISIT_ARCHIVE_AFTER_MONTHS", "0"))
+VISIT_ARCHIVE_DIR = os.getenv("VISIT_ARCHIVE_DIR", "./archive/visits")
+# How often partitions are created and archived (0 disables it)
+PARTITION_MAINTENANCE_SECONDS = int(os.getenv("PARTITION_MAINTENANCE_SECONDS", "3600"))
+
+PARTITION_PERIODS = ("month", "year")
+DEFAULT_PARTITION = "visits_default"
+# Arbitrary key for the PostgreSQL advisory lock that serializes partition maintenance
+PARTITION_LOCK_ID = 730115
+# Each SQLite partition needs its own copy of Visit's indexes
+PARTITION_INDEXES = {
+    "patient_id_visit_date": "patient_id, visit_date DESC",
+    "visit_date": "visit_date",
+    "created_at": "created_at",
+}
+# SQLite caps a compound SELECT (the view) at 500 terms
+SQLITE_MAX_PARTITIONS = 500
+ARCHIVE_ROW_GROUP_ROWS = 65536
+
+VISIT_TABLE_COLUMNS = [column.name for column in Visit.__table__.columns]
+# Id of the row being inserted through the SQLite view
+SQLITE_NEW_ID = "coalesce(new.id, (SELECT next_value - 1 FROM visits_id_counter))"
+
+# Whether visits is partitioned in this database - set by init_partitions
+_partitioned = False
+
+logger = logging.getLogger(__name__)
+
+
+def get_period(dialect: str):
+    """Partition period for a database backend"""
+    period = VISIT_PARTITION_PERIOD or ("month" if dialect == "postgresql" else "year")
+    if period not in PARTITION_PERIODS:
+        raise ValueError(f"VISIT_PARTITION_PERIOD must be one of {', '.join(PARTITION_PERIODS)}")
+    return period
+
+
+def add_months(day: date, months: int):
+    """First day of the month months after day's month"""
+    month = day.year * 12 + day.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def period_start(day: date, period: str):
+    return date(day.year, 1, 1) if period == "year" else date(day.year, day.month, 1)
+
+
+def period_end(start: date, period: str):
+    return add_months(start, 12 if period == "year" else 1)
+
+
+def partition_name(start: date, period: str):
+    return f"visits_p{start:%Y}" if period == "year" else f"visits_p{start:%Y_%m}"
+
+
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+@contextmanager
+def _maintenance(engine):
+    """A transaction holding the partition maintenance lock"""
+    with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": PARTITION_LOCK_ID})
+        else:
+            # pysqlite only begins a transaction at the first DML; take the write lock now
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        yield conn
+
+
+def is_partitioned(conn):
+    """Whether visits is already partitioned"""
+    if conn.dialect.name == "postgresql":
+        kind = conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('visits')")).scalar()
+        return kind == "p"
+    return conn.execute(text("SELECT type FROM sqlite_master WHERE name = 'visits'")).scalar() == "view"
+
+
+def _live(conn):
+    """(name, range_start, range_end) of the live partitions, oldest first"""
+    return conn.execute(
+        select(VisitPartition.name, VisitPartition.range_start, VisitPartition.range_end)
+        .where(VisitPartition.status == "live")
+        .order_by(VisitPartition.range_start)
+    ).all()
+
+
+def _table(name: str):
+    """A partition as a Table with Visit's columns, for typed reads"""
+    return Table(name, MetaData(), *(Column(column.name, column.type) for column in Visit.__table__.columns))
+
+
+# ============= PARTITIONS =============
+
+def _create_sqlite_table(conn, name: str):
+    metadata = MetaData()
+    Patient.__table__.to_metadata(metadata)
+    table = Visit.__table__.to_metadata(metadata, name=name)
+    conn.execute(CreateTable(table, if_not_exists=True))
+    for suffix, columns in PARTITION_INDEXES.items():
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{name}_{suffix} ON {name} ({columns})"))
+
+
+def _create_partition(conn, name: str, start: date, end: date):
+    """Create and register one partition, moving in its rows from the default partition"""
+    in_range = "visit_date >= :start AND visit_date < :end"
+    bounds = {"start": start.isoformat(), "end": end.isoformat()}
+    if conn.dialect.name == "postgresql":
+        conn.execute(text(f"CREATE TABLE {name} (LIKE visits INCLUDING DEFAULTS)"))
+        if conn.execute(text(f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE {in_range} LIMIT 1"), bounds).first():
+            # Moving rows isn't a change to them - keep them out of the change log
+            conn.execute(text("SET LOCAL healthplus.moving_rows = 'on'"))
+            conn.execute(text(
+                f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE {in_range} RETURNING *) "
+                f"INSERT INTO {name} SELECT * FROM moved"
+            ), bounds)
+            conn.execute(text("SET LOCAL healthplus.moving_rows = 'off'"))
+        # ATTACH only takes a SHARE UPDATE EXCLUSIVE lock on visits, so reads and writes carry on
+        conn.execute(text(f"ALTER TABLE visits ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')"))
+    else:
+        # The partition tables have no triggers, so nothing is logged
+        columns = ", ".join(VISIT_TABLE_COLUMNS)
+        _create_sqlite_table(conn, name)
+        conn.execute(text(f"INSERT INTO {name} ({columns}) SELECT {columns} FROM {DEFAULT_PARTITION} WHERE {in_range}"),
+                     bounds)
+        conn.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE {in_range}"), bounds)
+    conn.execute(insert(VisitPartition).values(name=name, range_start=start, range_end=end, status="live"))
+
+
+def _create_range(conn, period: str, first: date, last: date):
+    """Create the missing partitions for the periods from first's through last's"""
+    known = set(conn.execute(select(VisitPartition.name)).scalars())
+    created = []
+    start = period_start(first, period)
+    while start <= last:
+        name = partition_name(start, period)
+        if name not in known:
+            _create_partition(conn, name, start, period_end(start, period))
+            created.append(name)
+        start = period_end(start, period)
+    return created
+
+
+def ensure_partitions(conn, period: str, ahead: int = VISIT_PARTITIONS_AHEAD):
+    """Create partitions up to ahead periods past the current one; returns the new ones"""
+    current = period_start(date.today(), period)
+    last = add_months(current, ahead * (12 if period == "year" else 1))
+    # Fill any gap since the newest partition (maintenance didn't run for a while)
+    newest = conn.execute(select(func.max(VisitPartition.range_end))).scalar()
+    first = min(current, _as_date(newest)) if newest else current
+    return _create_range(conn, period, first, last)
+
+
+def _convert_postgres(conn, period: str):
+    first, last = conn.execute(select(func.min(Visit.visit_date), func.max(Visit.visit_date))).first()
+    sequence = conn.execute(text("SELECT pg_get_serial_sequence('visits', 'id')")).scalar()
+    indexes = conn.execute(text(
+        "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = 'visits'"
+    )).scalars().all()
+
+    conn.execute(text("LOCK TABLE visits IN ACCESS EXCLUSIVE MODE"))
+    conn.execute(text("ALTER TABLE visits RENAME TO visits_unpartitioned"))
+    for index in indexes:
+        conn.execute(text(f"ALTER INDEX {index} RENAME TO {index[:40]}_unpartitioned"))
+    conn.execute(text("CREATE TABLE visits (LIKE visits_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (visit_date)"))
+    # The partition key has to be part of the primary key
+    conn.execute(text("ALTER TABLE visits ADD PRIMARY KEY (id, visit_date)"))
+    conn.execute(text("ALTER TABLE visits ADD FOREIGN KEY (patient_id) REFERENCES patients (id)"))
+    if sequence:
+        # Otherwise the id sequence would be dropped with the old table
+        conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY visits.id"))
+    conn.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF visits DEFAULT"))
+    _create_range(conn, period, _as_date(first or date.today()), _as_date(last or date.today()))
+
+    conn.execute(text("INSERT INTO visits SELECT * FROM visits_unpartitioned"))
+    conn.execute(text("DROP TABLE visits_unpartitioned"))
+    # Indexes on the parent are built on every partition, and on new ones as they are attached
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_visits_id ON visits (id)"))
+    for suffix, columns in PARTITION_INDEXES.items():
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_visits_{suffix} ON visits ({columns})"))
+
+
+def _convert_sqlite(conn, period: str):
+    first, last = conn.execute(select(func.min(Visit.visit_date), func.max(Visit.visit_date))).first()
+    conn.execute(text("CREATE TABLE IF NOT EXISTS visits_id_counter (next_value INTEGER NOT NULL)"))
+    conn.execute(text("DELETE FROM visits_id_counter"))
+    conn.execute(text("INSERT INTO visits_id_counter (next_value) SELECT coalesce(max(id), 0) + 1 FROM visits"))
+
+    # Renaming carries the table's triggers and indexes along; they go with it below
+    conn.execute(text("ALTER TABLE visits RENAME TO visits_unpartitioned"))
+    _create_sqlite_table(conn, DEFAULT_PARTITION)
+    _create_range(conn, period, _as_date(first or date.today()), _as_date(last or date.today()))
+
+    columns = ", ".join(VISIT_TABLE_COLUMNS)
+    partitions = _live(conn)
+    for name, start, end in partitions:
+        conn.execute(text(
+            f"INSERT INTO {name} ({columns}) SELECT {columns} FROM visits_unpartitioned "
+            "WHERE visit_date >= :start AND visit_date < :end"
+        ), {"start": start.isoformat(), "end": end.isoformat()})
+    conn.execute(text(
+        f"INSERT INTO {DEFAULT_PARTITION} ({columns}) SELECT {columns} FROM visits_unpartitioned "
+        "WHERE visit_date >= :end"
+    ), {"end": partitions[-1].range_end.isoformat()})
+    conn.execute(text("DROP TABLE visits_unpartitioned"))
+
+
+# ============= SQLITE VIEW =============
+
+def _merge_ranges(partitions):
+    ranges = []
+    for _, start, end in partitions:
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+def _sqlite_route(partitions, visit_id: str):
+    """Statements inserting new into the partition its visit_date falls in"""
+    columns = ", ".join(VISIT_TABLE_COLUMNS)
+    values = ", ".join(visit_id if name == "id" else f"new.{name}" for name in VISIT_TABLE_COLUMNS)
+    statements = [
+        f"INSERT INTO {name} ({columns}) SELECT {values} "
+        f"WHERE new.visit_date >= '{start}' AND new.visit_date < '{end}'"
+        for name, start, end in partitions
+    ]
+    covered = " OR ".join(
+        f"(new.visit_date >= '{start}' AND new.visit_date < '{end}')" for start, end in _merge_ranges(partitions)
+    )
+    # A NULL visit_date lands here too, and fails the NOT NULL constraint
+    statements.append(
+        f"INSERT INTO {DEFAULT_PARTITION} ({columns}) SELECT {values} WHERE NOT coalesce({covered or '0'}, 0)"
+    )
+    return statements
+
+
+def _sqlite_trigger_ddl(partitions, logged: bool = True):
+    tables = [name for name, _, _ in partitions] + [DEFAULT_PARTITION]
+    delete = [f"DELETE FROM {table} WHERE id = old.id" for table in tables]
+
+    insert_body = [
+        "UPDATE visits_id_counter SET next_value = "
+        "CASE WHEN new.id IS NULL THEN next_value + 1 ELSE max(next_value, new.id + 1) END",
+        *_sqlite_route(partitions, SQLITE_NEW_ID),
+    ]
+    # Updates delete and re-insert, so a changed visit_date moves the row
+    update_body = [
+        "UPDATE visits_id_counter SET next_value = max(next_value, new.id + 1)",
+        *delete,
+        *_sqlite_route(partitions, "new.id"),
+    ]
+    delete_body = list(delete)
+    if logged:
+        insert_body += [
+            search.SQLITE_VISIT_SEARCH_INSERT.format(id=SQLITE_NEW_ID),
+            changes.sqlite_change_insert("visit", "insert", SQLITE_NEW_ID),
+        ]
+        update_body += [
+            search.SQLITE_VISIT_SEARCH_DELETE.format(id="old.id"),
+            search.SQLITE_VISIT_SEARCH_INSERT.format(id="new.id"),
+            changes.sqlite_change_insert("visit", "update"),
+        ]
+        delete_body += [
+            search.SQLITE_VISIT_SEARCH_DELETE.format(id="old.id"),
+            changes.sqlite_change_insert("visit", "delete"),
+        ]
+
+    statements = []
+    for op, body in (("insert", insert_body), ("update", update_body), ("delete", delete_body)):
+        statements += [
+            f"DROP TRIGGER IF EXISTS visits_{op}",
+            f"CREATE TRIGGER visits_{op} INSTEAD OF {op.upper()} ON visits BEGIN {'; '.join(body)}; END",
+        ]
+    return statements
+
+
+def sqlite_trigger_ddl(conn, logged: bool = True):
+    """
+    Statements (re)creating the triggers of a partitioned SQLite visits view;
+    none if visits is a plain table. logged=False leaves out the search index
+    and change log, for bulk loads.
+    """
+    if conn.dialect.name != "sqlite" or not is_partitioned(conn):
+        return []
+    return _sqlite_trigger_ddl(_live(conn), logged)
+
+
+def _sync_sqlite_view(conn):
+    """Point the visits view and its triggers at the current live partitions"""
+    partitions = _live(conn)
+    if len(partitions) + 1 > SQLITE_MAX_PARTITIONS:
+        raise ValueError("Too many live visit partitions for one SQLite view - "
+                         "archive old ones or use VISIT_PARTITION_PERIOD=year")
+    columns = ", ".join(VISIT_TABLE_COLUMNS)
+    tables = [name for name, _, _ in partitions] + [DEFAULT_PARTITION]
+    conn.execute(text("DROP VIEW IF EXISTS visits"))
+    conn.execute(text("CREATE VIEW visits AS " + " UNION ALL ".join(f"SELECT {columns} FROM {table}" for table in tables)))
+    for statement in _sqlite_trigger_ddl(partitions):
+        conn.execute(text(statement))
+
+
+# ============= VISIT IDS (SQLITE) =============
+
+def reserve_visit_ids(conn, count: int):
+    """Take count ids from the counter, inside the caller's transaction"""
+    end = conn.execute(
+        text("UPDATE visits_id_counter SET next_value = next_value + :count RETURNING next_value"), {"count": count}
+    ).scalar_one()
+    return range(end - count, end)
+
+
+def _needs_ids(db: Session):
+    return _partitioned and db.get_bind().dialect.name == "sqlite"
+
+
+def assign_visit_ids(db: Session, rows):
+    """Give new visit rows (dicts) their ids up front where the database can't report them back"""
+    missing = [row for row in rows if row.get("id") is None]
+    if missing and _needs_ids(db):
+        for row, visit_id in zip(missing, reserve_visit_ids(db.connection(), len(missing))):
+            row["id"] = visit_id
+
+
+def _assign_flush_ids(session, flush_context, instances):
+    visits = [obj for obj in session.new if isinstance(obj, Visit) and obj.id is None]
+    if visits and _needs_ids(session):
+        for visit, visit_id in zip(visits, reserve_visit_ids(session.connection(), len(visits))):
+            visit.id = visit_id
+
+
+def init_partitions(engine, fast: bool = False):
+    """
+    Partition visits on the first start with VISIT_PARTITIONING on, and make
+    sure the coming periods have partitions. Runs before the search index and
+    change log are set up. On a fast boot an already partitioned table is
+    left as it is; the maintenance thread creates the coming partitions.
+    """
+    global _partitioned
+    if engine.dialect.name not in ("postgresql", "sqlite"):
+        return
+    with engine.connect() as conn:
+        _partitioned = is_partitioned(conn)
+    if not VISIT_PARTITIONING and not _partitioned:
+        return
+
+    if not (fast and _partitioned):
+        period = get_period(engine.dialect.name)
+        with _maintenance(engine) as conn:
+            if not is_partitioned(conn):
+                logger.info("Partitioning the visits table by visit_date")
+                if engine.dialect.name == "postgresql":
+                    _convert_postgres(conn, period)
+                else:
+                    _convert_sqlite(conn, period)
+            if VISIT_PARTITIONING:
+                ensure_partitions(conn, period)
+            if engine.dialect.name == "sqlite":
+                _sync_sqlite_view(conn)
+    _partitioned = True
+    if not event.contains(Session, "before_flush", _assign_flush_ids):
+        event.listen(Session, "before_flush", _assign_flush_ids)
+
+
+# ============= ARCHIVE =============
+
+def _archive_schema():
+    from exporter import arrow_schema
+    return arrow_schema(Visit.__table__.columns)
+
+
+def _write_archive(conn, name: str, path: str):
+    """Write a partition's rows to a Parquet file; returns (rows, sum of ids) as a checksum"""
+    import pyarrow as pa  # optional dependency, only needed for archival
+    import pyarrow.parquet as pq
+
+    schema = _archive_schema()
+    table = _table(name)
+    rows = id_sum = 0
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with pq.ParquetWriter(path + ".tmp", schema, compression="zstd") as writer:
+        result = conn.execution_options(stream_results=True, yield_per=ARCHIVE_ROW_GROUP_ROWS).execute(
+            select(*table.columns).order_by(table.c.patient_id, table.c.visit_date)
+        )
+        # Sorted by patient, each row group covers a narrow range of patient ids
+        for chunk in result.partitions():
+            writer.write_batch(pa.RecordBatch.from_arrays(
+                [pa.array([row[i] for row in chunk], type=field.type) for i, field in enumerate(schema)],
+                schema=schema,
+            ))
+            rows += len(chunk)
+            id_sum += sum(row.id for row in chunk)
+    os.replace(path + ".tmp", path)
+    return rows, id_sum
+
+
+def _finish_archive(conn, name: str, path: str, rows: int):
+    """Swap an archived partition's table for its file"""
+    conn.execute(update(VisitPartition).where(VisitPartition.name == name).values(
+        status="archived", row_count=rows, archive_path=path, archived_at=datetime.utcnow()
+    ))
+    if conn.dialect.name == "postgresql":
+        conn.execute(text(f"ALTER TABLE visits DETACH PARTITION {name}"))
+    else:
+        conn.execute(text(f"DELETE FROM visits_search WHERE rowid IN (SELECT id FROM {name})"))
+        _sync_sqlite_view(conn)
+    conn.execute(text(f"DROP TABLE {name}"))
+
+
+def archive_partition(engine, name: str):
+    """
+    Write a live partition to a Parquet file and drop it from the database.
+    Returns the number of rows archived, or None if it wasn't archived.
+    """
+    path = os.path.join(VISIT_ARCHIVE_DIR, f"{name}.parquet")
+    with _maintenance(engine) as conn:
+        status = conn.execute(select(VisitPartition.status).where(VisitPartition.name == name)).scalar()
+        if status != "live":
+            return None
+        written = _write_archive(conn, name, path)
+        if conn.dialect.name == "sqlite":
+            # Writers wait for this transaction, so nothing can have changed meanwhile
+            _finish_archive(conn, name, path, written[0])
+            return written[0]
+
+    # PostgreSQL wrote the file without blocking writes; swap the partition
+    # out now, unless a late write to the period came in meanwhile
+    with _maintenance(engine) as conn:
+        conn.execute(text("LOCK TABLE visits IN ACCESS EXCLUSIVE MODE"))
+        checksum = tuple(conn.execute(text(f"SELECT count(*), coalesce(sum(id), 0) FROM {name}")).first())
+        if checksum != written:
+            logger.warning("Visits in %s changed while it was being archived - trying again next time", name)
+            return None
+        _finish_archive(conn, name, path, written[0])
+    return written[0]
+
+
+def archive_paths(db):
+    """Files of the archived partitions, oldest first (db is a Session or Connection)"""
+    if not _partitioned:
+        return []
+    return db.execute(
+        select(VisitPartition.archive_path)
+        .where(VisitPartition.status == "archived")
+        .order_by(VisitPartition.range_start)
+    ).scalars().all()
+
+
+def read_archive(paths, columns=None, patient_id: int = None):
+    """
+    Archived visits, optionally only one patient's, as rows of the given Visit
+    columns - or as (detached) Visit objects if no columns are given.
+    """
+    if not paths:
+        return []
+    import pyarrow.parquet as pq
+
+    keys = [column.key for column in columns] if columns else VISIT_TABLE_COLUMNS
+    filters = [("patient_id", "=", patient_id)] if patient_id is not None else None
+    values = []
+    for path in paths:
+        table = pq.read_table(path, columns=keys, filters=filters)
+        values.extend(zip(*(table.column(key).to_pylist() for key in keys)))
+    if not columns:
+        return [Visit(**dict(zip(keys, row))) for row in values]
+    row_type = namedtuple("ArchivedVisit", keys)
+    return [row_type(*row) for row in values]
+
+
+def archived_visits(db: Session, patient_id: int, columns=None):
+    """A patient's archived visits, shaped like read_archive's"""
+    return read_archive(archive_paths(db), columns, patient_id)
+
+
+def iter_archive(paths, columns, created_since: datetime = None):
+    """Yield lists of archived rows of the given Visit columns, one row group at a time"""
+    if not paths:
+        return
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    keys = [column.key for column in columns]
+    for path in paths:
+        parquet = pq.ParquetFile(path)
+        for index in range(parquet.num_row_groups):
+            table = parquet.read_row_group(index, columns=keys + (["created_at"] if created_since else []))
+            if created_since is not None:
+                table = table.filter(pc.greater_equal(table["created_at"], pa.scalar(created_since, pa.timestamp("us"))))
+            if table.num_rows:
+                yield list(zip(*(table.column(key).to_pylist() for key in keys)))
+
+
+def archived_visit_days(paths):
+    """Patient ids and visit days since 1970-01-01 of every archived visit, as lists of NumPy chunks"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    patient_ids, days = [], []
+    for path in paths:
+        table = pq.read_table(path, columns=["patient_id", "visit_date"])
+        patient_ids.append(table["patient_id"].to_numpy())
+        days.append(table["visit_date"].cast(pa.date32()).cast(pa.int32()).to_numpy())
+    return patient_ids, days
+
+
+def purge_patient(engine, patient_id: int):
+    """Remove a deleted patient's visits from the archive files; returns how many were removed"""
+    if not _partitioned:
+        return 0
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    removed = 0
+    with _maintenance(engine) as conn:
+        archived = conn.execute(
+            select(VisitPartition.name, VisitPartition.archive_path).where(VisitPartition.status == "archived")
+        ).all()
+        for name, path in archived:
+            if not pq.read_table(path, columns=["id"], filters=[("patient_id", "=", patient_id)]).num_rows:
+                continue
+            table = pq.read_table(path)
+            kept = table.filter(pc.not_equal(table["patient_id"], patient_id))
+            pq.write_table(kept, path + ".tmp", compression="zstd", row_group_size=ARCHIVE_ROW_GROUP_ROWS)
+            os.replace(path + ".tmp", path)
+            removed += table.num_rows - kept.num_rows
+            conn.execute(update(VisitPartition).where(VisitPartition.name == name).values(row_count=kept.num_rows))
+    return removed
+
+
+def archived_count(db: Session):
+    """Visits held in archive files"""
+    if not _partitioned:
+        return 0
+    return db.execute(
+        select(func.coalesce(func.sum(VisitPartition.row_count), 0)).where(VisitPartition.status == "archived")
+    ).scalar()
+
+
+# ============= MAINTENANCE =============
+
+def maintain(engine, today: date = None):
+    """Create upcoming partitions and archive cold ones; returns the partitions created and archived"""
+    if not _partitioned:
+        return {"created": [], "archived": []}
+    period = get_period(engine.dialect.name)
+    with _maintenance(engine) as conn:
+        created = ensure_partitions(conn, period)
+        if created and engine.dialect.name == "sqlite":
+            _sync_sqlite_view(conn)
+
+    archived = []
+    if VISIT_ARCHIVE_AFTER_MONTHS > 0:
+        cutoff = add_months(today or date.today(), -VISIT_ARCHIVE_AFTER_MONTHS)
+        with engine.connect() as conn:
+            cold = conn.execute(
+                select(VisitPartition.name)
+                .where(VisitPartition.status == "live", VisitPartition.range_end <= cutoff)
+                .order_by(VisitPartition.range_start)
+            ).scalars().all()
+        for name in cold:
+            if archive_partition(engine, name) is not None:
+                archived.append(name)
+    return {"created": created, "archived": archived}
+
+
+def get_partitions(db: Session):
+    """Every partition and archive file, with the rows in the default partition"""
+    if not _partitioned:
+        return {"partitioned": False, "partitions": []}
+    partitions = db.query(VisitPartition).order_by(VisitPartition.range_start).all()
+    return {
+        "partitioned": True,
+        "period": get_period(db.get_bind().dialect.name),
+        "default_rows": db.execute(text(f"SELECT count(*) FROM {DEFAULT_PARTITION}")).scalar(),
+        "partitions": [
+            {
+                "name": partition.name,
+                "range_start": partition.range_start,
+                "range_end": partition.range_end,
+                "status": partition.status,
+                "row_count": partition.row_count,
+                "archive_path": partition.archive_path,
+                "archived_at": partition.archived_at,
+            }
+            for partition in partitions
+        ],
+    }
+
+
+def start_maintenance_thread(engine, interval: int = PARTITION_MAINTENANCE_SECONDS):
+    """Run maintain now, then every interval seconds, in a daemon thread"""
+    if not _partitioned or interval <= 0:
+        return None
+
+    def loop():
+        while True:
+            try:
+                done = maintain(engine)
+                if done["created"] or done["archived"]:
+                    logger.info("Visit partitions created: %s, archived: %s", done["created"], done["archived"])
+            except Exception:
+                logger.exception("Partition maintenance failed")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name="partition-maintenance", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    import json
+    import sys
+    import partitions  # the copy init_db sets up, not this __main__ one
+    from database import SessionLocal, engine, init_db
+
+    init_db()
+    # "python partitions.py maintain" creates and archives partitions now
+    if sys.argv[1:] == ["maintain"]:
+        print(partitions.maintain(engine))
+    db = SessionLocal()
+    try:
+        print(json.dumps(partitions.get_partitions(db), indent=2, default=str))
+    finally:
+        db.close()
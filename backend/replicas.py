@@ -0,0 +1,288 @@
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Optional
+from anyio import to_thread
+from sqlalchemy import event, func, select, text
+from sqlalchemy.orm import Session
+from models import ChangeLog
+
+# Read replicas.
+# DATABASE_REPLICA_URLS lists read-only copies of the primary database
+# (comma-separated). Endpoints that only read and can take slightly stale
+# data - list scans, search, analytics, exports - get their session from
+# database.get_read_db, which picks a healthy replica that isn't too far
+# behind, round-robin or by lowest latency. Everything else, and every read
+# when no replica qualifies, uses the primary. The cached per-patient
+# responses stay on the primary too, so a lagging replica can't refill the
+# cache with rows a write has just invalidated.
+#
+# Read-your-writes: a response to a request that committed on the primary
+# carries the primary's replication position as a read token, in the
+# X-Read-After header and a cookie. Reads that send it back only go to a
+# replica known to have replayed at least that far.
+#
+# Positions are WAL LSNs on PostgreSQL streaming replicas. With
+# REPLICA_POSITION=changes they are the highest change_log id instead - the
+# trigger-maintained change feed replicates along with the data - which works
+# for logical replication and for SQLite. Locally, two SQLite files stand in
+# for primary and replica; refresh the replica with
+#   sqlite3 healthplus.db ".backup replica.db"
+# and start with DATABASE_REPLICA_URLS=sqlite:///./replica.db.
+
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_SELECTION = os.getenv("REPLICA_SELECTION", "round_robin").lower()  # round_robin or latency
+REPLICA_HEALTH_SECONDS = float(os.getenv("REPLICA_HEALTH_SECONDS", "2"))
+# Replicas further behind than this only serve reads again once they catch up
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "30"))
+REPLICA_POSITION = os.getenv("REPLICA_POSITION", "").lower()  # lsn or changes; default lsn on PostgreSQL
+READ_TOKEN_HEADER = "X-Read-After"
+READ_TOKEN_COOKIE = "read_after"
+READ_TOKEN_MAX_AGE = int(os.getenv("READ_TOKEN_MAX_AGE", "300"))
+
+REPLICA_SELECTIONS = ("round_robin", "latency")
+
+logger = logging.getLogger(__name__)
+
+
+def parse_lsn(value: str):
+    """PostgreSQL LSN ("16/B374D848") as an integer"""
+    high, low = value.split("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def read_position(conn, method: str, primary: bool):
+    """Replication position of the database conn is on, or None if it has none"""
+    if method == "lsn":
+        function = "pg_current_wal_lsn" if primary else "pg_last_wal_replay_lsn"
+        value = conn.execute(text(f"SELECT {function}()::text")).scalar()
+        return parse_lsn(value) if value else None
+    return conn.execute(select(func.max(ChangeLog.id))).scalar() or 0
+
+
+def make_read_only(engine):
+    """Refuse writes on every connection the engine opens"""
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if engine.dialect.name == "sqlite":
+            cursor.execute("PRAGMA query_only = ON")
+        else:
+            cursor.execute("SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY")
+        cursor.close()
+        if engine.dialect.name != "sqlite":
+            dbapi_connection.commit()
+
+
+class Replica:
+    """One read replica: its engines and what the last health check found"""
+
+    def __init__(self, name: str, engine, session_factory, async_engine=None, async_session_factory=None):
+        self.name = name
+        self.engine = engine
+        self.session_factory = session_factory
+        self.async_engine = async_engine
+        self.async_session_factory = async_session_factory
+        self.healthy = False
+        self.position = None
+        self.lag_seconds = None
+        self.latency_ms = None
+        self.error = "not checked yet"
+        self.checked_at = None
+
+        @event.listens_for(engine, "handle_error")
+        def handle_error(context):
+            # Stop routing reads here as soon as a request sees it go away
+            if context.is_disconnect:
+                self.healthy = False
+                self.error = str(context.original_exception)
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "url": self.engine.url.render_as_string(hide_password=True),
+            "healthy": self.healthy,
+            "position": self.position,
+            "lag_seconds": self.lag_seconds,
+            "latency_ms": self.latency_ms,
+            "error": self.error,
+            "checked_at": self.checked_at,
+        }
+
+
+class ReplicaSet:
+    """Picks the replica each read goes to, from periodic health checks"""
+
+    def __init__(self, primary, replicas, selection: str = REPLICA_SELECTION,
+                 max_lag_seconds: float = REPLICA_MAX_LAG_SECONDS, position: str = REPLICA_POSITION):
+        if selection not in REPLICA_SELECTIONS:
+            raise ValueError(f"REPLICA_SELECTION must be one of {', '.join(REPLICA_SELECTIONS)}")
+        self.primary = primary
+        self.replicas = replicas
+        self.selection = selection
+        self.max_lag_seconds = max_lag_seconds
+        self.position = position or ("lsn" if primary.dialect.name == "postgresql" else "changes")
+        self._turn = itertools.count()
+        # (monotonic time, primary position) from recent checks, for lag in seconds
+        self._history = deque()
+        self._lock = threading.Lock()
+
+    def primary_position(self):
+        """Current position of the primary - the read token after a write"""
+        with self.primary.connect() as conn:
+            return read_position(conn, self.position, primary=True)
+
+    def _lag(self, now: float, position: int):
+        # A replica is as far behind as the oldest primary position it hasn't reached
+        behind = [seen for seen, primary_position in self._history if primary_position > position]
+        return round(now - min(behind), 3) if behind else 0.0
+
+    def check(self):
+        """Ping every replica and record its position, lag and latency"""
+        with self._lock:
+            now = time.monotonic()
+            try:
+                self._history.append((now, self.primary_position()))
+            except Exception:
+                logger.exception("Replica check: primary unreachable")
+            while self._history and self._history[0][0] < now - 2 * self.max_lag_seconds:
+                self._history.popleft()
+
+            for replica in self.replicas:
+                started = time.perf_counter()
+                try:
+                    with replica.engine.connect() as conn:
+                        position = read_position(conn, self.position, primary=False)
+                except Exception as e:
+                    replica.healthy = False
+                    replica.error = str(e)
+                    continue
+                latency = (time.perf_counter() - started) * 1000
+                # Smoothed, so one slow ping doesn't move all traffic
+                replica.latency_ms = round(latency if replica.latency_ms is None
+                                           else 0.8 * replica.latency_ms + 0.2 * latency, 3)
+                replica.checked_at = time.time()
+                if position is None:
+                    replica.healthy = False
+                    replica.error = "not a streaming replica - set REPLICA_POSITION=changes"
+                    continue
+                replica.position = position
+                replica.lag_seconds = self._lag(now, position)
+                replica.healthy = True
+                replica.error = None
+
+    def choose(self, token: Optional[int] = None):
+        """Replica to read from, or None to read from the primary"""
+        candidates = [
+            replica for replica in self.replicas
+            if replica.healthy and replica.lag_seconds <= self.max_lag_seconds
+            and (token is None or replica.position >= token)
+        ]
+        if not candidates:
+            return None
+        if self.selection == "latency":
+            return min(candidates, key=lambda replica: replica.latency_ms)
+        return candidates[next(self._turn) % len(candidates)]
+
+    def stats(self):
+        return {
+            "selection": self.selection,
+            "position": self.position,
+            "max_lag_seconds": self.max_lag_seconds,
+            "replicas": [replica.stats() for replica in self.replicas],
+        }
+
+
+def start_health_thread(replica_set: ReplicaSet, interval: float = REPLICA_HEALTH_SECONDS):
+    """Check the replicas now, then every interval seconds in a daemon thread"""
+    replica_set.check()
+    if interval <= 0:
+        return None
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                replica_set.check()
+            except Exception:
+                logger.exception("Replica health check failed")
+
+    thread = threading.Thread(target=loop, name="replica-health", daemon=True)
+    thread.start()
+    return thread
+
+
+# ============= READ-YOUR-WRITES TOKENS =============
+
+def parse_token(value: Optional[str]):
+    """Read token from a request header or cookie; None if missing or malformed"""
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+def request_token(headers, cookies):
+    """The read token a request carries, header first"""
+    return parse_token(headers.get(READ_TOKEN_HEADER.lower()) or cookies.get(READ_TOKEN_COOKIE))
+
+
+class RequestWrites:
+    """Whether the current request committed anything on the primary"""
+
+    def __init__(self):
+        self.committed = False
+
+
+current = ContextVar("request_writes", default=None)
+
+
+def track_commits(engines):
+    """Mark the current request as a writer when a session on one of engines commits"""
+    engines = set(engines)
+
+    @event.listens_for(Session, "after_commit")
+    def after_commit(session):
+        writes = current.get()
+        if writes is not None and session.get_bind() in engines:
+            writes.committed = True
+
+
+class ReadTokenMiddleware:
+    """ASGI middleware that hands a read token to clients that just wrote"""
+
+    def __init__(self, app, replica_set: ReplicaSet):
+        self.app = app
+        self.replica_set = replica_set
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        writes = RequestWrites()
+        token = current.set(writes)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and writes.committed:
+                try:
+                    position = await to_thread.run_sync(self.replica_set.primary_position)
+                except Exception:
+                    logger.exception("Could not read the primary position")
+                    position = None
+                if position is not None:
+                    cookie = f"{READ_TOKEN_COOKIE}={position}; Max-Age={READ_TOKEN_MAX_AGE}; Path=/; HttpOnly; SameSite=Lax"
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (READ_TOKEN_HEADER.lower().encode(), str(position).encode()),
+                        (b"set-cookie", cookie.encode()),
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current.reset(token)
@@ -1,6 +1,6 @@
 from pydantic import BaseModel, EmailStr
 from datetime import date, datetime
-from typing import Optional, List
+from typing import Any, Dict, List, Literal, Optional
 
 
 # ============= PATIENT SCHEMAS =============
@@ -46,6 +46,12 @@ class Patient(PatientBase):
         from_attributes = True
 
 
+class PatientPage(BaseModel):
+    """Schema for a page of patients returned by cursor pagination"""
+    items: List[Patient]
+    next_cursor: Optional[str] = None
+
+
 # ============= VISIT SCHEMAS =============
 
 class VisitBase(BaseModel):
@@ -71,6 +77,19 @@ class Visit(VisitBase):
         from_attributes = True
 
 
+class VisitSearchHit(BaseModel):
+    """Schema for a visit search result"""
+    visit: Visit
+    snippet: str  # matched text, with terms wrapped in <mark></mark>
+    rank: float
+
+
+class VisitSearchResults(BaseModel):
+    """Schema for a page of visit search results"""
+    items: List[VisitSearchHit]
+    truncated: bool  # more visits matched than the newest SEARCH_MAX_CANDIDATES that were ranked
+
+
 # ============= DOCUMENT SCHEMAS =============
 
 class DocumentBase(BaseModel):
@@ -92,12 +111,70 @@ class Document(DocumentBase):
     patient_id: int
     file_url: str
     file_size: Optional[int] = None
+    sha256: Optional[str] = None
     uploaded_at: datetime
+    processing_status: Optional[str] = None
+    processed_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
+class DocumentExtraction(BaseModel):
+    """Schema for the text and metadata extracted from a document file"""
+    id: int
+    processing_status: Optional[str] = None
+    processed_at: Optional[datetime] = None
+    extracted_text: Optional[str] = None
+    extracted_metadata: Optional[dict] = None
+
+    class Config:
+        from_attributes = True
+
+
+# ============= BATCH SCHEMAS =============
+
+class BatchOperation(BaseModel):
+    """One operation in a batch write"""
+    op: Literal["create_patient", "update_patient", "create_visit", "create_document"]
+    ref: Optional[str] = None  # label for a patient created by this operation
+    patient_id: Optional[int] = None  # existing patient to update or attach to
+    patient_ref: Optional[str] = None  # ...or a patient created earlier in the batch
+    data: Dict[str, Any] = {}
+
+
+class BatchRequest(BaseModel):
+    """Schema for a batch write"""
+    operations: List[BatchOperation]
+
+
+# ============= CHANGE FEED SCHEMAS =============
+
+class Change(BaseModel):
+    """One entry in the change feed"""
+    id: int
+    entity: str  # patient, visit, document
+    entity_id: int
+    patient_id: Optional[int] = None
+    op: str  # create, update, delete
+    fields: Optional[List[str]] = None  # columns an update changed
+    changed_at: datetime
 
     class Config:
         from_attributes = True
 
 
+class ChangePage(BaseModel):
+    """A page of the change feed with the cursor to continue from"""
+    changes: List[Change]
+    next_cursor: str
+
+
+class ChangeAck(BaseModel):
+    """Schema for saving a consumer's position in the feed"""
+    cursor: str
+
+
 # ============= USER SCHEMAS =============
 
 class UserBase(BaseModel):
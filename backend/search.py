@@ -0,0 +1,394 @@
+import os
+import re
+from datetime import timedelta
+from sqlalchemy import case, func, literal, or_, text
+from sqlalchemy.orm import Session
+from models import Patient, Visit
+
+# Patient and visit search indexes.
+# PostgreSQL: pg_trgm GIN index on the full name for fuzzy matching, plus
+# text_pattern_ops expression indexes so LIKE 'prefix%' is an index range scan.
+# SQLite: two FTS5 shadow tables kept in sync with the patients table by
+# triggers - patients_prefix holds whole words (an MRN, phone number or
+# email address counts as one word) with prefix indexes, so word prefixes
+# of any length are index lookups, and patients_search holds trigrams for
+# substring and fuzzy matches.
+#
+# Visit text (reason, diagnosis, treatment, notes) gets full-text search:
+# a GIN index over a weighted tsvector expression on PostgreSQL, and an FTS5
+# shadow table with the porter stemmer on SQLite. Both are maintained by the
+# database itself, so every write path (CRUD, bulk import) stays in sync.
+
+POSTGRES_SEARCH_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_patients_full_name_trgm ON patients "
+    "USING gin ((lower(first_name || ' ' || last_name)) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_patients_first_name_prefix ON patients (lower(first_name) text_pattern_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_patients_last_name_prefix ON patients (lower(last_name) text_pattern_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_patients_mrn_prefix ON patients (medical_record_number text_pattern_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_patients_phone_prefix ON patients (phone text_pattern_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_patients_email_prefix ON patients (lower(email) text_pattern_ops)",
+]
+
+SQLITE_SEARCH_COLUMNS = (
+    "new.first_name || ' ' || new.last_name, new.medical_record_number, new.phone, new.email"
+)
+
+# FTS5 table -> its options
+SQLITE_PATIENT_SEARCH_TABLES = {
+    "patients_prefix": "tokenize=\"unicode61 tokenchars '-@.+'\", prefix='1 2 3'",
+    "patients_search": "tokenize='trigram'",
+}
+
+
+def _sqlite_patient_search_ddl(table: str, options: str):
+    """A patient search shadow table and the triggers that keep it in sync"""
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5("
+        f"full_name, medical_record_number, phone, email, {options})",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_insert AFTER INSERT ON patients BEGIN "
+        f"INSERT INTO {table}(rowid, full_name, medical_record_number, phone, email) "
+        f"VALUES (new.id, {SQLITE_SEARCH_COLUMNS}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_delete AFTER DELETE ON patients BEGIN "
+        f"DELETE FROM {table} WHERE rowid = old.id; END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_update AFTER UPDATE ON patients BEGIN "
+        f"DELETE FROM {table} WHERE rowid = old.id; "
+        f"INSERT INTO {table}(rowid, full_name, medical_record_number, phone, email) "
+        f"VALUES (new.id, {SQLITE_SEARCH_COLUMNS}); END",
+    ]
+
+
+SQLITE_SEARCH_DDL = [
+    statement for table, options in SQLITE_PATIENT_SEARCH_TABLES.items()
+    for statement in _sqlite_patient_search_ddl(table, options)
+]
+
+# Reason and diagnosis weigh most, then treatment, then free-text notes.
+# The query must repeat this expression exactly for the index to be used.
+VISIT_SEARCH_VECTOR = (
+    "setweight(to_tsvector('english', coalesce(reason, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(diagnosis, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(treatment, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(notes, '')), 'C')"
+)
+
+POSTGRES_VISIT_SEARCH_DDL = [
+    f"CREATE INDEX IF NOT EXISTS ix_visits_search ON visits USING gin (({VISIT_SEARCH_VECTOR}))",
+]
+
+SQLITE_VISIT_SEARCH_COLUMNS = "new.reason, new.diagnosis, new.treatment, new.notes"
+
+# What the visit triggers run, given the visit id expression
+SQLITE_VISIT_SEARCH_INSERT = (
+    "INSERT INTO visits_search(rowid, reason, diagnosis, treatment, notes) "
+    f"VALUES ({{id}}, {SQLITE_VISIT_SEARCH_COLUMNS})"
+)
+SQLITE_VISIT_SEARCH_DELETE = "DELETE FROM visits_search WHERE rowid = {id}"
+
+SQLITE_VISIT_SEARCH_TABLE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS visits_search USING fts5("
+    "reason, diagnosis, treatment, notes, tokenize='porter unicode61')",
+]
+
+# A partitioned visits view (partitions.py) maintains the index from its own triggers instead
+SQLITE_VISIT_SEARCH_TRIGGER_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS visits_search_insert AFTER INSERT ON visits BEGIN "
+    f"{SQLITE_VISIT_SEARCH_INSERT.format(id='new.id')}; END",
+    "CREATE TRIGGER IF NOT EXISTS visits_search_delete AFTER DELETE ON visits BEGIN "
+    f"{SQLITE_VISIT_SEARCH_DELETE.format(id='old.id')}; END",
+    "CREATE TRIGGER IF NOT EXISTS visits_search_update AFTER UPDATE OF reason, diagnosis, treatment, notes "
+    "ON visits BEGIN "
+    f"{SQLITE_VISIT_SEARCH_DELETE.format(id='old.id')}; "
+    f"{SQLITE_VISIT_SEARCH_INSERT.format(id='new.id')}; END",
+]
+
+# Trigram tokens need at least three characters to hit the index
+MIN_TRIGRAM_LENGTH = 3
+
+
+def search_index_ddl(dialect: str, visits_view: bool = False):
+    """Statements that create the search indexes; visits_view when visits is a (partitioned) view"""
+    if dialect == "postgresql":
+        return POSTGRES_SEARCH_DDL + POSTGRES_VISIT_SEARCH_DDL
+    if dialect == "sqlite":
+        # A partitioned visits view maintains visits_search from its own triggers
+        triggers = [] if visits_view else SQLITE_VISIT_SEARCH_TRIGGER_DDL
+        return SQLITE_SEARCH_DDL + SQLITE_VISIT_SEARCH_TABLE_DDL + triggers
+    return []
+
+
+def init_search_index(engine):
+    """Create the search indexes for the current database backend"""
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            for statement in search_index_ddl("postgresql"):
+                conn.execute(text(statement))
+        elif engine.dialect.name == "sqlite":
+            visits_type = conn.execute(text("SELECT type FROM sqlite_master WHERE name = 'visits'")).scalar()
+            for statement in search_index_ddl("sqlite", visits_view=visits_type == "view"):
+                conn.execute(text(statement))
+            # Backfill patients that existed before the shadow tables did
+            for table in SQLITE_PATIENT_SEARCH_TABLES:
+                conn.execute(text(
+                    f"INSERT INTO {table}(rowid, full_name, medical_record_number, phone, email) "
+                    "SELECT id, first_name || ' ' || last_name, medical_record_number, phone, email "
+                    f"FROM patients WHERE id NOT IN (SELECT rowid FROM {table})"
+                ))
+            conn.execute(text(
+                "INSERT INTO visits_search(rowid, reason, diagnosis, treatment, notes) "
+                "SELECT id, reason, diagnosis, treatment, notes "
+                "FROM visits WHERE id NOT IN (SELECT rowid FROM visits_search)"
+            ))
+
+
+def _escape_like(value: str):
+    """Escape LIKE wildcards so user input is matched literally"""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _fts_phrase(value: str):
+    """Quote a string as an FTS5 phrase"""
+    return '"' + value.replace('"', '""') + '"'
+
+
+def search_patients(db: Session, q: str, skip: int = 0, limit: int = 20):
+    """
+    Search patients by name, MRN, phone or email prefix, with fuzzy name matching.
+    Results are ranked best match first.
+    """
+    q = q.strip()
+    if not q:
+        return []
+    if db.get_bind().dialect.name == "sqlite":
+        return _search_sqlite(db, q, skip, limit)
+    return _search_postgres(db, q, skip, limit)
+
+
+def _search_postgres(db: Session, q: str, skip: int, limit: int):
+    """Ranked search using the text_pattern_ops and pg_trgm indexes"""
+    lowered = q.lower()
+    prefix = _escape_like(lowered) + "%"
+    full_name = func.lower(Patient.first_name + " " + Patient.last_name)
+
+    prefix_match = or_(
+        func.lower(Patient.first_name).like(prefix, escape="\\"),
+        func.lower(Patient.last_name).like(prefix, escape="\\"),
+        full_name.like(prefix, escape="\\"),
+        Patient.medical_record_number.like(_escape_like(q) + "%", escape="\\"),
+        Patient.phone.like(_escape_like(q) + "%", escape="\\"),
+        func.lower(Patient.email).like(prefix, escape="\\"),
+    )
+    # % is the pg_trgm similarity operator (default threshold 0.3)
+    fuzzy_match = full_name.op("%")(lowered)
+    score = case((prefix_match, literal(1.0)), else_=literal(0.0)) + func.similarity(full_name, lowered)
+
+    return (
+        db.query(Patient)
+        .filter(or_(prefix_match, fuzzy_match))
+        .order_by(score.desc(), Patient.id)
+        .offset(skip)
+        .limit(limit)
+        .all()
+    )
+
+
+def _search_sqlite(db: Session, q: str, skip: int, limit: int):
+    """Ranked search using the FTS5 word prefix and trigram shadow tables"""
+    wanted = skip + limit
+    ids = []
+    if re.search(r"\w", q):
+        # Word prefix matches rank first. A prefix too short for trigrams can
+        # match a large share of the table, so those stay in id order rather
+        # than paying for ranking every match.
+        order = "rank" if len(q) >= MIN_TRIGRAM_LENGTH else "rowid"
+        ids = [row[0] for row in db.execute(text(
+            "SELECT rowid FROM patients_prefix WHERE patients_prefix MATCH :prefix "
+            f"ORDER BY {order} LIMIT :wanted"
+        ), {"prefix": _fts_phrase(q) + " *", "wanted": wanted}).all()]
+    if len(q) >= MIN_TRIGRAM_LENGTH and len(ids) < wanted:
+        # ... then substring matches ...
+        seen = set(ids)
+        rows = db.execute(text(
+            "SELECT rowid FROM patients_search WHERE patients_search MATCH :phrase "
+            "ORDER BY rank LIMIT :wanted"
+        ), {"phrase": _fts_phrase(q), "wanted": wanted}).all()
+        ids += [row[0] for row in rows if row[0] not in seen]
+        # ... then fuzzy matches: rows sharing the most trigrams with the query
+        if len(ids) < wanted:
+            trigrams = {q[i:i + MIN_TRIGRAM_LENGTH] for i in range(len(q) - MIN_TRIGRAM_LENGTH + 1)}
+            fuzzy = " OR ".join(_fts_phrase(trigram) for trigram in sorted(trigrams))
+            rows = db.execute(text(
+                "SELECT rowid FROM patients_search WHERE patients_search MATCH :fuzzy "
+                "ORDER BY rank LIMIT :wanted"
+            ), {"fuzzy": "full_name : (" + fuzzy + ")", "wanted": wanted}).all()
+            seen = set(ids)
+            ids += [row[0] for row in rows if row[0] not in seen]
+
+    ids = ids[skip:wanted]
+    if not ids:
+        return []
+    patients = {p.id: p for p in db.query(Patient).filter(Patient.id.in_(ids)).all()}
+    return [patients[patient_id] for patient_id in ids if patient_id in patients]
+
+
+# ============= VISIT SEARCH =============
+
+# Terms of a web-search style query: "quoted phrases", OR, and -exclusions
+_QUERY_TERM = re.compile(r'(-?)"([^"]*)"?|(\S+)')
+
+# Only the newest matches are ranked, which bounds the cost of very common
+# terms; results within them are still ordered by relevance, and the
+# response says when there were more matches than that
+SEARCH_MAX_CANDIDATES = int(os.getenv("SEARCH_MAX_CANDIDATES", "5000"))
+
+# Snippet markers around matched terms
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_END = "</mark>"
+
+
+def _fts_visit_query(q: str):
+    """
+    Translate web-search syntax into an FTS5 query with the same meaning as
+    PostgreSQL's websearch_to_tsquery. Returns None if nothing can match.
+    """
+    groups, excluded = [[]], []
+    for negate, phrase, word in _QUERY_TERM.findall(q):
+        if word == "OR":
+            groups.append([])
+            continue
+        if word.startswith("-") and len(word) > 1:
+            negate, word = "-", word[1:]
+        # Punctuation is a token separator for unicode61, just like in to_tsvector
+        tokens = re.findall(r"\w+", phrase if phrase else word)
+        if not tokens:
+            continue
+        term = _fts_phrase(" ".join(tokens))
+        (excluded if negate else groups[-1]).append(term)
+
+    groups = [" AND ".join(group) for group in groups if group]
+    if not groups:
+        return None
+    query = " OR ".join(f"({group})" for group in groups)
+    if excluded:
+        query = f"({query}) NOT ({' OR '.join(excluded)})"
+    return query
+
+
+def search_visits(db: Session, q: str, patient_id: int = None, start=None, end=None,
+                  skip: int = 0, limit: int = 20):
+    """
+    Full-text search over visit reason, diagnosis, treatment and notes.
+    Supports "quoted phrases", OR and -exclusions; start/end bound visit_date
+    (inclusive) and patient_id restricts to one patient. The newest
+    SEARCH_MAX_CANDIDATES matches are ranked. Returns (hits, truncated):
+    (visit, snippet, rank) tuples, best match first, and whether more visits
+    matched than were ranked.
+    """
+    q = q.strip()
+    if not q:
+        return [], False
+    if db.get_bind().dialect.name == "sqlite":
+        return _search_visits_sqlite(db, q, patient_id, start, end, skip, limit)
+    return _search_visits_postgres(db, q, patient_id, start, end, skip, limit)
+
+
+def _visit_filters(patient_id, start, end):
+    """SQL conditions and parameters for the optional visit filters"""
+    conditions, params = [], {}
+    if patient_id is not None:
+        conditions.append("v.patient_id = :patient_id")
+        params["patient_id"] = patient_id
+    if start is not None:
+        conditions.append("v.visit_date >= :start")
+        params["start"] = start
+    if end is not None:
+        # Inclusive of the whole end day
+        conditions.append("v.visit_date < :end")
+        params["end"] = end + timedelta(days=1)
+    return "".join(f" AND {condition}" for condition in conditions), params
+
+
+def _truncated(db: Session, matches: str, params: dict, skip: int, limit: int, found: int):
+    """Whether more than SEARCH_MAX_CANDIDATES visits match - matches is the unordered matching query"""
+    if found < limit and (found or not skip) and skip + found < SEARCH_MAX_CANDIDATES:
+        # A short page: every candidate has been seen and there were fewer than the cap
+        return False
+    return db.execute(
+        text(f"SELECT count(*) FROM ({matches} LIMIT :over) matches"),
+        {**params, "over": SEARCH_MAX_CANDIDATES + 1},
+    ).scalar() > SEARCH_MAX_CANDIDATES
+
+
+def _load_hits(db: Session, rows):
+    """Turn (id, snippet, rank) rows into (visit, snippet, rank), keeping their order"""
+    if not rows:
+        return []
+    visits = {v.id: v for v in db.query(Visit).filter(Visit.id.in_([row[0] for row in rows])).all()}
+    return [(visits[row[0]], row[1], row[2]) for row in rows if row[0] in visits]
+
+
+def _search_visits_postgres(db: Session, q, patient_id, start, end, skip, limit):
+    """Ranked search using the tsvector GIN index"""
+    filters, params = _visit_filters(patient_id, start, end)
+    # Take the newest matches from the index, rank those and cut one page,
+    # then build snippets for that page only - ts_rank_cd and ts_headline
+    # both reparse the text, so neither may run once per match
+    rows = db.execute(text(
+        "WITH query AS (SELECT websearch_to_tsquery('english', :q) AS tsq), "
+        "candidates AS ("
+        "  SELECT v.id, v.visit_date, v.reason, v.diagnosis, v.treatment, v.notes "
+        "  FROM visits v, query "
+        f"  WHERE ({VISIT_SEARCH_VECTOR}) @@ query.tsq{filters} "
+        "  ORDER BY v.id DESC LIMIT :candidates"
+        "), "
+        "page AS ("
+        f"  SELECT id, visit_date, ts_rank_cd({VISIT_SEARCH_VECTOR}, query.tsq) AS rank "
+        "  FROM candidates, query "
+        "  ORDER BY rank DESC, visit_date DESC, id DESC "
+        "  OFFSET :skip LIMIT :limit"
+        ") "
+        "SELECT page.id, ts_headline('english', "
+        "  concat_ws(' ... ', v.reason, v.diagnosis, v.treatment, v.notes), query.tsq, "
+        f"  'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, MaxFragments=2, MaxWords=20, MinWords=5'"
+        "), page.rank "
+        "FROM page JOIN visits v ON v.id = page.id, query "
+        "ORDER BY page.rank DESC, page.visit_date DESC, page.id DESC"
+    ), {"q": q, "skip": skip, "limit": limit, "candidates": SEARCH_MAX_CANDIDATES, **params}).all()
+    truncated = _truncated(
+        db, f"SELECT 1 FROM visits v WHERE ({VISIT_SEARCH_VECTOR}) @@ websearch_to_tsquery('english', :q){filters}",
+        {"q": q, **params}, skip, limit, len(rows),
+    )
+    return _load_hits(db, rows), truncated
+
+
+def _search_visits_sqlite(db: Session, q, patient_id, start, end, skip, limit):
+    """Ranked search using the FTS5 shadow table"""
+    match = _fts_visit_query(q)
+    if match is None:
+        return [], False
+    filters, params = _visit_filters(patient_id, start, end)
+    # FTS5 returns matches in rowid order, so only the newest candidates get
+    # scored; bm25 weights mirror the PostgreSQL setweight classes (bm25 is
+    # lower for better matches)
+    page = db.execute(text(
+        "SELECT id, rank FROM ("
+        "  SELECT s.rowid AS id, v.visit_date, -bm25(visits_search, 10.0, 10.0, 4.0, 1.0) AS rank "
+        "  FROM visits_search s JOIN visits v ON v.id = s.rowid "
+        f"  WHERE visits_search MATCH :match{filters} "
+        "  ORDER BY s.rowid DESC LIMIT :candidates"
+        ") ORDER BY rank DESC, visit_date DESC, id DESC LIMIT :limit OFFSET :skip"
+    ), {"match": match, "skip": skip, "limit": limit, "candidates": SEARCH_MAX_CANDIDATES, **params}).all()
+    truncated = _truncated(
+        db, f"SELECT 1 FROM visits_search s JOIN visits v ON v.id = s.rowid WHERE visits_search MATCH :match{filters}",
+        {"match": match, **params}, skip, limit, len(page),
+    )
+    if not page:
+        return [], truncated
+
+    ids = ", ".join(str(row[0]) for row in page)
+    snippets = dict(db.execute(text(
+        "SELECT rowid, "
+        f"snippet(visits_search, -1, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}', ' ... ', 16) "
+        f"FROM visits_search WHERE visits_search MATCH :match AND rowid IN ({ids})"
+    ), {"match": match}).all())
+    return _load_hits(db, [(row[0], snippets.get(row[0], ""), row[1]) for row in page]), truncated
@@ -0,0 +1,535 @@
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.orm import Session
+from models import (
+    Patient, Visit, Document, StatCounter, DailyStat, VisitRollup, RollupReason,
+    StatCounterDelta, DailyStatDelta, VisitRollupDelta,
+)
+import partitions
+
+# Materialized statistics for /api/analytics/stats.
+# Totals live in stat_counters and per-day counts in daily_stats. The CRUD
+# functions record their changes in the same transaction as the change
+# itself, so the endpoint reads a handful of rows instead of counting whole
+# tables. A periodic reconcile recounts from the source tables to correct
+# any drift.
+#
+# Visit trends work the same way: visit_rollups holds day/week/month counts
+# per reason, gender and age band, so /api/analytics/trends reads a few
+# hundred pre-aggregated rows rather than grouping the whole visits table.
+# Reasons are free text, so they are rolled up on a normalized form (trimmed,
+# lower case) and only the ROLLUP_MAX_REASONS most common ones - listed in
+# rollup_reasons - get rows of their own; the rest count as "other". Until
+# the list is full, new reasons are added as they are first seen;
+# rebuild_rollups picks the most common ones afresh.
+#
+# Writers never update those rows directly: every patient or visit created
+# would otherwise update the same "patients" / "visits" counter row, and on
+# PostgreSQL hold its lock until commit, so concurrent writes would queue up
+# behind each other. Instead each transaction inserts its changes into the
+# *_deltas tables, and a background fold moves them into the aggregates
+# every STATS_FOLD_SECONDS. Readers add up both, so the figures are exact
+# the moment a write commits. Reconcile works out its corrections from a
+# single snapshot and records them as deltas too.
+
+WINDOW_DAYS = 30
+
+# How often the background reconcile runs (0 disables it)
+STATS_RECONCILE_SECONDS = int(os.getenv("STATS_RECONCILE_SECONDS", "900"))
+# How often pending deltas are folded into the aggregate tables (0 disables it)
+STATS_FOLD_SECONDS = int(os.getenv("STATS_FOLD_SECONDS", "5"))
+# Distinct visit reasons the rollups keep apart
+ROLLUP_MAX_REASONS = int(os.getenv("ROLLUP_MAX_REASONS", "50"))
+OTHER_REASON = "other"
+
+logger = logging.getLogger(__name__)
+
+
+def _as_date(value):
+    """Normalize a date/datetime/ISO string (SQLite's date()) to a date"""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    return value
+
+
+def _insert_ignore(db: Session, model, values: dict):
+    """Insert a row unless one with the same primary key exists"""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        if db.get(model, tuple(values.values())) is None:
+            db.add(model(**values))
+        return
+    db.execute(insert(model).values(**values).on_conflict_do_nothing())
+
+
+def _upsert_add(db: Session, model, keys: dict, deltas: dict):
+    """Add deltas (column -> delta) to the row identified by keys, creating it if needed"""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        query = update(model).values({column: getattr(model, column) + delta for column, delta in deltas.items()})
+        for key, value in keys.items():
+            query = query.where(getattr(model, key) == value)
+        if db.execute(query).rowcount == 0:
+            db.add(model(**keys, **deltas))
+        return
+
+    stmt = insert(model).values(**keys, **deltas)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[getattr(model, key) for key in keys],
+        set_={column: getattr(model, column) + delta for column, delta in deltas.items()}
+    )
+    db.execute(stmt)
+
+
+def bump(db: Session, counters=None, new_patients=None, visits=None):
+    """
+    Record deltas to the statistics inside the caller's transaction.
+    counters maps counter name -> delta; new_patients and visits map day -> delta.
+    """
+    rows = [{"name": name, "value": delta} for name, delta in (counters or {}).items() if delta]
+    if rows:
+        db.execute(insert(StatCounterDelta), rows)
+
+    days = {}
+    for day, delta in (new_patients or {}).items():
+        days.setdefault(_as_date(day), [0, 0])[0] += delta
+    for day, delta in (visits or {}).items():
+        days.setdefault(_as_date(day), [0, 0])[1] += delta
+    rows = [
+        {"day": day, "new_patients": new_patients, "visits": visits}
+        for day, (new_patients, visits) in days.items() if new_patients or visits
+    ]
+    if rows:
+        db.execute(insert(DailyStatDelta), rows)
+
+
+def get_counters(db: Session, names=None):
+    """Counter values - the folded totals plus any deltas not folded in yet"""
+    counters = {}
+    for model in (StatCounter, StatCounterDelta):
+        query = select(model.name, func.sum(model.value)).group_by(model.name)
+        if names is not None:
+            query = query.where(model.name.in_(names))
+        for name, value in db.execute(query):
+            counters[name] = counters.get(name, 0) + int(value)
+    return counters
+
+
+def _daily(db: Session, since: date):
+    """day -> [new_patients, visits] from daily_stats plus pending deltas, from since on"""
+    days = {}
+    for model in (DailyStat, DailyStatDelta):
+        for day, new_patients, visits in db.execute(
+            select(model.day, func.sum(model.new_patients), func.sum(model.visits))
+            .where(model.day >= since).group_by(model.day)
+        ):
+            counts = days.setdefault(_as_date(day), [0, 0])
+            counts[0] += int(new_patients)
+            counts[1] += int(visits)
+    return days
+
+
+# delta table -> (aggregate table, key columns, value columns)
+DELTA_TABLES = {
+    StatCounterDelta: (StatCounter, ("name",), ("value",)),
+    DailyStatDelta: (DailyStat, ("day",), ("new_patients", "visits")),
+    VisitRollupDelta: (VisitRollup, ("granularity", "period_start", "reason", "gender", "age_band"), ("visit_count",)),
+}
+
+
+def fold(db: Session):
+    """Move the pending deltas into the aggregate tables"""
+    for delta_model, (model, keys, columns) in DELTA_TABLES.items():
+        # DELETE ... RETURNING claims the rows, so concurrent folds never add one twice
+        rows = db.execute(
+            delete(delta_model).returning(*(getattr(delta_model, column) for column in keys + columns))
+        ).all()
+        totals = {}
+        for row in rows:
+            sums = totals.setdefault(tuple(row[:len(keys)]), [0] * len(columns))
+            for i, value in enumerate(row[len(keys):]):
+                sums[i] += value
+        # In key order, so folds running in two processes lock rows in the same order
+        for key in sorted(totals):
+            if any(totals[key]):
+                _upsert_add(db, model, dict(zip(keys, key)), dict(zip(columns, totals[key])))
+        db.commit()
+    # Pick up reasons another process has added, or a rebuild has replaced
+    _load_reasons(db)
+
+
+# ============= VISIT ROLLUPS =============
+
+ROLLUP_GRANULARITIES = ("day", "week", "month")
+ROLLUP_GROUPS = ("reason", "gender", "age_band")
+AGE_BANDS = ((18, "0-17"), (35, "18-34"), (50, "35-49"), (65, "50-64"))
+
+
+def age_band(date_of_birth: date, on: date):
+    """Age band of a patient on a given day"""
+    age = on.year - date_of_birth.year - ((on.month, on.day) < (date_of_birth.month, date_of_birth.day))
+    for upper, band in AGE_BANDS:
+        if age < upper:
+            return band
+    return "65+"
+
+
+def period_start(day: date, granularity: str):
+    """First day of the day/week (Monday)/month containing day"""
+    if granularity == "week":
+        return day - timedelta(days=day.weekday())
+    if granularity == "month":
+        return day.replace(day=1)
+    return day
+
+
+def rollup_deltas(visits, delta: int = 1):
+    """
+    Turn (visit_date, reason, gender, date_of_birth) tuples into rollup deltas,
+    keyed by (granularity, period_start, reason, gender, age_band).
+    """
+    deltas = {}
+    for visit_date, reason, gender, date_of_birth in visits:
+        day = _as_date(visit_date)
+        band = age_band(date_of_birth, day)
+        for granularity in ROLLUP_GRANULARITIES:
+            key = (granularity, period_start(day, granularity), reason, gender or "Unknown", band)
+            deltas[key] = deltas.get(key, 0) + delta
+    return deltas
+
+
+def normalize_reason(reason: str):
+    """The form of a visit reason the rollups are keyed on"""
+    return " ".join((reason or "").split()).lower() or OTHER_REASON
+
+
+_reasons = None  # the reasons in rollup_reasons, loaded on first use
+
+
+def _load_reasons(db: Session):
+    global _reasons
+    _reasons = set(db.execute(select(RollupReason.reason)).scalars())
+    return _reasons
+
+
+def rollup_reason(db: Session, reason: str):
+    """The reason a visit is rolled up under: its normalized form if tracked, otherwise "other" """
+    reason = normalize_reason(reason)
+    reasons = _reasons if _reasons is not None else _load_reasons(db)
+    if reason in reasons:
+        return reason
+    if len(reasons) >= ROLLUP_MAX_REASONS:
+        return OTHER_REASON
+    _insert_ignore(db, RollupReason, {"reason": reason})
+    reasons.add(reason)
+    return reason
+
+
+def _regroup(deltas: dict, reason_key):
+    """Re-key rollup deltas with reason_key(reason), merging the ones that collide"""
+    regrouped = {}
+    for (granularity, start, reason, gender, band), delta in deltas.items():
+        key = (granularity, start, reason_key(reason), gender, band)
+        regrouped[key] = regrouped.get(key, 0) + delta
+    return regrouped
+
+
+def bump_rollups(db: Session, deltas: dict):
+    """Record rollup deltas inside the caller's transaction"""
+    rows = [
+        {"granularity": granularity, "period_start": start, "reason": reason,
+         "gender": gender, "age_band": band, "visit_count": delta}
+        for (granularity, start, reason, gender, band), delta in _regroup(
+            deltas, lambda reason: rollup_reason(db, reason)
+        ).items() if delta
+    ]
+    if rows:
+        db.execute(insert(VisitRollupDelta), rows)
+
+
+def rebuild_rollups(db: Session, chunk_size: int = 10000):
+    """Recompute all visit rollups from the visits table and the visit archive"""
+    rows = db.query(Visit.visit_date, Visit.reason, Patient.gender, Patient.date_of_birth).join(
+        Patient, Visit.patient_id == Patient.id
+    ).yield_per(chunk_size)
+    deltas = rollup_deltas(rows)
+    archived = partitions.read_archive(
+        partitions.archive_paths(db), (Visit.visit_date, Visit.reason, Visit.patient_id)
+    )
+    if archived:
+        demographics = {
+            patient_id: (gender, date_of_birth) for patient_id, gender, date_of_birth in
+            db.query(Patient.id, Patient.gender, Patient.date_of_birth)
+        }
+        for key, delta in rollup_deltas(
+            (visit_date, reason, *demographics[patient_id]) for visit_date, reason, patient_id in archived
+            if patient_id in demographics
+        ).items():
+            deltas[key] = deltas.get(key, 0) + delta
+
+    # Track the most common reasons, counted once per visit (on the day rollups)
+    deltas = _regroup(deltas, normalize_reason)
+    counts = {}
+    for (granularity, _, reason, _, _), count in deltas.items():
+        if granularity == "day":
+            counts[reason] = counts.get(reason, 0) + count
+    reasons = set(sorted(counts, key=lambda reason: (-counts[reason], reason))[:ROLLUP_MAX_REASONS])
+    deltas = _regroup(deltas, lambda reason: reason if reason in reasons else OTHER_REASON)
+    db.query(RollupReason).delete()
+    db.add_all(RollupReason(reason=reason) for reason in reasons)
+
+    db.query(VisitRollupDelta).delete()
+    db.query(VisitRollup).delete()
+    # Core insert on the connection -> a plain executemany; there can be
+    # hundreds of thousands of rollup rows
+    rows = [
+        {"granularity": granularity, "period_start": start, "reason": reason,
+         "gender": gender, "age_band": band, "visit_count": count}
+        for (granularity, start, reason, gender, band), count in deltas.items()
+    ]
+    for offset in range(0, len(rows), chunk_size):
+        db.connection().execute(insert(VisitRollup.__table__), rows[offset:offset + chunk_size])
+    db.commit()
+    _load_reasons(db)
+
+
+def get_trends(db: Session, granularity: str = "month", start: date = None, end: date = None, group_by: str = None):
+    """Visit counts per period from the rollup table, optionally broken down by one dimension"""
+    if granularity not in ROLLUP_GRANULARITIES:
+        raise ValueError(f"Invalid granularity: {granularity}")
+    if group_by is not None and group_by not in ROLLUP_GROUPS:
+        raise ValueError(f"Invalid group_by: {group_by}")
+
+    counts = {}
+    for model in (VisitRollup, VisitRollupDelta):
+        columns = [model.period_start]
+        if group_by:
+            columns.append(getattr(model, group_by))
+        query = db.query(*columns, func.sum(model.visit_count)).filter(model.granularity == granularity)
+        if start:
+            query = query.filter(model.period_start >= period_start(start, granularity))
+        if end:
+            query = query.filter(model.period_start <= end)
+        for *key, count in query.group_by(*columns):
+            key = (_as_date(key[0]), *key[1:])
+            counts[key] = counts.get(key, 0) + int(count)
+
+    trends = []
+    for key in sorted(counts):
+        start_day = key[0]
+        trend = {
+            "period_start": start_day.isoformat(),
+            "year": start_day.year,
+            "month": start_day.month,
+            "visit_count": counts[key],
+        }
+        if group_by:
+            trend[group_by] = key[1]
+        if trend["visit_count"]:
+            trends.append(trend)
+    return trends
+
+
+# ============= CRUD HOOKS =============
+
+def record_patient_created(db: Session, created_at: datetime):
+    """Count a new patient"""
+    bump(db, {"patients": 1}, new_patients={created_at: 1})
+
+
+def record_visit_created(db: Session, visit_date: datetime, reason: str, patient: Patient):
+    """Count a new visit"""
+    bump(db, {"visits": 1}, visits={visit_date: 1})
+    bump_rollups(db, rollup_deltas([(visit_date, reason, patient.gender, patient.date_of_birth)]))
+
+
+def record_document_created(db: Session):
+    """Count a new document"""
+    bump(db, {"documents": 1})
+
+
+def _patient_visits(db: Session, patient_id: int):
+    """(visit_date, reason) of each of a patient's visits, archived ones included"""
+    columns = (Visit.visit_date, Visit.reason)
+    visits = db.query(*columns).filter(Visit.patient_id == patient_id).all()
+    return visits + partitions.archived_visits(db, patient_id, columns)
+
+
+def record_patient_deleted(db: Session, patient: Patient):
+    """Subtract a patient and everything that cascades with them"""
+    visits = _patient_visits(db, patient.id)
+    document_count = db.query(func.count(Document.id)).filter(
+        Document.patient_id == patient.id
+    ).scalar()
+
+    visit_days = {}
+    for visit_date, _ in visits:
+        visit_days[_as_date(visit_date)] = visit_days.get(_as_date(visit_date), 0) - 1
+    bump(
+        db,
+        {"patients": -1, "visits": -len(visits), "documents": -document_count},
+        new_patients={patient.created_at: -1} if patient.created_at else None,
+        visits=visit_days,
+    )
+    bump_rollups(db, rollup_deltas(
+        [(visit_date, reason, patient.gender, patient.date_of_birth) for visit_date, reason in visits],
+        delta=-1
+    ))
+
+
+def record_patient_demographics_changed(db: Session, patient: Patient, old_gender: str, old_date_of_birth: date):
+    """Move a patient's visits to their new gender / age band rollups"""
+    visits = _patient_visits(db, patient.id)
+    deltas = rollup_deltas(
+        [(visit_date, reason, old_gender, old_date_of_birth) for visit_date, reason in visits], delta=-1
+    )
+    for key, delta in rollup_deltas(
+        [(visit_date, reason, patient.gender, patient.date_of_birth) for visit_date, reason in visits]
+    ).items():
+        deltas[key] = deltas.get(key, 0) + delta
+    bump_rollups(db, deltas)
+
+
+def _begin_snapshot(db: Session):
+    """Begin a transaction whose reads all see the same snapshot of the database"""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    elif dialect == "sqlite":
+        # pysqlite only opens a transaction at the first write; take the write
+        # lock up front so nothing commits between the counts and the corrections
+        db.connection().exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def reconcile(db: Session):
+    """
+    Recount totals and the recent daily buckets from the source tables, and
+    record the differences from the current figures as deltas
+    """
+    fold(db)
+    _begin_snapshot(db)
+    since = datetime.utcnow().date() - timedelta(days=WINDOW_DAYS + 1)
+
+    totals = {
+        "patients": db.query(func.count(Patient.id)).scalar(),
+        "visits": db.query(func.count(Visit.id)).scalar() + partitions.archived_count(db),
+        "documents": db.query(func.count(Document.id)).scalar(),
+    }
+    days = {}
+    for day, count in db.query(func.date(Patient.created_at), func.count(Patient.id)).filter(
+        Patient.created_at >= since
+    ).group_by(func.date(Patient.created_at)):
+        days.setdefault(_as_date(day), [0, 0])[0] = count
+    for day, count in db.query(func.date(Visit.visit_date), func.count(Visit.id)).filter(
+        Visit.visit_date >= since
+    ).group_by(func.date(Visit.visit_date)):
+        days.setdefault(_as_date(day), [0, 0])[1] = count
+
+    counters = get_counters(db, tuple(totals))
+    current = _daily(db, since)
+    new_patients, visits = {}, {}
+    for day in days.keys() | current.keys():
+        actual, recorded = days.get(day, [0, 0]), current.get(day, [0, 0])
+        new_patients[day] = actual[0] - recorded[0]
+        visits[day] = actual[1] - recorded[1]
+    bump(
+        db, {name: value - counters.get(name, 0) for name, value in totals.items()},
+        new_patients=new_patients, visits=visits,
+    )
+    db.merge(StatCounter(name="reconciled_at", value=int(time.time())))
+    db.commit()
+
+
+def get_stats(db: Session):
+    """Read the materialized statistics"""
+    counters = get_counters(db)
+    since = (datetime.utcnow() - timedelta(days=WINDOW_DAYS)).date()
+    days = _daily(db, since).values()
+    new_patients = sum(new_patients for new_patients, _ in days)
+    recent_visits = sum(visits for _, visits in days)
+
+    total_patients = counters.get("patients", 0)
+    total_visits = counters.get("visits", 0)
+    reconciled_at = counters.get("reconciled_at")
+    return {
+        "total_patients": total_patients,
+        "total_visits": total_visits,
+        "total_documents": counters.get("documents", 0),
+        "recent_visits_30d": recent_visits,
+        "new_patients_30d": new_patients,
+        "avg_visits_per_patient": round(total_visits / total_patients, 2) if total_patients > 0 else 0,
+        "last_reconciled_at": datetime.utcfromtimestamp(reconciled_at).isoformat() if reconciled_at else None,
+        "staleness_seconds": int(time.time()) - reconciled_at if reconciled_at else None,
+    }
+
+
+def init_stats(session_factory):
+    """Seed the counters and rollups on first run"""
+    db = session_factory()
+    try:
+        if db.get(StatCounter, "reconciled_at") is None:
+            reconcile(db)
+        # Also rebuilds rollups from before reasons were normalized
+        if (db.execute(select(VisitRollup.granularity).limit(1)).first() is None
+                or db.execute(select(RollupReason.reason).limit(1)).first() is None):
+            rebuild_rollups(db)
+    finally:
+        db.close()
+
+
+def start_reconcile_thread(session_factory, interval: int = STATS_RECONCILE_SECONDS,
+                           fold_interval: int = STATS_FOLD_SECONDS):
+    """Fold deltas every fold_interval seconds and reconcile every interval seconds in a daemon thread"""
+    if interval <= 0 and fold_interval <= 0:
+        return None
+
+    def loop():
+        reconciled = time.monotonic()
+        while True:
+            time.sleep(fold_interval if fold_interval > 0 else interval)
+            db = session_factory()
+            try:
+                if interval > 0 and time.monotonic() - reconciled >= interval:
+                    reconciled = time.monotonic()
+                    reconcile(db)  # folds first
+                else:
+                    fold(db)
+            except Exception:
+                db.rollback()
+                logger.exception("Stats reconcile failed")
+            finally:
+                db.close()
+
+    thread = threading.Thread(target=loop, name="stats-reconcile", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    import sys
+    from database import SessionLocal, init_db
+
+    init_db()
+    db = SessionLocal()
+    try:
+        reconcile(db)
+        # "python stats.py rollups" also rebuilds the visit rollups from scratch
+        if "rollups" in sys.argv[1:]:
+            rebuild_rollups(db)
+        print(get_stats(db))
+    finally:
+        db.close()
@@ -0,0 +1,218 @@
+import hashlib
+import os
+import time
+import uuid
+
+# Document file storage.
+# Content is stored once per SHA-256 hash, so uploading the same file twice
+# keeps a single copy. Writers take data in whatever pieces arrive and flush
+# it in fixed-size chunks, and readers yield fixed-size chunks, so memory use
+# stays at a few chunks no matter how large the file is.
+#
+# STORAGE_BACKEND selects the backend:
+#   local - files under STORAGE_DIR (default)
+#   azure - Azure Blob Storage (or the Azurite emulator) via
+#           AZURE_STORAGE_CONNECTION_STRING and AZURE_STORAGE_CONTAINER
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local").lower()
+STORAGE_DIR = os.getenv("STORAGE_DIR", "./storage")
+STORAGE_CHUNK_SIZE = int(os.getenv("STORAGE_CHUNK_SIZE", str(1024 * 1024)))
+AZURE_STORAGE_CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING", "")
+AZURE_STORAGE_CONTAINER = os.getenv("AZURE_STORAGE_CONTAINER", "documents")
+
+
+class StoredFile:
+    """Result of a finished upload"""
+
+    def __init__(self, sha256: str, size: int, url: str, deduplicated: bool):
+        self.sha256 = sha256
+        self.size = size
+        self.url = url
+        self.deduplicated = deduplicated
+
+
+# ============= LOCAL FILESYSTEM =============
+
+class LocalWriter:
+    """Streams an upload to a temp file while hashing it"""
+
+    def __init__(self, storage: "LocalStorage"):
+        self.storage = storage
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.temp_path = os.path.join(storage.root, "tmp", uuid.uuid4().hex)
+        os.makedirs(os.path.dirname(self.temp_path), exist_ok=True)
+        self.file = open(self.temp_path, "wb", buffering=storage.chunk_size)
+
+    def write(self, data: bytes):
+        """Append data to the upload"""
+        self.hash.update(data)
+        self.size += len(data)
+        self.file.write(data)
+
+    def commit(self):
+        """Move the upload to its content address, or drop it if already stored"""
+        self.file.close()
+        sha256 = self.hash.hexdigest()
+        path = self.storage.path_for(sha256)
+        if os.path.exists(path):
+            os.remove(self.temp_path)
+            return StoredFile(sha256, self.size, self.storage.url_for(sha256), deduplicated=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.temp_path, path)
+        return StoredFile(sha256, self.size, self.storage.url_for(sha256), deduplicated=False)
+
+    def abort(self):
+        """Discard the upload"""
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class LocalStorage:
+    """Content-addressed files under a local directory"""
+
+    def __init__(self, root: str = STORAGE_DIR, chunk_size: int = STORAGE_CHUNK_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+
+    def path_for(self, sha256: str):
+        """Local path of the file with the given hash"""
+        return os.path.join(self.root, "objects", sha256[:2], sha256[2:4], sha256)
+
+    def url_for(self, sha256: str):
+        """Value stored in Document.file_url"""
+        return os.path.abspath(self.path_for(sha256))
+
+    def open_writer(self):
+        """Start a new upload"""
+        return LocalWriter(self)
+
+    def size(self, sha256: str):
+        """Size in bytes of the stored file"""
+        return os.path.getsize(self.path_for(sha256))
+
+    def read(self, sha256: str, start: int = 0, end: int = None):
+        """Yield the bytes from start to end (inclusive) in chunks"""
+        remaining = (end if end is not None else self.size(sha256) - 1) - start + 1
+        with open(self.path_for(sha256), "rb") as f:
+            f.seek(start)
+            while remaining > 0:
+                chunk = f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+# ============= AZURE BLOB STORAGE =============
+
+class AzureWriter:
+    """Streams an upload as staged blocks on a temporary blob while hashing it"""
+
+    def __init__(self, storage: "AzureStorage"):
+        self.storage = storage
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.blob = storage.container.get_blob_client(f"uploads/{uuid.uuid4().hex}")
+        self.block_ids = []
+        self.buffer = bytearray()
+
+    def _stage(self):
+        block_id = f"{len(self.block_ids):08d}"
+        self.blob.stage_block(block_id, bytes(self.buffer))
+        self.block_ids.append(block_id)
+        self.buffer.clear()
+
+    def write(self, data: bytes):
+        """Append data to the upload"""
+        self.hash.update(data)
+        self.size += len(data)
+        self.buffer.extend(data)
+        if len(self.buffer) >= self.storage.chunk_size:
+            self._stage()
+
+    def commit(self):
+        """Copy the upload to its content address, or drop it if already stored"""
+        from azure.storage.blob import BlobBlock
+
+        if self.buffer or not self.block_ids:
+            self._stage()
+        sha256 = self.hash.hexdigest()
+        target = self.storage.container.get_blob_client(self.storage.name_for(sha256))
+        deduplicated = target.exists()
+        if not deduplicated:
+            self.blob.commit_block_list([BlobBlock(block_id=block_id) for block_id in self.block_ids])
+            # Server-side copy - the data doesn't pass through this process again
+            target.start_copy_from_url(self.blob.url)
+            while target.get_blob_properties().copy.status == "pending":
+                time.sleep(0.2)
+            self.blob.delete_blob()
+        return StoredFile(sha256, self.size, target.url, deduplicated=deduplicated)
+
+    def abort(self):
+        """Discard the upload"""
+        # Uncommitted blocks are garbage collected by the service
+        self.buffer.clear()
+
+
+class AzureStorage:
+    """Content-addressed blobs in an Azure Storage container"""
+
+    def __init__(self, connection_string: str = AZURE_STORAGE_CONNECTION_STRING,
+                 container: str = AZURE_STORAGE_CONTAINER, chunk_size: int = STORAGE_CHUNK_SIZE):
+        from azure.core.exceptions import ResourceExistsError
+        from azure.storage.blob import BlobServiceClient  # optional dependency
+
+        # Download in chunk_size pieces so reads stay bounded
+        service = BlobServiceClient.from_connection_string(
+            connection_string, max_single_get_size=chunk_size, max_chunk_get_size=chunk_size
+        )
+        self.container = service.get_container_client(container)
+        try:
+            self.container.create_container()
+        except ResourceExistsError:
+            pass
+        self.chunk_size = chunk_size
+
+    def name_for(self, sha256: str):
+        """Blob name of the file with the given hash"""
+        return f"objects/{sha256}"
+
+    def url_for(self, sha256: str):
+        """Value stored in Document.file_url"""
+        return self.container.get_blob_client(self.name_for(sha256)).url
+
+    def open_writer(self):
+        """Start a new upload"""
+        return AzureWriter(self)
+
+    def size(self, sha256: str):
+        """Size in bytes of the stored file"""
+        return self.container.get_blob_client(self.name_for(sha256)).get_blob_properties().size
+
+    def read(self, sha256: str, start: int = 0, end: int = None):
+        """Yield the bytes from start to end (inclusive) in chunks"""
+        length = None if end is None else end - start + 1
+        downloader = self.container.download_blob(
+            self.name_for(sha256), offset=start, length=length, max_concurrency=1
+        )
+        yield from downloader.chunks()
+
+
+def create_storage(backend: str = STORAGE_BACKEND):
+    """Build the storage backend selected by configuration"""
+    if backend == "azure":
+        return AzureStorage()
+    return LocalStorage()
+
+
+_storage = None
+
+
+def get_storage():
+    """The configured storage backend, created on first use"""
+    global _storage
+    if _storage is None:
+        _storage = create_storage()
+    return _storage
@@ -0,0 +1,79 @@
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+# database.py reads its configuration at import, so point it at a scratch
+# SQLite file before any test imports it
+_scratch = tempfile.mkdtemp(prefix="healthplus-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_scratch, 'test.db')}"
+os.environ["JOB_WORKERS"] = "0"
+os.environ["CACHE_BACKEND"] = "none"
+os.environ["STORAGE_DIR"] = os.path.join(_scratch, "storage")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import database
+import partitions
+
+
+@pytest.fixture(scope="session", autouse=True)
+def schema():
+    database.init_db()
+
+
+@pytest.fixture
+def db():
+    session = database.SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def partitioned_db(tmp_path, monkeypatch):
+    """
+    A session on a separate SQLite database set up with VISIT_PARTITIONING on,
+    so visits is a view over yearly tables. database.engine points at it for
+    the duration of the test.
+    """
+    url = f"sqlite:///{tmp_path / 'partitioned.db'}"
+    engine = create_engine(url, **database.get_engine_options(url))
+    monkeypatch.setattr(database, "engine", engine)
+    monkeypatch.setattr(database, "SessionLocal", sessionmaker(autocommit=False, autoflush=False, bind=engine))
+    monkeypatch.setattr(partitions, "VISIT_PARTITIONING", True)
+    monkeypatch.setattr(partitions, "VISIT_ARCHIVE_DIR", str(tmp_path / "archive"))
+    # init_partitions sets this for the new database; monkeypatch puts the shared one's back
+    monkeypatch.setattr(partitions, "_partitioned", False)
+    database.init_db()
+    session = database.SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+        engine.dispose()
+
+
+@contextmanager
+def count_queries(engine=None):
+    """Collect the SQL statements run on engine inside the block"""
+    engine = engine or database.engine
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+@pytest.fixture
+def queries():
+    return count_queries
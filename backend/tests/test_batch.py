@@ -0,0 +1,117 @@
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import text
+
+import batch
+import crud
+import schemas
+from models import Patient, Visit
+
+# A batch inserts each kind of row with INSERT ... RETURNING
+# (sort_by_parameter_order=True) and hands the ids back per operation, so
+# every result must name the row its operation created - also when visits
+# is a partitioned SQLite view, where ids are reserved up front
+# (assign_visit_ids) and the INSTEAD OF trigger routes each row.
+
+THIS_YEAR = date.today().year
+# Partitions exist from this year on; older and far-off dates go to the default one
+VISIT_DATES = [
+    datetime(THIS_YEAR, 3, 4, 9, 30), datetime(THIS_YEAR + 1, 11, 20, 14, 0), datetime(THIS_YEAR - 3, 7, 1, 8, 0),
+    datetime(THIS_YEAR + 2, 1, 15, 10, 0), datetime(2099, 6, 1, 12, 0),
+]
+
+
+def _operations(existing_id: int):
+    operations = []
+    for i in range(6):
+        operations.append(schemas.BatchOperation(op="create_patient", ref=f"p{i}", data={
+            "first_name": f"Batch{i}", "last_name": "Order", "date_of_birth": date(1950 + i, 1, 1),
+        }))
+        # Interleave visits, some for patients of this batch and some for an existing one
+        for j, visit_date in enumerate(VISIT_DATES[:i % 3 + 1]):
+            target = {"patient_ref": f"p{i}"} if j % 2 == 0 else {"patient_id": existing_id}
+            operations.append(schemas.BatchOperation(op="create_visit", **target, data={
+                "visit_date": visit_date, "reason": f"Visit {i}.{j}",
+            }))
+    operations.append(schemas.BatchOperation(op="update_patient", patient_ref="p2", data={"phone": "555-0102"}))
+    operations.append(schemas.BatchOperation(op="create_visit", patient_ref="p5", data={
+        "visit_date": VISIT_DATES[4], "reason": "Far ahead",
+    }))
+    return operations
+
+
+def _check_results(db, operations, report):
+    assert report["committed"]
+    results = report["results"]
+    assert [result["index"] for result in results] == list(range(len(operations)))
+    assert all(result["status"] == "ok" for result in results)
+
+    patient_ids = {}
+    for operation, result in zip(operations, results):
+        if operation.op == "create_patient":
+            patient = db.get(Patient, result["id"])
+            assert patient.first_name == operation.data["first_name"]
+            assert patient.medical_record_number == result["medical_record_number"]
+            patient_ids[operation.ref] = patient.id
+    mrns = [result["medical_record_number"] for result in results if result["op"] == "create_patient"]
+    assert mrns == sorted(mrns)  # allocated in input order
+
+    for operation, result in zip(operations, results):
+        if operation.op == "create_visit":
+            visit = db.get(Visit, result["id"])
+            assert visit.reason == operation.data["reason"]
+            assert visit.visit_date == operation.data["visit_date"]
+            expected = patient_ids[operation.patient_ref] if operation.patient_ref else operation.patient_id
+            assert visit.patient_id == expected
+        elif operation.op == "update_patient":
+            assert result["id"] == patient_ids["p2"]
+            assert db.get(Patient, result["id"]).phone == "555-0102"
+    return patient_ids
+
+
+def _existing_patient(db):
+    return crud.create_patient(db, schemas.PatientCreate(
+        first_name="Existing", last_name="Patient", date_of_birth=date(1940, 5, 5),
+    ))
+
+
+def test_batch_results_line_up_with_the_operations(db):
+    operations = _operations(_existing_patient(db).id)
+    report = batch.apply_batch(db, operations)
+    db.expire_all()
+    _check_results(db, operations, report)
+
+
+def test_batch_through_the_partitioned_visits_view(partitioned_db):
+    db = partitioned_db
+    assert db.execute(text("SELECT type FROM sqlite_master WHERE name = 'visits'")).scalar() == "view"
+    operations = _operations(_existing_patient(db).id)
+    report = batch.apply_batch(db, operations)
+    db.expire_all()
+    _check_results(db, operations, report)
+
+    # Each visit is stored in the partition for its year
+    for operation, result in zip(operations, report["results"]):
+        if operation.op == "create_visit":
+            year = operation.data["visit_date"].year
+            table = f"visits_p{year}" if THIS_YEAR <= year <= THIS_YEAR + 2 else "visits_default"
+            assert db.execute(text(f"SELECT reason FROM {table} WHERE id = :id"), {"id": result["id"]}).scalar() \
+                == operation.data["reason"]
+
+
+def test_rejected_batch_writes_nothing(db):
+    before = db.query(Patient).count(), db.query(Visit).count()
+    operations = [
+        schemas.BatchOperation(op="create_patient", ref="a", data={
+            "first_name": "Never", "last_name": "Written", "date_of_birth": date(1990, 1, 1),
+        }),
+        schemas.BatchOperation(op="create_visit", patient_ref="a", data={"visit_date": VISIT_DATES[0], "reason": "x"}),
+        schemas.BatchOperation(op="create_visit", patient_ref="missing", data={
+            "visit_date": VISIT_DATES[0], "reason": "x",
+        }),
+    ]
+    with pytest.raises(batch.BatchError) as rejected:
+        batch.apply_batch(db, operations)
+    assert [result["status"] for result in rejected.value.results] == ["skipped", "skipped", "error"]
+    assert (db.query(Patient).count(), db.query(Visit).count()) == before
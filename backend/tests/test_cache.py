@@ -0,0 +1,87 @@
+import asyncio
+from datetime import date, datetime
+
+import cache
+import changes
+from models import Patient, Visit
+
+# A write only drops cached responses in the process that made it; other
+# processes with an in-process cache pick it up from the change log.
+
+
+def _patient(db):
+    patient = Patient(medical_record_number=f"CACHE-{datetime.utcnow():%H%M%S%f}",
+                      first_name="Ada", last_name="Lovelace", date_of_birth=date(1980, 1, 1))
+    db.add(patient)
+    db.commit()
+    return patient.id
+
+
+def test_writes_by_other_processes_invalidate_from_the_change_log(db, monkeypatch):
+    monkeypatch.setattr(cache, "cache", cache.LRUCache())
+    changed, untouched = _patient(db), _patient(db)
+    cursor = changes.end_cursor(db)
+    cache.set_patient_response(changed, "detail", b"{}")
+    cache.set_patient_response(untouched, "detail", b"{}")
+
+    # Written without going through crud, like another worker would
+    db.add(Visit(patient_id=changed, visit_date=datetime.utcnow(), reason="Checkup"))
+    db.commit()
+    cursor = cache.invalidate_changed(db, cursor, batch=1)
+
+    assert cache.get_patient_response(changed, "detail") is None
+    assert cache.get_patient_response(untouched, "detail") == b"{}"
+    assert cache.invalidate_changed(db, cursor) == cursor
+
+
+def test_async_accessors(monkeypatch):
+    for backend in (cache.LRUCache(), cache.RedisCache(cache.FakeRedis(), local=True)):
+        monkeypatch.setattr(cache, "cache", backend)
+
+        async def roundtrip():
+            await cache.set_patient_response_async(1, "visits", b"[]")
+            return await cache.get_patient_response_async(1, "visits")
+
+        assert asyncio.run(roundtrip()) == b"[]"
+
+
+class _RecordingCache(cache.LRUCache):
+    """Notes which path each invalidation took"""
+
+    def __init__(self):
+        super().__init__()
+        self.deleted = []
+
+    def delete(self, key: str):
+        self.deleted.append(("sync", key))
+        super().delete(key)
+
+    async def delete_async(self, key: str):
+        self.deleted.append(("async", key))
+        super().delete(key)
+
+
+def test_async_writes_invalidate_through_the_async_path(db, monkeypatch):
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+    import crud_async
+    import database
+    import schemas
+
+    recording = _RecordingCache()
+    monkeypatch.setattr(cache, "cache", recording)
+    patient_id = _patient(db)
+
+    async def write():
+        async_engine = create_async_engine(database.get_async_url(database.DATABASE_URL))
+        try:
+            async with AsyncSession(async_engine, expire_on_commit=False) as session:
+                await crud_async.create_visit(session, schemas.VisitCreate(
+                    patient_id=patient_id, visit_date=datetime.utcnow(), reason="Checkup",
+                ))
+                await crud_async.update_patient(session, patient_id, schemas.PatientUpdate(first_name="Augusta"))
+        finally:
+            await async_engine.dispose()
+
+    asyncio.run(write())
+    assert recording.deleted == [("async", cache.patient_key(patient_id))] * 2
@@ -0,0 +1,103 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+import changes
+import crud
+import schemas
+from models import ChangeLog
+
+# A consumer pages through the change log with a cursor, in write order,
+# without gaps or repeats. Compaction keeps the latest change per row;
+# pruning expires cursors that point into the pruned range while later
+# cursors resume where they left off.
+
+
+def _write(db):
+    """Five changes: a patient created and updated, two visits, one of them deleted"""
+    patient = crud.create_patient(db, schemas.PatientCreate(
+        first_name="Feed", last_name="Reader", date_of_birth=date(1980, 4, 4),
+    ))
+    crud.update_patient(db, patient.id, schemas.PatientUpdate(phone="555-0199"))
+    first = crud.create_visit(db, schemas.VisitCreate(patient_id=patient.id, visit_date=datetime(2024, 2, 1), reason="A"))
+    second = crud.create_visit(db, schemas.VisitCreate(patient_id=patient.id, visit_date=datetime(2024, 2, 2), reason="B"))
+    db.delete(second)
+    db.commit()
+    return patient, first, second
+
+
+def _read_all(db, cursor: str, limit: int):
+    seen = []
+    while True:
+        page, cursor = changes.get_changes(db, cursor, limit)
+        if not page:
+            return seen, cursor
+        seen += page
+
+
+def _backdate(db, changes_to_age, **age):
+    ids = [change.id for change in changes_to_age]
+    db.query(ChangeLog).filter(ChangeLog.id.in_(ids)).update(
+        {ChangeLog.changed_at: datetime.utcnow() - timedelta(**age)}, synchronize_session=False
+    )
+    db.commit()
+
+
+def test_read_with_a_cursor_then_prune_and_resume(db):
+    start = changes.end_cursor(db)
+    patient, first, second = _write(db)
+
+    seen, cursor = _read_all(db, start, limit=2)
+    assert [(c.entity, c.entity_id, c.op) for c in seen] == [
+        ("patient", patient.id, "create"),
+        ("patient", patient.id, "update"),
+        ("visit", first.id, "create"),
+        ("visit", second.id, "create"),
+        ("visit", second.id, "delete"),
+    ]
+    assert [c.id for c in seen] == sorted(c.id for c in seen)
+    assert "phone" in seen[1].fields
+    # Caught up: the cursor stays put until something new is written
+    assert changes.get_changes(db, cursor) == ([], cursor)
+
+    # Prune up to the first visit; a consumer that had read that far resumes
+    ids = [c.id for c in seen]
+    cursors = [changes.change_cursor(c) for c in seen]
+    _backdate(db, seen[:3], days=changes.CHANGES_RETENTION_DAYS + 1)
+    assert changes.prune(db) >= 3
+    with pytest.raises(changes.CursorExpired):
+        changes.get_changes(db, start)
+    with pytest.raises(changes.CursorExpired):
+        changes.get_changes(db, cursors[1])
+    assert [c.id for c in _read_all(db, cursors[2], limit=1)[0]] == ids[3:]
+    # An empty cursor starts at the oldest retained change
+    assert changes.get_changes(db, "", 1)[0][0].id == ids[3]
+
+    client = TestClient(app.app)
+    assert client.get("/api/changes", params={"cursor": start}).status_code == 410
+    assert client.get("/api/changes", params={"cursor": "not a cursor"}).status_code == 400
+    resumed = client.get("/api/changes", params={"cursor": cursors[2]}).json()
+    assert [c["id"] for c in resumed["changes"]] == ids[3:]
+    assert resumed["next_cursor"] == cursor
+
+    # Writes after the prune carry on from the same cursor
+    crud.update_patient(db, patient.id, schemas.PatientUpdate(phone="555-0100"))
+    page, _ = changes.get_changes(db, cursor)
+    assert [(c.entity_id, c.op) for c in page] == [(patient.id, "update")]
+
+
+def test_compaction_keeps_the_latest_change_per_row(db):
+    start = changes.end_cursor(db)
+    patient, first, second = _write(db)
+    seen, _ = _read_all(db, start, limit=100)
+
+    _backdate(db, seen, hours=changes.CHANGES_COMPACT_AFTER_HOURS + 1)
+    assert changes.compact(db) >= 2
+    compacted, _ = _read_all(db, start, limit=100)
+    assert [(c.entity, c.entity_id, c.op) for c in compacted] == [
+        ("patient", patient.id, "update"),
+        ("visit", first.id, "create"),
+        ("visit", second.id, "delete"),
+    ]
@@ -0,0 +1,86 @@
+from datetime import date
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+import cohorts
+
+# Cohort metrics are computed from a columnar extract; this one is small
+# enough to check by hand. Results depend on today (ages, which months have
+# been observed), so cached results must not outlive the day they were
+# computed on.
+
+TODAY = date(2024, 4, 30)
+
+PATIENTS = [  # id, date of birth, gender, blood type, allergies
+    (1, date(1980, 6, 15), "Female", "A+", "penicillin"),
+    (2, date(1990, 1, 1), "Male", "O-", ""),
+    (3, date(2000, 12, 31), "Female", "A+", "Penicillin, peanuts"),
+    (4, date(1970, 1, 1), "Male", "", ""),
+]
+VISITS = [
+    (1, date(2024, 1, 10)), (1, date(2024, 2, 5)), (1, date(2024, 4, 20)),
+    (2, date(2024, 1, 25)), (2, date(2024, 3, 1)),
+    (3, date(2024, 2, 14)), (3, date(2024, 2, 20)), (3, date(2024, 3, 15)),
+    (4, date(2024, 6, 1)),  # booked ahead - its cohort month hasn't started yet
+]
+
+
+def _extract():
+    def encode(values):
+        names = sorted(set(values))
+        return np.array([names.index(value) for value in values], dtype=np.int32), names
+
+    return cohorts.Extract(
+        "test",
+        np.array([p[0] for p in PATIENTS], dtype=np.int64),
+        np.array([cohorts._epoch_day(p[1]) for p in PATIENTS], dtype=np.int32),
+        encode([p[2] for p in PATIENTS]),
+        encode([p[3] for p in PATIENTS]),
+        encode([p[4] for p in PATIENTS]),
+        np.array([v[0] for v in VISITS], dtype=np.int64),
+        np.array([cohorts._epoch_day(v[1]) for v in VISITS], dtype=np.int32),
+    )
+
+
+def test_retention_matches_hand_computed_cohorts():
+    # January: patients 1 and 2, back in February (1), March (2) and April (1).
+    # February: patient 3, back in March; April is observed but empty.
+    # June (patient 4) is in the future and starts no cohort.
+    assert cohorts.retention(_extract(), months=3, today=TODAY) == [
+        {"cohort": "2024-01", "patients": 2, "retention": [1.0, 0.5, 0.5, 0.5]},
+        {"cohort": "2024-02", "patients": 1, "retention": [1.0, 1.0, 0.0]},
+    ]
+
+
+def test_retention_rejects_a_start_after_the_current_month():
+    with pytest.raises(ValueError):
+        cohorts.retention(_extract(), start=date(2024, 5, 1), today=TODAY)
+
+    response = TestClient(app.app).get("/api/analytics/cohorts/retention", params={"from": "2999-01-01"})
+    assert response.status_code == 400
+
+
+def test_cached_results_are_keyed_by_day(db, monkeypatch):
+    class FakeDate(date):
+        today_value = TODAY
+
+        @classmethod
+        def today(cls):
+            return cls.today_value
+
+    monkeypatch.setattr(cohorts, "date", FakeDate)
+    monkeypatch.setattr(cohorts, "_results", cohorts.OrderedDict())
+    monkeypatch.setattr(cohorts, "get_extract", lambda db, version=None: _extract())
+
+    first = cohorts.get_cohort(db, "retention", months=3)
+    assert [row["retention"] for row in first["results"]] == [[1.0, 0.5, 0.5, 0.5], [1.0, 1.0, 0.0]]
+    assert cohorts.get_cohort(db, "retention", months=3) is first
+
+    # A month on, February's cohort has a fourth month observed
+    FakeDate.today_value = date(2024, 5, 31)
+    later = cohorts.get_cohort(db, "retention", months=3)
+    assert later is not first
+    assert [row["retention"] for row in later["results"]] == [[1.0, 0.5, 0.5, 0.5], [1.0, 1.0, 0.0, 0.0]]
@@ -0,0 +1,43 @@
+from datetime import date
+from urllib.parse import unquote
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+import crud
+import files
+import schemas
+
+# Downloads send the uploaded file name back in Content-Disposition. Names
+# that aren't latin-1, or that hold quotes, used to break the header (500).
+
+
+@pytest.fixture(scope="module")
+def client():
+    return TestClient(app.app)
+
+
+@pytest.mark.parametrize("filename", ["病历.pdf", "résumé.pdf", "plain.pdf"])
+def test_download_keeps_any_uploaded_filename(client, db, filename):
+    patient = crud.create_patient(db, schemas.PatientCreate(
+        first_name="Ada", last_name="Lovelace", date_of_birth=date(1980, 1, 1),
+    ))
+    content = f"contents of {filename}".encode()
+    uploaded = client.post(f"/api/patients/{patient.id}/documents", files={"file": (filename, content)})
+    assert uploaded.status_code == 201, uploaded.text
+    assert uploaded.json()["filename"] == filename
+
+    response = client.get(f"/api/documents/{uploaded.json()['id']}/content")
+    assert response.status_code == 200
+    assert response.content == content
+    disposition = response.headers["content-disposition"]
+    fallback = disposition.split('filename="', 1)[1].split('"', 1)[0]
+    assert fallback.isascii() and fallback
+    assert unquote(disposition.split("filename*=UTF-8''", 1)[1]) == filename
+
+
+def test_quotes_and_line_breaks_stay_inside_the_header():
+    # Browsers send quotes in upload names as %22, but records can be created with any name
+    disposition = files.content_disposition('say "hi"\r\n.txt')
+    assert disposition == "attachment; filename=\"say _hi___.txt\"; filename*=UTF-8''say%20%22hi%22%0D%0A.txt"
@@ -0,0 +1,81 @@
+import csv
+import io
+import json
+import time
+from datetime import date, datetime
+
+import pytest
+
+import crud
+import database
+import exporter
+import schemas
+
+# Each format must carry the same rows and values; updated_since keeps only
+# rows changed at or after it (created, for visits).
+
+
+@pytest.fixture
+def recent(db):
+    """A patient with two visits, created after the returned cutoff"""
+    old = crud.create_patient(db, schemas.PatientCreate(
+        first_name="Before", last_name="Cutoff", date_of_birth=date(1960, 2, 2),
+    ))
+    crud.create_visit(db, schemas.VisitCreate(patient_id=old.id, visit_date=datetime(2024, 1, 1, 9), reason="Old"))
+    time.sleep(0.01)
+    since = datetime.utcnow()
+    patient = crud.create_patient(db, schemas.PatientCreate(
+        first_name="Ada", last_name="Lovelace", date_of_birth=date(1815, 12, 10), phone="555-0100",
+    ))
+    visits = [
+        crud.create_visit(db, schemas.VisitCreate(
+            patient_id=patient.id, visit_date=datetime(2024, 5, day, 10, 30), reason=f"Visit {day}",
+            diagnosis="Flu" if day == 1 else None,
+        ))
+        for day in (1, 2)
+    ]
+    return since, patient, visits
+
+
+def _read(kind: str, fmt: str, since: datetime):
+    data = b"".join(exporter.export_stream(database.engine, kind, fmt, since))
+    if fmt == "ndjson":
+        return [json.loads(line) for line in data.splitlines()]
+    if fmt == "csv":
+        return [
+            {key: value or None for key, value in row.items()}
+            for row in csv.DictReader(io.StringIO(data.decode()))
+        ]
+    import pyarrow.parquet as pq
+    return pq.read_table(io.BytesIO(data)).to_pylist()
+
+
+def _as_text(value):
+    return value.isoformat() if hasattr(value, "isoformat") else None if value is None else str(value)
+
+
+@pytest.mark.parametrize("fmt", ["ndjson", "csv", "parquet"])
+def test_export_formats_carry_the_changed_rows(recent, fmt):
+    if fmt == "parquet":
+        pytest.importorskip("pyarrow")
+    since, patient, visits = recent
+
+    patients = _read("patients", fmt, since)
+    assert [str(row["id"]) for row in patients] == [str(patient.id)]
+    assert _as_text(patients[0]["date_of_birth"]) == "1815-12-10"
+    assert patients[0]["medical_record_number"] == patient.medical_record_number
+    assert patients[0]["phone"] == "555-0100"
+
+    rows = _read("visits", fmt, since)
+    assert [str(row["id"]) for row in rows] == [str(visit.id) for visit in visits]
+    assert [str(row["patient_id"]) for row in rows] == [str(patient.id)] * 2
+    assert [_as_text(row["visit_date"]) for row in rows] == ["2024-05-01T10:30:00", "2024-05-02T10:30:00"]
+    assert [row["reason"] for row in rows] == ["Visit 1", "Visit 2"]
+    assert [row["diagnosis"] for row in rows] == ["Flu", None]
+
+
+def test_export_rejects_unknown_kind_and_format():
+    with pytest.raises(ValueError):
+        exporter.export_stream(database.engine, "users")
+    with pytest.raises(ValueError):
+        exporter.export_stream(database.engine, "visits", "xml")
@@ -0,0 +1,46 @@
+import csv
+import io
+from datetime import date
+
+import pytest
+
+import importer
+from models import Patient, Visit
+
+
+@pytest.fixture
+def patient_id(db):
+    patient = Patient(medical_record_number="TEST-IMPORT-1", first_name="Grace", last_name="Hopper",
+                      date_of_birth=date(1970, 1, 1))
+    db.add(patient)
+    db.commit()
+    yield patient.id
+    db.query(Visit).filter(Visit.patient_id == patient.id).delete()
+    db.delete(patient)
+    db.commit()
+
+
+def _visit(patient_id: int, reason: str):
+    return f'{{"patient_id": {patient_id}, "visit_date": "2024-01-01T09:00:00", "reason": "{reason}"}}\n'.encode()
+
+
+def test_invalid_utf8_stops_at_its_line_after_committing_earlier_rows(db, patient_id):
+    body = _visit(patient_id, "one") * 3 + b"\xff\n" + _visit(patient_id, "never read")
+    with pytest.raises(importer.ImportStreamError) as raised:
+        importer.import_stream(db, "visits", io.BytesIO(body), "ndjson", batch_size=2)
+    assert raised.value.line == 4
+    assert raised.value.report["imported"] == 3
+    assert db.query(Visit).filter(Visit.patient_id == patient_id).count() == 3
+
+
+def test_malformed_csv_names_its_line(db, patient_id):
+    limit = csv.field_size_limit(20)
+    try:
+        body = (f"patient_id,visit_date,reason\n{patient_id},2024-01-01T09:00:00,ok\n"
+                f"{patient_id},2024-01-01T09:00:00,{'x' * 50}\n").encode()
+        with pytest.raises(importer.ImportStreamError) as raised:
+            importer.import_stream(db, "visits", io.BytesIO(body), "csv")
+    finally:
+        csv.field_size_limit(limit)
+    assert raised.value.line == 3
+    assert raised.value.report["imported"] == 1
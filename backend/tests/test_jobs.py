@@ -0,0 +1,144 @@
+from concurrent.futures import Future
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import delete, update
+
+import crud
+import database
+import jobs
+import schemas
+from models import Document, DocumentJob
+
+# The document queue on SQLite, driven by hand: claim hands a job out once,
+# fail puts it back with a doubling delay until the attempts run out, and a
+# job whose worker died is reclaimed after JOB_LOCK_TIMEOUT. The extractor is
+# a stand-in; JobWorker._finish records whatever its future returns or raises.
+
+MAX_ATTEMPTS = 3
+RETRY_SECONDS = 30
+LOCK_TIMEOUT = 600
+
+
+@pytest.fixture
+def queue(db, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_MAX_ATTEMPTS", MAX_ATTEMPTS)
+    monkeypatch.setattr(jobs, "JOB_RETRY_SECONDS", RETRY_SECONDS)
+    monkeypatch.setattr(jobs, "JOB_LOCK_TIMEOUT", LOCK_TIMEOUT)
+    # Start from an empty queue; uploads in other tests leave jobs behind
+    db.execute(update(DocumentJob).where(DocumentJob.status.in_(("queued", "running"))).values(status="done"))
+    db.commit()
+    return jobs.JobWorker(database.SessionLocal, processes=1)
+
+
+def _queued_document(db):
+    patient = crud.create_patient(db, schemas.PatientCreate(
+        first_name="Queue", last_name="Test", date_of_birth=date(1975, 3, 3),
+    ))
+    return crud.create_document(db, schemas.DocumentCreate(
+        patient_id=patient.id, filename="scan.txt", file_type="txt", file_url="/files/scan.txt",
+    ), sha256="0" * 64)
+
+
+def _run(worker, db, job, extractor):
+    """Run the fake extractor for a claimed job and record the outcome like the worker loop does"""
+    future = Future()
+    try:
+        future.set_result(extractor(job[4], job[5]))
+    except Exception as e:
+        future.set_exception(e)
+    worker._finish(db, job, future, submitted=0)
+
+
+def _broken(sha256, file_type):
+    raise RuntimeError("unreadable")
+
+
+def _job(db, document_id):
+    db.expire_all()
+    # Newest first: SQLite reuses the id of a deleted document
+    jobs_of_document = db.query(DocumentJob).filter(DocumentJob.document_id == document_id)
+    return jobs_of_document.order_by(DocumentJob.id.desc()).first()
+
+
+def _make_runnable(db, job_id):
+    db.execute(update(DocumentJob).where(DocumentJob.id == job_id).values(run_after=datetime.utcnow()))
+    db.commit()
+
+
+def test_claim_fail_claim_backs_off_until_attempts_run_out(db, queue):
+    document = _queued_document(db)
+    assert document.processing_status == "queued"
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        before = datetime.utcnow()
+        claimed = jobs.claim(db, 10, "test-worker")
+        assert [(job[1], job[3]) for job in claimed] == [(document.id, attempt)]
+        assert jobs.claim(db, 10, "other-worker") == []  # handed out once
+        _run(queue, db, claimed[0], _broken)
+
+        job = _job(db, document.id)
+        assert job.last_error == "RuntimeError: unreadable"
+        if attempt < MAX_ATTEMPTS:
+            assert job.status == "queued"
+            delay = RETRY_SECONDS * 2 ** (attempt - 1)  # 30s, then 60s
+            assert before + timedelta(seconds=delay) <= job.run_after <= datetime.utcnow() + timedelta(seconds=delay)
+            assert jobs.claim(db, 10, "test-worker") == []  # not due yet
+            _make_runnable(db, job.id)
+
+    assert (job.status, job.attempts) == ("failed", MAX_ATTEMPTS)
+    assert db.get(Document, document.id).processing_status == "failed"
+    assert jobs.claim(db, 10, "test-worker") == []
+    assert (queue.retried, queue.failed, queue.completed) == (MAX_ATTEMPTS - 1, 1, 0)
+
+
+def test_retry_then_success_stores_the_result(db, queue):
+    document = _queued_document(db)
+    _run(queue, db, jobs.claim(db, 10, "test-worker")[0], _broken)
+    _make_runnable(db, _job(db, document.id).id)
+
+    job = jobs.claim(db, 10, "test-worker")[0]
+    assert db.get(Document, document.id).processing_status == "processing"
+    _run(queue, db, job, lambda sha256, file_type: {"text": f"{file_type} text", "metadata": {"pages": 1}})
+
+    db.expire_all()
+    stored = db.get(Document, document.id)
+    assert (stored.processing_status, stored.extracted_text) == ("done", "txt text")
+    assert stored.extracted_metadata == {"pages": 1}
+    assert stored.processed_at is not None
+    job = _job(db, document.id)
+    assert (job.status, job.last_error) == ("done", None)
+
+
+def test_job_of_a_deleted_document_fails_on_claim(db, queue):
+    document = _queued_document(db)
+    # SQLite doesn't enforce the ON DELETE CASCADE here, so the job outlives it
+    db.execute(delete(Document).where(Document.id == document.id))
+    db.commit()
+
+    assert jobs.claim(db, 10, "test-worker") == []
+    job = _job(db, document.id)
+    assert (job.status, job.last_error) == ("failed", "Document deleted")
+    assert job.finished_at is not None
+
+
+def test_job_of_a_dead_worker_is_reclaimed_after_the_lock_timeout(db, queue):
+    document = _queued_document(db)
+    first = jobs.claim(db, 10, "dead-worker")
+    assert jobs.claim(db, 10, "live-worker") == []
+
+    job = _job(db, document.id)
+    assert (job.status, job.locked_by) == ("running", "dead-worker")
+    db.execute(update(DocumentJob).where(DocumentJob.id == job.id).values(
+        locked_at=datetime.utcnow() - timedelta(seconds=LOCK_TIMEOUT - 5)
+    ))
+    db.commit()
+    assert jobs.claim(db, 10, "live-worker") == []  # not timed out yet
+
+    db.execute(update(DocumentJob).where(DocumentJob.id == job.id).values(
+        locked_at=datetime.utcnow() - timedelta(seconds=LOCK_TIMEOUT + 5)
+    ))
+    db.commit()
+    reclaimed = jobs.claim(db, 10, "live-worker")
+    assert [(j[0], j[3]) for j in reclaimed] == [(first[0][0], 2)]
+    assert _job(db, document.id).locked_by == "live-worker"
@@ -0,0 +1,95 @@
+import asyncio
+import multiprocessing
+import threading
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+import crud
+import database
+import mrn
+
+# Many allocators reserving blocks from the one counter row at once - threads
+# sharing an allocator, separate engines standing in for separate processes,
+# forked workers that inherit a half-used block, and the async path going
+# through share_allocator - must never hand out the same MRN twice.
+
+THREADS = 8
+PER_THREAD = 150
+BLOCK_SIZE = 7  # small, so blocks run out and get reserved concurrently
+
+
+def _allocate(allocator, results, rounds: int = PER_THREAD):
+    for i in range(rounds):
+        results.extend(allocator.next_mrns(1 + i % 3))
+
+
+def _threads(target, count: int = THREADS):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _forked_worker(queue):
+    # A forked child must not reuse the block the parent reserved before forking
+    database.engine.dispose(close=False)
+    results = []
+    _allocate(mrn.get_allocator(database.engine), results, rounds=50)
+    queue.put(results)
+
+
+async def _async_allocations(tasks: int = 20, rounds: int = 20):
+    async_engine = create_async_engine(database.get_async_url(database.DATABASE_URL))
+    mrn.share_allocator(async_engine.sync_engine, database.engine)
+    try:
+        async def task():
+            allocated = []
+            for i in range(rounds):
+                async with AsyncSession(async_engine) as session:
+                    allocated += await session.run_sync(crud.generate_mrns, 1 + i % 3)
+            return allocated
+
+        return [value for allocated in await asyncio.gather(*(task() for _ in range(tasks))) for value in allocated]
+    finally:
+        await async_engine.dispose()
+
+
+def test_concurrent_mrns_are_unique_and_valid(monkeypatch):
+    results = []
+    shared = mrn.get_allocator(database.engine)
+    monkeypatch.setattr(shared, "block_size", BLOCK_SIZE)
+    results += shared.next_mrns(1)  # the parent holds a partly used block when it forks
+
+    # Threads sharing the process allocator
+    _threads(lambda: _allocate(shared, results))
+
+    # Independent allocators on their own engines, like separate processes
+    engines = [create_engine(database.DATABASE_URL, connect_args={"check_same_thread": False}) for _ in range(4)]
+    allocators = iter([mrn.MRNAllocator(engine, block_size=BLOCK_SIZE) for engine in engines])
+    _threads(lambda: _allocate(next(allocators), results), count=len(engines))
+    for engine in engines:
+        engine.dispose()
+
+    # Forked worker processes, all at once alongside threads and the async path
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    workers = [context.Process(target=_forked_worker, args=(queue,)) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    async_thread = threading.Thread(target=lambda: results.extend(asyncio.run(_async_allocations())))
+    async_thread.start()
+    _threads(lambda: _allocate(shared, results), count=4)
+    async_thread.join()
+    for _ in workers:
+        results += queue.get(timeout=60)
+    for worker in workers:
+        worker.join(timeout=60)
+        assert worker.exitcode == 0
+
+    expected = 1 + (THREADS + 4 + 4) * sum(1 + i % 3 for i in range(PER_THREAD)) \
+        + 3 * sum(1 + i % 3 for i in range(50)) + 20 * sum(1 + i % 3 for i in range(20))
+    assert len(results) == expected
+    assert len(set(results)) == len(results)
+    assert all(mrn.is_valid_mrn(value) for value in results)
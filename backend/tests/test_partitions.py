@@ -0,0 +1,90 @@
+import os
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import text
+
+import crud
+import database
+import partitions
+import schemas
+
+# Partitioned visits on SQLite: writes through the visits view land in the
+# table for their year, archiving swaps a cold partition for a Parquet file
+# that a patient's visit list still reads, and deleting a patient rewrites
+# the archive without their visits.
+
+pytest.importorskip("pyarrow")
+
+THIS_YEAR = date.today().year
+
+
+def _patient(db, name: str):
+    return crud.create_patient(db, schemas.PatientCreate(
+        first_name=name, last_name="Partitioned", date_of_birth=date(1985, 5, 5),
+    ))
+
+
+def _visit(db, patient_id: int, when: datetime, reason: str):
+    visit = crud.create_visit(db, schemas.VisitCreate(patient_id=patient_id, visit_date=when, reason=reason))
+    return visit.id, reason
+
+
+def _stored_in(db, visit_id: int):
+    tables = [name for name, _, _ in partitions._live(db.connection())] + [partitions.DEFAULT_PARTITION]
+    return [
+        table for table in tables
+        if db.execute(text(f"SELECT 1 FROM {table} WHERE id = :id"), {"id": visit_id}).first()
+    ]
+
+
+def test_insert_archive_read_and_purge(partitioned_db, monkeypatch):
+    db = partitioned_db
+    ada, bob = _patient(db, "Ada").id, _patient(db, "Bob").id
+    visits = {
+        "ada-old": _visit(db, ada, datetime(THIS_YEAR - 5, 6, 1, 9), "Long ago"),
+        "ada-1": _visit(db, ada, datetime(THIS_YEAR, 1, 10, 9), "January"),
+        "ada-2": _visit(db, ada, datetime(THIS_YEAR, 3, 20, 9), "March"),
+        "bob-1": _visit(db, bob, datetime(THIS_YEAR, 2, 14, 9), "February"),
+        "ada-next": _visit(db, ada, datetime(THIS_YEAR + 1, 4, 1, 9), "Next year"),
+    }
+
+    # Inserted through the view, each into its year's table (or the default one)
+    assert len({visit_id for visit_id, _ in visits.values()}) == len(visits)
+    assert _stored_in(db, visits["ada-old"][0]) == [partitions.DEFAULT_PARTITION]
+    for key in ("ada-1", "ada-2", "bob-1"):
+        assert _stored_in(db, visits[key][0]) == [f"visits_p{THIS_YEAR}"]
+    assert _stored_in(db, visits["ada-next"][0]) == [f"visits_p{THIS_YEAR + 1}"]
+
+    # Archive everything that ended a month before next February: this year's partition
+    monkeypatch.setattr(partitions, "VISIT_ARCHIVE_AFTER_MONTHS", 1)
+    done = partitions.maintain(database.engine, today=date(THIS_YEAR + 1, 2, 1))
+    assert done["archived"] == [f"visits_p{THIS_YEAR}"]
+    path = os.path.join(partitions.VISIT_ARCHIVE_DIR, f"visits_p{THIS_YEAR}.parquet")
+    assert os.path.exists(path)
+    db.expire_all()
+    assert partitions.archived_count(db) == 3
+    assert _stored_in(db, visits["ada-1"][0]) == []
+    archived = {row["name"]: row for row in partitions.get_partitions(db)["partitions"]}[f"visits_p{THIS_YEAR}"]
+    assert (archived["status"], archived["row_count"], archived["archive_path"]) == ("archived", 3, path)
+
+    # The patient's visit list still has the archived visits, newest first
+    detail = crud.get_patient_detail(db, ada)
+    assert [(visit.id, visit.reason) for visit in detail.visits] == [
+        visits[key] for key in ("ada-next", "ada-2", "ada-1", "ada-old")
+    ]
+    assert [visit.reason for visit in crud.get_patient_detail(db, bob).visits] == ["February"]
+    assert [visit.reason for visit in crud.get_patient_detail(db, ada, visits_limit=3).visits] == \
+        ["Next year", "March", "January"]
+
+    # Deleting a patient (in a request of its own) removes their visits from the archive file too
+    session = database.SessionLocal()
+    try:
+        assert crud.delete_patient(session, ada)
+    finally:
+        session.close()
+    db.expire_all()
+    assert partitions.archived_count(db) == 1
+    assert [row.patient_id for row in partitions.read_archive([path])] == [bob]
+    assert [visit.reason for visit in crud.get_patient_detail(db, bob).visits] == ["February"]
+    assert _stored_in(db, visits["ada-next"][0]) == [] and _stored_in(db, visits["ada-old"][0]) == []
@@ -0,0 +1,65 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import crud
+import database
+import schemas
+from models import Document, Patient, Visit
+
+# get_patient_detail used to lazy-load visits and documents (N+1 queries).
+# It must take the same three queries - patient, visits, documents - however
+# many related rows there are.
+
+
+def _patient_with(db, visits: int, documents: int):
+    patient = Patient(
+        medical_record_number=f"TEST-{datetime.utcnow():%H%M%S%f}-{visits}-{documents}",
+        first_name="Ada", last_name="Lovelace", date_of_birth=date(1980, 1, 1),
+    )
+    db.add(patient)
+    db.flush()
+    start = datetime(2024, 1, 1)
+    db.add_all(Visit(patient_id=patient.id, visit_date=start + timedelta(days=i), reason="Checkup")
+               for i in range(visits))
+    db.add_all(Document(patient_id=patient.id, filename=f"scan{i}.pdf", file_url=f"/uploads/scan{i}.pdf",
+                        uploaded_at=start + timedelta(days=i))
+               for i in range(documents))
+    db.commit()
+    return patient.id
+
+
+@pytest.mark.parametrize("visits, documents", [(0, 0), (1, 1), (30, 12)])
+@pytest.mark.parametrize("visits_limit, documents_limit", [(None, None), (5, 5), (0, 100)])
+def test_patient_detail_query_count_is_constant(db, queries, visits, documents, visits_limit, documents_limit):
+    patient_id = _patient_with(db, visits, documents)
+    session = database.SessionLocal()
+    try:
+        with queries() as statements:
+            patient = crud.get_patient_detail(
+                session, patient_id, visits_limit=visits_limit, documents_limit=documents_limit
+            )
+            # Serializing the response must not lazy-load anything either
+            detail = schemas.PatientDetail.model_validate(patient)
+        assert len(statements) == 3
+    finally:
+        session.close()
+
+    expected_visits = visits if visits_limit is None else min(visits, visits_limit)
+    expected_documents = documents if documents_limit is None else min(documents, documents_limit)
+    assert len(detail.visits) == expected_visits
+    assert len(detail.documents) == expected_documents
+    # Newest first
+    assert [visit.visit_date for visit in detail.visits] == sorted(
+        (visit.visit_date for visit in detail.visits), reverse=True
+    )
+
+
+def test_missing_patient_takes_one_query(queries):
+    session = database.SessionLocal()
+    try:
+        with queries() as statements:
+            assert crud.get_patient_detail(session, 10 ** 9) is None
+        assert len(statements) == 1
+    finally:
+        session.close()
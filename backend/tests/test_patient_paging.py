@@ -0,0 +1,73 @@
+import base64
+import json
+from datetime import date
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+import crud
+from models import Patient
+
+# Keyset paging must visit every patient exactly once in either order - even
+# with duplicate names - and turn away cursors it didn't issue with a 400.
+
+
+@pytest.fixture(scope="module")
+def client():
+    return TestClient(app.app)
+
+
+def _add_namesakes(db, count: int = 7):
+    for mrn in crud.generate_mrns(db, count):
+        db.add(Patient(medical_record_number=mrn, first_name="Jane", last_name="Doe", date_of_birth=date(1990, 1, 1)))
+    db.commit()
+
+
+def _cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+
+@pytest.mark.parametrize("order, key", [
+    ("id", lambda p: p.id),
+    ("name", lambda p: (p.last_name, p.first_name, p.id)),
+])
+def test_pages_cover_every_patient_once(db, order, key):
+    _add_namesakes(db)
+    expected = [p.id for p in sorted(db.query(Patient).all(), key=key)]
+
+    seen, cursor = [], ""
+    while True:
+        patients, cursor = crud.get_patients_keyset(db, cursor=cursor, limit=3, order=order)
+        seen += [p.id for p in patients]
+        if cursor is None:
+            break
+    assert seen == expected
+
+
+def test_cursor_for_another_order_is_rejected(db):
+    _, cursor = crud.get_patients_keyset(db, limit=1, order="id")
+    with pytest.raises(ValueError):
+        crud.get_patients_keyset(db, cursor=cursor, limit=1, order="name")
+
+
+@pytest.mark.parametrize("cursor", [
+    "not a cursor!",
+    _cursor(["id"]),
+    _cursor(["id", [1, 2]]),
+    _cursor(["id", [[1]]]),
+    _cursor(["id", [{"a": 1}]]),
+    _cursor(["id", ["1"]]),
+    _cursor(["id", [True]]),
+    _cursor(["name", ["Doe", 5, 1]]),
+    _cursor([["id"], [1]]),
+    _cursor({"id": 1}),
+])
+def test_malformed_cursor_is_a_400(client, cursor):
+    response = client.get("/api/patients", params={"cursor": cursor, "limit": 5})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("params", [{"skip": -1}, {"limit": 0}, {"cursor": "", "limit": 0}])
+def test_paging_bounds_are_validated(client, params):
+    assert client.get("/api/patients", params=params).status_code == 422
@@ -0,0 +1,108 @@
+import sqlite3
+from datetime import date
+
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+import crud
+import database
+import replicas
+import schemas
+
+# Read-your-writes on a SQLite stand-in replica (a backup of the test
+# database), positioned by change_log id. A request that commits gets the
+# primary's position as a read token; reads carrying it only go to a replica
+# that has caught up with it, and to the primary until then.
+
+
+@pytest.fixture
+def replica_set(tmp_path, monkeypatch):
+    path = tmp_path / "replica.db"
+    replica = database.create_replica(0, f"sqlite:///{path}")
+    replica_set = replicas.ReplicaSet(database.engine, [replica], selection="round_robin", position="changes")
+
+    def refresh():
+        """Copy the primary over the replica, as replication would, and check it"""
+        replica.engine.dispose()
+        source, target = sqlite3.connect(database.engine.url.database), sqlite3.connect(path)
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+        replica_set.check()
+
+    replica_set.refresh = refresh
+    refresh()
+    monkeypatch.setattr(database, "replica_set", replica_set)
+    yield replica_set
+    replica.engine.dispose()
+
+
+def _write(db):
+    crud.create_patient(db, schemas.PatientCreate(
+        first_name="Token", last_name="Holder", date_of_birth=date(1990, 9, 9),
+    ))
+
+
+def test_choose_honours_the_read_token(db, replica_set):
+    replica = replica_set.replicas[0]
+    assert replica.healthy and replica.lag_seconds == 0.0
+    assert replica.position == replica_set.primary_position()
+    assert replica_set.choose() is replica
+    assert replica_set.choose(replica.position) is replica
+
+    _write(db)
+    token = replica_set.primary_position()
+    assert token > replica.position
+    assert replica_set.choose(token) is None  # primary, until the replica catches up
+    assert replica_set.choose() is replica  # reads without a token don't wait
+
+    replica_set.refresh()
+    assert replica_set.choose(token) is replica
+
+
+def test_replica_refuses_writes(replica_set):
+    session = replica_set.replicas[0].session_factory()
+    try:
+        with pytest.raises(OperationalError):
+            _write(session)
+    finally:
+        session.close()
+
+
+def test_a_write_hands_out_a_token_that_keeps_reads_on_the_primary(replica_set):
+    replicas.track_commits([database.engine])
+    probe = FastAPI()
+    probe.add_middleware(replicas.ReadTokenMiddleware, replica_set=replica_set)
+
+    @probe.post("/write")
+    def write(db: Session = Depends(database.get_db)):
+        _write(db)
+        return {}
+
+    @probe.get("/read")
+    def read(db: Session = Depends(database.get_read_db)):
+        return {"replica": db.get_bind() is not database.engine}
+
+    client = TestClient(probe)
+    response = client.get("/read")
+    assert response.json() == {"replica": True}
+    assert replicas.READ_TOKEN_HEADER not in response.headers  # nothing written, no token
+
+    response = client.post("/write")
+    token = int(response.headers[replicas.READ_TOKEN_HEADER])
+    assert token == replica_set.primary_position() > replica_set.replicas[0].position
+    assert client.cookies[replicas.READ_TOKEN_COOKIE] == str(token)
+
+    # The cookie follows the client: its reads stay on the primary...
+    assert client.get("/read").json() == {"replica": False}
+    # ...as do reads sending the header, while a client without a token reads the replica
+    assert TestClient(probe).get("/read", headers={replicas.READ_TOKEN_HEADER: str(token)}).json() == {"replica": False}
+    assert TestClient(probe).get("/read").json() == {"replica": True}
+
+    replica_set.refresh()
+    assert client.get("/read").json() == {"replica": True}
@@ -0,0 +1,30 @@
+from datetime import date, datetime
+
+import crud
+import schemas
+import search
+
+# Visit search ranks only the newest SEARCH_MAX_CANDIDATES matches; the
+# results must say when more visits matched than that.
+
+
+def test_search_visits_reports_truncated_candidates(db, monkeypatch):
+    patient = crud.create_patient(db, schemas.PatientCreate(
+        first_name="Alan", last_name="Turing", date_of_birth=date(1912, 6, 23),
+    ))
+    for _ in range(4):
+        crud.create_visit(db, schemas.VisitCreate(
+            patient_id=patient.id, visit_date=datetime.utcnow(), reason="Xylophonist cramp",
+        ))
+
+    hits, truncated = search.search_visits(db, "xylophonist")
+    assert len(hits) == 4 and not truncated
+
+    monkeypatch.setattr(search, "SEARCH_MAX_CANDIDATES", 3)
+    hits, truncated = search.search_visits(db, "xylophonist")
+    assert len(hits) == 3 and truncated
+    assert search.search_visits(db, "xylophonist", skip=10) == ([], True)
+    assert search.search_visits(db, "xylophonist", limit=2)[1]
+
+    monkeypatch.setattr(search, "SEARCH_MAX_CANDIDATES", 4)
+    assert search.search_visits(db, "xylophonist")[1] is False
@@ -0,0 +1,85 @@
+from datetime import date, datetime
+
+import crud
+import schemas
+import stats
+from models import StatCounterDelta, VisitRollupDelta
+
+# Writes record their statistics as delta rows rather than updating the
+# shared counter rows (which serialized concurrent writers on PostgreSQL).
+# The figures must be exact straight after the write, stay the same when the
+# deltas are folded in, and reconcile must correct drift with deltas.
+
+
+def _create_patient_with_visits(db, visits: int):
+    patient = crud.create_patient(db, schemas.PatientCreate(
+        first_name="Grace", last_name="Hopper", date_of_birth=date(1970, 12, 9), gender="Female",
+    ))
+    for _ in range(visits):
+        crud.create_visit(db, schemas.VisitCreate(
+            patient_id=patient.id, visit_date=datetime.utcnow(), reason="Checkup",
+        ))
+    return patient
+
+
+def test_writes_add_deltas_instead_of_updating_counters(db, queries):
+    stats.reconcile(db)
+    before = stats.get_stats(db)
+    trends_before = stats.get_trends(db, granularity="day", group_by="reason")
+
+    with queries() as statements:
+        _create_patient_with_visits(db, visits=2)
+    assert not [s for s in statements if s.lstrip().upper().startswith("UPDATE STAT_COUNTERS")]
+    assert not [s for s in statements if "daily_stats " in s or "visit_rollups " in s]
+
+    after = stats.get_stats(db)
+    assert after["total_patients"] == before["total_patients"] + 1
+    assert after["total_visits"] == before["total_visits"] + 2
+    assert after["new_patients_30d"] == before["new_patients_30d"] + 1
+    assert after["recent_visits_30d"] == before["recent_visits_30d"] + 2
+    trends = stats.get_trends(db, granularity="day", group_by="reason")
+    assert sum(t["visit_count"] for t in trends) == sum(t["visit_count"] for t in trends_before) + 2
+
+    stats.fold(db)
+    assert db.query(StatCounterDelta).count() == 0
+    assert db.query(VisitRollupDelta).count() == 0
+    assert {**stats.get_stats(db), "staleness_seconds": None} == {**after, "staleness_seconds": None}
+    assert stats.get_trends(db, granularity="day", group_by="reason") == trends
+
+
+def test_reconcile_corrects_drift_with_deltas(db):
+    _create_patient_with_visits(db, visits=1)
+    stats.reconcile(db)
+    expected = stats.get_stats(db)
+
+    db.add(StatCounterDelta(name="patients", value=5))
+    db.add(StatCounterDelta(name="visits", value=-3))
+    db.commit()
+    assert stats.get_stats(db)["total_patients"] == expected["total_patients"] + 5
+
+    stats.reconcile(db)
+    reconciled = stats.get_stats(db)
+    assert reconciled["total_patients"] == expected["total_patients"]
+    assert reconciled["total_visits"] == expected["total_visits"]
+    assert reconciled["recent_visits_30d"] == expected["recent_visits_30d"]
+
+
+def test_rollups_key_on_a_bounded_set_of_normalized_reasons(db, monkeypatch):
+    monkeypatch.setattr(stats, "ROLLUP_MAX_REASONS", 3)
+    patient = _create_patient_with_visits(db, visits=0)
+    for reason in ["  Checkup ", "CHECKUP", "Flu  shot", "Sprained ankle", "Broken wrist", "Rash"]:
+        crud.create_visit(db, schemas.VisitCreate(patient_id=patient.id, visit_date=datetime.utcnow(), reason=reason))
+    stats.rebuild_rollups(db)
+
+    def reasons():
+        return {t["reason"] for t in stats.get_trends(db, granularity="month", group_by="reason")}
+
+    assert len(reasons()) <= 3 + 1
+    assert "other" in reasons()
+    assert all(reason == reason.strip().lower() for reason in reasons())
+
+    crud.create_visit(db, schemas.VisitCreate(
+        patient_id=patient.id, visit_date=datetime.utcnow(), reason="Chipped tooth",
+    ))
+    assert "chipped tooth" not in reasons()
+    assert len(reasons()) <= 3 + 1